@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# blokcrafters local action archive
+# an append-only store of history actions with an account/action/time index, shared by the tools
+#
+import argparse
+import functools
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import hyperion
+
+# Start a new segment file once the current one is bigger than this.
+SEGMENT_SIZE = 64 * 1024 * 1024
+# How many actions are fetched and appended together while syncing.
+SYNC_BATCH = hyperion.PAGE_SIZE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+  id INTEGER PRIMARY KEY,
+  segment INTEGER NOT NULL,
+  offset INTEGER NOT NULL,
+  length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS actions (
+  global_sequence INTEGER PRIMARY KEY,
+  block INTEGER NOT NULL,
+  timestamp INTEGER NOT NULL,
+  contract TEXT NOT NULL,
+  name TEXT NOT NULL,
+  amount REAL,
+  chunk INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS actions_contract ON actions (contract, name, timestamp);
+CREATE INDEX IF NOT EXISTS actions_timestamp ON actions (timestamp);
+CREATE TABLE IF NOT EXISTS accounts (
+  account TEXT NOT NULL,
+  global_sequence INTEGER NOT NULL,
+  PRIMARY KEY (account, global_sequence)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feeds (
+  name TEXT PRIMARY KEY,
+  params TEXT NOT NULL,
+  block INTEGER NOT NULL,
+  global_sequence INTEGER NOT NULL,
+  timestamp REAL
+);
+"""
+
+def ActionAccounts(action):
+    # The accounts an action is indexed under: the notified accounts, the authorizers
+    # and the usual account fields of the action data (owner, from, to).
+    accounts = set(action.get('notified', []))
+    for authorization in action['act'].get('authorization', []):
+        accounts.add(authorization['actor'])
+    data = action['act'].get('data')
+    if isinstance(data, dict):
+        for field in ('owner', 'from', 'to'):
+            if isinstance(data.get(field), str):
+                accounts.add(data[field])
+    return accounts
+
+class ActionStore:
+    # Actions are kept as JSON lines in gzip members appended to segment files, one member
+    # per appended batch, and indexed in SQLite by global_sequence, contract and action name,
+    # block time and the accounts involved.  Nothing is ever rewritten.
+    def __init__(self, directory, segmentSize=SEGMENT_SIZE):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        os.makedirs(os.path.join(directory, 'segments'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        # Stores made before the feed cursors kept the time of their action.
+        if 'timestamp' not in [column[1] for column in self.db.execute("PRAGMA table_info(feeds)")]:
+            self.db.execute("ALTER TABLE feeds ADD COLUMN timestamp REAL")
+        self.ReadChunk = functools.lru_cache(maxsize=16)(self.ReadChunk)
+
+    def SegmentFilename(self, segment):
+        return os.path.join(self.directory, 'segments', f"{segment:06d}.gz")
+
+    def Append(self, actions, feed=None, cursor=None):
+        # Add the actions not already in the store and, in the same transaction, move
+        # the feed's cursor.  The member is written before the index is committed, so a
+        # crash can only leave unreferenced bytes at the end of a segment.
+        with self.lock:
+            new = []
+            for action in actions:
+                if self.db.execute("SELECT 1 FROM actions WHERE global_sequence = ?", (action['global_sequence'],)).fetchone() is None:
+                    new.append(action)
+            with self.db:
+                if new:
+                    segment = self.db.execute("SELECT MAX(segment) FROM chunks").fetchone()[0] or 1
+                    if os.path.exists(self.SegmentFilename(segment)) and os.path.getsize(self.SegmentFilename(segment)) >= self.segmentSize:
+                        segment += 1
+                    member = gzip.compress(''.join(json.dumps(a) + "\n" for a in new).encode())
+                    with open(self.SegmentFilename(segment), 'ab') as fh:
+                        offset = fh.tell()
+                        fh.write(member)
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                    chunk = self.db.execute("INSERT INTO chunks (segment, offset, length) VALUES (?, ?, ?)",
+                                            (segment, offset, len(member))).lastrowid
+                    for action in new:
+                        data = action['act'].get('data')
+                        amount = data.get('amount') if isinstance(data, dict) else None
+                        self.db.execute("INSERT INTO actions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        (action['global_sequence'], action['block_num'], int(hyperion.ActionTime(action['@timestamp']) * 1000),
+                                         action['act']['account'], action['act']['name'],
+                                         amount if isinstance(amount, (int, float)) else None, chunk))
+                        self.db.executemany("INSERT OR IGNORE INTO accounts VALUES (?, ?)",
+                                            [(account, action['global_sequence']) for account in ActionAccounts(action)])
+                if feed is not None:
+                    self.db.execute("UPDATE feeds SET block = ?, global_sequence = ?, timestamp = ? WHERE name = ?",
+                                    (cursor['block'], cursor['global_sequence'], cursor.get('timestamp'), feed))
+            return len(new)
+
+    def Feed(self, feed, params, client=None, start='head'):
+        # The cursor of a feed, creating it at the head of the chain or at its start.  The
+        # cursor keeps the time of its action, when known, so a feed far behind catches up
+        # in parallel time slices.
+        with self.lock:
+            row = self.db.execute("SELECT block, global_sequence, timestamp FROM feeds WHERE name = ?", (feed,)).fetchone()
+        if row:
+            cursor = {'block': row[0], 'global_sequence': row[1]}
+            if row[2] is not None:
+                cursor['timestamp'] = row[2]
+            return cursor
+        if start == 'head':
+            cursor = hyperion.HeadCursor(client, params)
+        else:
+            cursor = hyperion.StartCursor(client, params)
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO feeds VALUES (?, ?, ?, ?, ?)",
+                            (feed, json.dumps(params), cursor['block'], cursor['global_sequence'], cursor.get('timestamp')))
+        return cursor
+
+    def Sync(self, client, feed, params, start='head'):
+        # Fetch everything newer than the feed's cursor and append it a page at a time.
+        cursor = self.Feed(feed, params, client, start)
+        added = 0
+        batch = []
+        for action in hyperion.FollowActions(client, params, cursor, simple=False):
+            batch.append(action)
+            if len(batch) >= SYNC_BATCH:
+                added += self.Append(batch, feed, cursor)
+                batch = []
+        added += self.Append(batch, feed, cursor)
+        return added
+
+    def ReadChunk(self, segment, offset, length):
+        with open(self.SegmentFilename(segment), 'rb') as fh:
+            fh.seek(offset)
+            lines = gzip.decompress(fh.read(length)).decode().splitlines()
+        return {action['global_sequence']: action for action in map(json.loads, lines)}
+
+    def Query(self, contract=None, name=None, account=None, after=None, before=None, afterSequence=None,
+              amountOver=None, newestFirst=False, limit=None):
+        # The stored actions matching every given condition in chain order (or newest
+        # first).  after and before are epoch seconds.
+        where = []
+        params = []
+        table = "actions"
+        if account is not None:
+            table = "accounts JOIN actions USING (global_sequence)"
+            where.append("account = ?")
+            params.append(account)
+        for column, value in (('contract', contract), ('name', name)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if after is not None:
+            where.append("timestamp > ?")
+            params.append(int(after * 1000))
+        if before is not None:
+            where.append("timestamp < ?")
+            params.append(int(before * 1000))
+        if afterSequence is not None:
+            where.append("global_sequence > ?")
+            params.append(afterSequence)
+        if amountOver is not None:
+            where.append("amount > ?")
+            params.append(amountOver)
+        sql = f"SELECT global_sequence, segment, offset, length FROM {table} JOIN chunks ON chunks.id = chunk"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY global_sequence" + (" DESC" if newestFirst else "")
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        for globalSequence, segment, offset, length in rows:
+            yield self.ReadChunk(segment, offset, length)[globalSequence]
+
+# MAIN
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query a local action store, printing the matching actions as JSON lines.")
+    parser.add_argument("directory", help="The action store directory")
+    parser.add_argument("-c", "--contract", help="Only actions of this contract, e.g. eosio.token")
+    parser.add_argument("-n", "--name", help="Only actions with this name, e.g. transfer")
+    parser.add_argument("-a", "--account", help="Only actions involving this account (notified, authorizer, owner, from or to)")
+    parser.add_argument("-s", "--since", help="Only actions from the last this many seconds", type=float)
+    parser.add_argument("-o", "--amount-over", help="Only actions with an amount over this", type=float)
+    parser.add_argument("-l", "--limit", help="At most this many actions, newest first", type=int)
+    args = parser.parse_args()
+
+    store = ActionStore(args.directory)
+    after = time.time() - args.since if args.since else None
+    for action in store.Query(contract=args.contract, name=args.name, account=args.account, after=after,
+                              amountOver=args.amount_over, newestFirst=args.limit is not None, limit=args.limit):
+        print(json.dumps(action))
+    sys.stdout.flush()
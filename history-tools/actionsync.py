@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+#
+# blokcrafters action store sync
+# keeps a local action store up to date with one or more history feeds
+#
+import argparse
+import sys
+import time
+import urllib.parse
+
+import actionstore
+import hyperion
+
+parser = argparse.ArgumentParser(epilog="""
+Each feed is a name and a get_actions query, e.g. -f producerjson act.account=producerjson
+or -f ram account=eosio.ram.  A new feed starts at the newest action unless --from-start is given.
+""")
+parser.add_argument("-d", "--directory", help="The action store directory", required=True)
+parser.add_argument("-u", "--url", help="The history endpoint (default: %(default)s)", default=hyperion.HISTORY_URL)
+parser.add_argument("-f", "--feed", help="A feed to sync: a name and a get_actions query", nargs=2, action='append',
+                    metavar=('NAME', 'QUERY'), required=True)
+parser.add_argument("-s", "--from-start", help="Sync new feeds from the first action rather than the newest", action="store_true")
+parser.add_argument("-i", "--interval", help="Keep running and sync every this many seconds", type=int, default=0)
+args = parser.parse_args()
+
+store = actionstore.ActionStore(args.directory)
+client = hyperion.HistoryClient(args.url)
+while True:
+    for name, query in args.feed:
+        try:
+            added = store.Sync(client, name, dict(urllib.parse.parse_qsl(query)), start='genesis' if args.from_start else 'head')
+            print(f"{name}: {added} new actions", flush=True)
+        except (OSError, ValueError) as e:
+            print(f"{name}: {args.url}: {e}", file=sys.stderr, flush=True)
+    if not args.interval:
+        break
+    time.sleep(args.interval)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#
+# blokcrafters Hyperion stand-in
+# a local server speaking enough of the Hyperion stream and get_actions APIs to exercise the tools
+#
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+import socketio
+import werkzeug.serving
+
+import hyperion
+import hyperionstream
+
+ACCOUNTS = ['alice', 'bob', 'carol', 'dave', 'eosio.ram', 'eosio.names', 'eosio.stake']
+MEMOS = {'eosio.ram': 'buy ram', 'eosio.names': 'bid name cool'}
+
+class Chain:
+    # A synthetic chain of eosio.token transfers with a bounded in-memory history.
+    def __init__(self, historySize):
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=historySize)
+        self.block = 1
+        self.globalSequence = 0
+
+    def NewAction(self):
+        with self.lock:
+            self.globalSequence += 1
+            if self.globalSequence % 10 == 0:
+                self.block += 1
+            sender, receiver = random.sample(ACCOUNTS, 2)
+            amount = round(random.paretovariate(1.2) * 10, 4)
+            timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            action = {
+                '@timestamp': timestamp,
+                'block_num': self.block,
+                'global_sequence': self.globalSequence,
+                'trx_id': f"{self.globalSequence:064x}",
+                'notified': ['eosio.token', sender, receiver],
+                'act': {
+                    'account': 'eosio.token',
+                    'name': 'transfer',
+                    'authorization': [{'actor': sender, 'permission': 'active'}],
+                    'data': {'from': sender, 'to': receiver, 'amount': amount, 'symbol': 'WAX',
+                             'quantity': f"{amount:.8f} WAX", 'memo': MEMOS.get(receiver, '')},
+                },
+            }
+            self.history.append(action)
+            return action
+
+    def Since(self, block):
+        with self.lock:
+            return [a for a in self.history if a['block_num'] >= block]
+
+def Matches(request, action):
+    if request.get('contract', '*') not in ('*', action['act']['account']):
+        return False
+    if request.get('action', '*') not in ('*', action['act']['name']):
+        return False
+    return request.get('account', '') in ('', action['act']['account']) or request['account'] in action['notified']
+
+class StandIn:
+    def __init__(self, args):
+        self.args = args
+        # While set, get_actions answers 503, as a history node does when its backend is down.
+        self.failing = False
+        self.chain = Chain(args.history)
+        self.sio = socketio.Server(async_mode='threading')
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.sio.on('action_stream_request', self.OnRequest)
+        self.sio.on('disconnect', self.OnDisconnect)
+        app = socketio.WSGIApp(self.sio, self.HistoryApp, socketio_path='stream')
+        self.server = werkzeug.serving.make_server(args.host, args.port, app, threaded=True)
+        self.port = self.server.server_port
+
+    def OnRequest(self, sid, request):
+        history = []
+        if request.get('start_from'):
+            history = [a for a in self.chain.Since(int(request['start_from'])) if Matches(request, a)]
+        with self.lock:
+            self.subscribers.setdefault(sid, []).append(request)
+        for i in range(0, len(history), self.args.batch):
+            messages = [json.dumps(a) for a in history[i:i + self.args.batch]]
+            self.sio.emit('message', {'type': 'action_trace', 'mode': 'history', 'messages': messages}, to=sid)
+        return {'status': 'OK', 'startingBlock': request.get('start_from', 0)}
+
+    def OnDisconnect(self, sid, *args):
+        with self.lock:
+            self.subscribers.pop(sid, None)
+
+    def HistoryApp(self, environ, start_response):
+        # Just enough of /v2/history/get_actions for the polling fallback.
+        if environ['PATH_INFO'] != '/v2/history/get_actions':
+            start_response('404 Not Found', [('Content-Type', 'application/json')])
+            return [b'{}']
+        query = dict(urllib.parse.parse_qsl(environ.get('QUERY_STRING', '')))
+        request = {'account': query.get('account', ''), 'contract': query.get('act.account', '*'), 'action': query.get('act.name', '*')}
+        # after and before are block numbers or times, as on Hyperion.  The history is in
+        # chain order and its timestamps all have the same form, so both bisect it.
+        actions = self.chain.Since(0)
+        for bound, side in (('after', bisect.bisect_right), ('before', bisect.bisect_left)):
+            if bound not in query:
+                continue
+            if query[bound].isdigit():
+                at = side(actions, int(query[bound]), key=lambda a: a['block_num'])
+            else:
+                at = side(actions, hyperion.IsoTime(hyperion.ActionTime(query[bound])), key=lambda a: a['@timestamp'])
+            actions = actions[at:] if bound == 'after' else actions[:at]
+        actions = [a for a in actions if Matches(request, a)]
+        if '@transfer.amount' in query:
+            low, high = (float(v) for v in query['@transfer.amount'].split('-'))
+            actions = [a for a in actions if low <= a['act']['data']['amount'] <= high]
+        if query.get('sort', 'desc') == 'desc':
+            actions.reverse()
+        skip = int(query.get('skip', 0))
+        actions = actions[skip:skip + int(query.get('limit', 10))]
+        if self.args.delay:
+            time.sleep(self.args.delay)
+        if self.failing:
+            start_response('503 Service Unavailable', [('Content-Type', 'application/json')])
+            return [b'{}']
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'actions': actions}).encode()]
+
+    def Produce(self):
+        # Make actions at the requested rate (0 is as fast as possible) and push them
+        # to the matching subscribers a batch at a time.
+        pending = {}
+        lastDrop = time.monotonic()
+        while True:
+            started = time.monotonic()
+            for i in range(self.args.batch):
+                action = self.chain.NewAction()
+                with self.lock:
+                    subscribers = list(self.subscribers.items())
+                for sid, requests in subscribers:
+                    if any(Matches(r, action) for r in requests):
+                        pending.setdefault(sid, []).append(json.dumps(action))
+            for sid, messages in pending.items():
+                self.sio.emit('message', {'type': 'action_trace', 'mode': 'live', 'messages': messages}, to=sid)
+            pending = {}
+            if self.args.drop_every and time.monotonic() - lastDrop >= self.args.drop_every:
+                lastDrop = time.monotonic()
+                for sid in list(self.subscribers):
+                    self.sio.disconnect(sid)
+            if self.args.rate:
+                time.sleep(max(0, self.args.batch / self.args.rate - (time.monotonic() - started)))
+
+    def Start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.Produce, daemon=True).start()
+
+def Benchmark(standIn, seconds):
+    # Sustained events per second through the stand-in and the stream client, checking
+    # that no global_sequence is skipped or repeated on the way.  False when any was, or
+    # nothing arrived.
+    url = f"http://127.0.0.1:{standIn.port}"
+    stream = hyperionstream.ActionStream(url, [{'contract': 'eosio.token', 'action': '*', 'account': ''}], lambda request: 0)
+    stream.Start()
+    while stream.DownFor():
+        time.sleep(0.1)
+    received = 0
+    gaps = 0
+    duplicates = 0
+    last = None
+    started = time.monotonic()
+    while time.monotonic() - started < seconds:
+        for item in stream.Get(timeout=1):
+            if last is not None and item['global_sequence'] <= last:
+                duplicates += 1
+                continue
+            if last is not None and item['global_sequence'] != last + 1:
+                gaps += 1
+            last = item['global_sequence']
+            received += 1
+    elapsed = time.monotonic() - started
+    print(f"benchmark: {received} actions in {elapsed:.1f}s = {received / elapsed:.0f} actions/s, {gaps} gaps, {duplicates} duplicates")
+    if received == 0 or gaps or duplicates:
+        print("benchmark: FAIL: " + ("no actions arrived" if received == 0 else "the stream skipped or repeated actions"))
+        return False
+    return True
+
+def PrintEndpoints(client, served):
+    for e in client.endpoints:
+        latency = f"{e.latency * 1000:.0f}ms" if e.latency is not None else "-"
+        print(f"check: + {e.url}: served {e.served - served[e.url]}, latency average {latency},"
+              f" error rate {e.ErrorRate():.2f}, {'healthy' if e.Healthy() else 'resting'}")
+
+def CheckRecovery(args, failures):
+    # Without hedging to lean on, the quick one fails a burst of concurrent requests until
+    # its error rate makes it unhealthy, then answers again: once its rest is over it must
+    # be back in front.  The rest and the error rate half life are shortened so that this
+    # takes seconds rather than minutes.
+    hyperion.REST_DELAY = 0.2
+    hyperion.ERROR_HALF_LIFE = 1
+    quick = StandIn(argparse.Namespace(**dict(vars(args), port=0, delay=0.01)))
+    slow = StandIn(argparse.Namespace(**dict(vars(args), port=0, delay=0.2)))
+    quick.Start()
+    slow.Start()
+    client = hyperion.HistoryClient([f"http://127.0.0.1:{slow.port}", f"http://127.0.0.1:{quick.port}"], timeout=5, hedge=False)
+    fast = next(e for e in client.endpoints if e.url.endswith(f":{quick.port}"))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+    for phase in ('recovery: steady', 'recovery: quick one fails', 'recovery: quick one back'):
+        served = {e.url: e.served for e in client.endpoints}
+        if phase == 'recovery: quick one fails':
+            quick.failing = True
+            for burst in range(5):
+                list(executor.map(lambda i: client.GetActions({'limit': 1}), range(8)))
+                if fast.ErrorRate() >= hyperion.UNHEALTHY_ERROR_RATE:
+                    break
+            print(f"check: {phase}: error rate {fast.ErrorRate():.2f} after {fast.failures} failures in a row")
+            if fast.ErrorRate() < hyperion.UNHEALTHY_ERROR_RATE:
+                failures.append(f"the failures did not make {fast.url} unhealthy")
+        else:
+            if phase == 'recovery: quick one back':
+                quick.failing = False
+                time.sleep(max(0, fast.restUntil - time.monotonic()) + 0.1)
+            for i in range(20):
+                client.GetActions({'limit': 1})
+            print(f"check: {phase}: {fast.url} served {fast.served - served[fast.url]} of 20")
+            if fast.served - served[fast.url] < 15:
+                failures.append(f"{phase}: the requests did not go to {fast.url}")
+        PrintEndpoints(client, served)
+
+def CheckEndpoints(args):
+    # Two stand-ins, one quick and one slow, behind one HistoryClient: requests should
+    # settle on the quick one, be hedged to the slow one while the quick one stalls and
+    # fail over to the other one when the one ranked first goes away.  Then CheckRecovery.
+    # Exits non-zero when any of that does not happen.
+    quick = StandIn(argparse.Namespace(**dict(vars(args), port=0, delay=0.01)))
+    slow = StandIn(argparse.Namespace(**dict(vars(args), port=0, delay=0.2)))
+    quick.Start()
+    slow.Start()
+    standIns = {f"http://127.0.0.1:{slow.port}": slow, f"http://127.0.0.1:{quick.port}": quick}
+    client = hyperion.HistoryClient(list(standIns), timeout=5)
+    hedges = hyperion.HEDGES
+    failures = []
+    for phase, requests in (('steady', 100), ('quick one stalls', 20), ('first one gone', 20)):
+        gone = None
+        if phase == 'quick one stalls':
+            quick.args.delay = 2
+        elif phase == 'first one gone':
+            quick.args.delay = 0.01
+            gone = client.Ranked()[0]
+            standIns[gone.url].server.shutdown()
+            standIns[gone.url].server.server_close()
+        served = {e.url: e.served for e in client.endpoints}
+        errorRates = {e.url: e.ErrorRate() for e in client.endpoints}
+        hedged = sum(hedges.values.values())
+        latencies = []
+        for i in range(requests):
+            started = time.perf_counter()
+            client.GetActions({'limit': 1})
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        hedged = sum(hedges.values.values()) - hedged
+        print(f"check: {phase}: p50 {latencies[len(latencies) // 2] * 1000:.0f}ms"
+              f" p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f}ms, {hedged} hedged")
+        PrintEndpoints(client, served)
+        if phase == 'quick one stalls' and hedged == 0:
+            failures.append("no request was hedged while the quick one stalled")
+        if gone is not None:
+            others = [e for e in client.endpoints if e is not gone]
+            if sum(e.served - served[e.url] for e in others) < requests:
+                failures.append(f"the requests did not all fail over from {gone.url}")
+            if gone.ErrorRate() <= errorRates[gone.url]:
+                failures.append(f"the error rate of {gone.url} did not go up")
+    CheckRecovery(args, failures)
+    for failure in failures:
+        print(f"check: FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+def CheckPushdown(args):
+    # A stand-in holding a day of transfers, as slow to answer as a distant, busy server:
+    # the whale transfers found by filtering the whole feed on the client, by pushing the
+    # filters down to the server, and in a catch-up over the whole day paged forward one
+    # page at a time and in time slices fetched in parallel.  Each way must find the same.
+    standIn = StandIn(argparse.Namespace(**dict(vars(args), port=0, delay=args.delay or 0.25)))
+    count = min(args.history, 50000)
+    day = 86400
+    started = time.time() - day
+    for i in range(count):
+        standIn.chain.NewAction()['@timestamp'] = hyperion.IsoTime(started + i * day / count)
+    threading.Thread(target=standIn.server.serve_forever, daemon=True).start()
+    client = hyperion.HistoryClient(f"http://127.0.0.1:{standIn.port}", hedge=False)
+    params = {'account': 'eosio.token'}
+    amountOver = 1000
+
+    def Run(name, fetch):
+        received = sum(hyperion.FETCH_BYTES.values.values())
+        requests = sum(sum(counts[:-1]) for counts in hyperion.FETCH_SECONDS.values.values())
+        began = time.monotonic()
+        found = [a['global_sequence'] for a in fetch() if a['act']['data']['amount'] > amountOver]
+        print(f"check: {name}: {len(found)} whale transfers in {time.monotonic() - began:.1f}s,"
+              f" {sum(sum(counts[:-1]) for counts in hyperion.FETCH_SECONDS.values.values()) - requests} requests,"
+              f" {sum(hyperion.FETCH_BYTES.values.values()) - received} bytes")
+        return found
+
+    print(f"check: {count} transfers over a day, {standIn.args.delay * 1000:.0f}ms per request, whales over {amountOver}")
+    pushed = hyperion.Pushdown(params, action='transfer', amountOver=amountOver)
+    results = [
+        Run('whole feed, filtered on the client', lambda: hyperion.FollowActions(client, params, {'block': 0, 'global_sequence': 0}, simple=False)),
+        Run('filters pushed down', lambda: hyperion.FollowActions(client, pushed, {'block': 0, 'global_sequence': 0}, simple=False)),
+        Run('catch-up, a page at a time', lambda: hyperion.SliceActions(client, params, started, started + day)),
+        Run('catch-up, time slices in parallel', lambda: hyperion.SlicedActions(client, params, started, started + day)),
+        Run('catch-up, time slices in parallel, filters pushed down', lambda: hyperion.SlicedActions(client, pushed, started, started + day)),
+    ]
+    if any(found != results[0] for found in results):
+        print("check: FAIL: the ways found different transfers")
+        sys.exit(1)
+
+# MAIN
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", help="The address to listen on (default: %(default)s)", default="127.0.0.1")
+parser.add_argument("-p", "--port", help="The port to listen on, 0 picks a free one (default: %(default)s)", type=int, default=7000)
+parser.add_argument("-r", "--rate", help="Actions per second to produce, 0 is as fast as possible (default: %(default)s)", type=float, default=10)
+parser.add_argument("-b", "--batch", help="Actions per stream message (default: %(default)s)", type=int, default=1)
+parser.add_argument("--history", help="How many actions to keep for start_from and get_actions (default: %(default)s)", type=int, default=100000)
+parser.add_argument("--delay", help="Seconds to delay each get_actions response (default: %(default)s)", type=float, default=0)
+parser.add_argument("--drop-every", help="Disconnect every stream client this often in seconds, 0 never (default: %(default)s)", type=float, default=0)
+parser.add_argument("--benchmark", help="Run a stream client against the stand-in for this many seconds and report actions/s", type=float, default=0)
+parser.add_argument("--check-pushdown", help="Compare filtering the whole feed on the client with pushing the filters down, and a paged catch-up with a time-sliced one", action="store_true")
+parser.add_argument("--check-endpoints", help="Run a quick and a slow stand-in behind one history client and report how it routes, hedges and fails over", action="store_true")
+args = parser.parse_args()
+
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+if args.check_endpoints:
+    CheckEndpoints(args)
+    sys.exit(0)
+if args.check_pushdown:
+    CheckPushdown(args)
+    sys.exit(0)
+standIn = StandIn(args)
+standIn.Start()
+print(f"stand-in: listening on http://{args.host}:{standIn.port}", file=sys.stderr, flush=True)
+if args.benchmark:
+    sys.exit(0 if Benchmark(standIn, args.benchmark) else 1)
+while True:
+    time.sleep(3600)
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+#
+# blokcrafters Hyperion history helpers shared by the tools
+#
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+import requests
+
+import jsonstream
+import metrics
+
+# The history endpoint used when none is given.
+HISTORY_URL = "https://api.blokcrafters.io"
+# How many actions to ask for on each get_actions page while following.
+PAGE_SIZE = 1000
+# The upper end of a @transfer.amount range asked for with only a lower end: more WAX than
+# there will ever be.
+MAX_AMOUNT = 10 ** 11
+# A cursor that is further behind than this many seconds is caught up in time slices,
+# SLICE_WORKERS of them fetched at once, rather than a page at a time.  The slices are at
+# least SLICE_SECONDS long and there are at most MAX_SLICES of them, so a sparse feed
+# caught up from its start costs few requests; each slice buffers at most SLICE_PAGES
+# pages ahead of the caller.
+CATCH_UP_AFTER = 3600
+SLICE_SECONDS = 600
+SLICE_WORKERS = 8
+MAX_SLICES = 64
+SLICE_PAGES = 2
+# Seconds to wait for the history API before giving up on a request.
+TIMEOUT = 10
+# How many keep-alive connections to hold open per history endpoint.
+POOL_SIZE = 10
+# Weight of the newest sample in the per-endpoint latency and error rate averages.
+EWMA_ALPHA = 0.2
+# An endpoint whose error rate average reaches this is skipped until it has rested.
+UNHEALTHY_ERROR_RATE = 0.5
+# Seconds for the error rate average to halve while an endpoint is not asked anything, so
+# one that stopped failing is tried again even when it is no longer sent requests.
+ERROR_HALF_LIFE = 60
+# Seconds an endpoint rests after a failure, multiplied by its consecutive failures.
+REST_DELAY = 15
+# How many latencies are kept per endpoint to estimate its p95; fewer samples than
+# MIN_P95_SAMPLES and a quarter of the timeout is used as the hedging delay instead.
+LATENCY_SAMPLES = 100
+MIN_P95_SAMPLES = 20
+
+FETCH_SECONDS = metrics.NewHistogram('hyperion_fetch_seconds', "Time taken by history API requests", ('endpoint', 'path'))
+FETCH_BYTES = metrics.NewCounter('hyperion_fetch_bytes_total', "Bytes downloaded from the history API", ('endpoint', 'path'))
+FETCH_ERRORS = metrics.NewCounter('hyperion_fetch_errors_total', "Failed history API requests", ('endpoint', 'path'))
+HEDGES = metrics.NewCounter('hyperion_hedged_requests_total', "Requests duplicated to the runner-up endpoint because the primary was slow", ('endpoint',))
+
+class Endpoint:
+    # What the client has learned about one history endpoint.
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.lock = threading.Lock()
+        self.latency = None
+        self.errorRate = 0.0
+        self.errorAt = time.monotonic()
+        self.failures = 0
+        self.restUntil = 0
+        self.served = 0
+        self.recent = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def Record(self, seconds, ok):
+        with self.lock:
+            if ok:
+                self.latency = seconds if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * seconds
+                self.recent.append(seconds)
+                self.failures = 0
+                self.served += 1
+            else:
+                self.failures += 1
+                self.restUntil = time.monotonic() + REST_DELAY * self.failures
+            self.errorRate = (1 - EWMA_ALPHA) * self.Decayed() + EWMA_ALPHA * (0 if ok else 1)
+            self.errorAt = time.monotonic()
+
+    def Decayed(self):
+        return self.errorRate * 0.5 ** ((time.monotonic() - self.errorAt) / ERROR_HALF_LIFE)
+
+    def ErrorRate(self):
+        with self.lock:
+            return self.Decayed()
+
+    def Healthy(self):
+        return time.monotonic() >= self.restUntil and self.ErrorRate() < UNHEALTHY_ERROR_RATE
+
+    def P95(self):
+        with self.lock:
+            if len(self.recent) < MIN_P95_SAMPLES:
+                return None
+            return sorted(self.recent)[int(len(self.recent) * 0.95) - 1]
+
+class HistoryClient:
+    # Requests go to the fastest healthy endpoint by latency average, and fail over down
+    # the ranking when it errors.  When the chosen endpoint has not answered within its
+    # own p95 the request is duplicated to the runner-up and the first answer wins.
+    # All requests share one pooled keep-alive session, so concurrent fetches reuse
+    # connections instead of paying a TLS handshake each.
+    def __init__(self, endpoints=HISTORY_URL, poolSize=POOL_SIZE, timeout=TIMEOUT, hedge=True):
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        self.endpoints = [Endpoint(url) for url in endpoints]
+        self.historyURL = self.endpoints[0].url
+        self.timeout = timeout
+        self.hedge = hedge
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * poolSize)
+
+    def Ranked(self):
+        # Healthy endpoints fastest first (untried ones count as fastest so they get
+        # measured), then the resting ones, soonest back first.
+        healthy = [e for e in self.endpoints if e.Healthy()]
+        resting = [e for e in self.endpoints if not e.Healthy()]
+        healthy.sort(key=lambda e: e.latency or 0)
+        resting.sort(key=lambda e: e.restUntil)
+        return healthy + resting
+
+    def Fetch(self, endpoint, path, params=None, body=None):
+        started = time.perf_counter()
+        try:
+            if body is None:
+                r = self.session.get(endpoint.url + path, params=params, timeout=self.timeout)
+            else:
+                r = self.session.post(endpoint.url + path, json=body, timeout=self.timeout)
+            r.raise_for_status()
+            result = r.json()
+        except (requests.RequestException, ValueError):
+            FETCH_ERRORS.Inc(endpoint=endpoint.url, path=path)
+            endpoint.Record(time.perf_counter() - started, False)
+            raise
+        finally:
+            FETCH_SECONDS.Observe(time.perf_counter() - started, endpoint=endpoint.url, path=path)
+        endpoint.Record(time.perf_counter() - started, True)
+        FETCH_BYTES.Inc(len(r.content), endpoint=endpoint.url, path=path)
+        return result
+
+    def Request(self, path, params=None, body=None):
+        ranked = self.Ranked()
+        error = None
+        i = 0
+        while i < len(ranked):
+            primary = ranked[i]
+            futures = {self.executor.submit(self.Fetch, primary, path, params, body)}
+            if self.hedge and i + 1 < len(ranked):
+                hedgeAfter = primary.P95() or self.timeout / 4
+                done, pending = concurrent.futures.wait(futures, timeout=hedgeAfter)
+                if pending:
+                    HEDGES.Inc(endpoint=primary.url)
+                    i += 1
+                    futures.add(self.executor.submit(self.Fetch, ranked[i], path, params, body))
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    return future.result()
+                except (requests.RequestException, ValueError) as e:
+                    error = e
+            i += 1
+        raise error
+
+    def GetActions(self, params):
+        return self.Request("/v2/history/get_actions", params)
+
+    def StreamActions(self, params, keep=None):
+        # get_actions with the actions decoded one at a time as the page arrives, so memory
+        # stays flat however large the page; keep drops all but these fields of each action.
+        # An endpoint that fails before the first action is failed over as in Request(), but
+        # streams are not hedged, and a failure part way through is raised to the caller.
+        # The endpoint is ranked by how long it took to start answering, since the rest of
+        # the time goes as fast as the caller takes the actions.
+        path = "/v2/history/get_actions"
+        error = None
+        for endpoint in self.Ranked():
+            started = time.perf_counter()
+            received = [0]
+            yielded = False
+            try:
+                with self.session.get(endpoint.url + path, params=params, timeout=self.timeout, stream=True) as r:
+                    r.raise_for_status()
+                    answered = time.perf_counter() - started
+                    for action in jsonstream.ArrayStream(self.Chunks(r, received), keep=keep):
+                        yielded = True
+                        yield action
+            except (requests.RequestException, ValueError) as e:
+                FETCH_ERRORS.Inc(endpoint=endpoint.url, path=path)
+                endpoint.Record(time.perf_counter() - started, False)
+                if yielded:
+                    raise
+                error = e
+                continue
+            finally:
+                FETCH_SECONDS.Observe(time.perf_counter() - started, endpoint=endpoint.url, path=path)
+                FETCH_BYTES.Inc(received[0], endpoint=endpoint.url, path=path)
+            endpoint.Record(answered, True)
+            return
+        raise error
+
+    def Chunks(self, r, received):
+        for chunk in r.iter_content(jsonstream.CHUNK_SIZE):
+            received[0] += len(chunk)
+            yield chunk
+
+    # Hyperion nodes also answer the chain API, so the producer registry comes the same way.
+    def GetProducers(self, lowerBound='', limit=100):
+        return self.Request("/v1/chain/get_producers", body={'json': True, 'lower_bound': lowerBound, 'limit': limit})
+
+    def GetProducerSchedule(self):
+        return self.Request("/v1/chain/get_producer_schedule", body={})
+
+def ActionTime(timestamp):
+    # Hyperion timestamps are UTC without a zone suffix, e.g. 2022-03-12T14:40:49.000
+    dt = datetime.datetime.fromisoformat(timestamp)
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def IsoTime(epoch):
+    # The other way round, to the millisecond.
+    return datetime.datetime.utcfromtimestamp(epoch).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+def Pushdown(params, contract=None, action=None, amountOver=None, after=None, before=None):
+    # params narrowed so that Hyperion leaves out the actions the caller would throw away:
+    # act.account, act.name, a @transfer.amount range (from amountOver, which it counts
+    # inclusively) and after and before times in epoch seconds.  A server that does not know
+    # a filter may ignore it, so the caller still checks every action it is given.
+    query = dict(params)
+    if contract is not None:
+        query['act.account'] = contract
+    if action is not None:
+        query['act.name'] = action
+    if amountOver is not None:
+        query['@transfer.amount'] = f"{amountOver}-{MAX_AMOUNT}"
+    if after is not None:
+        query['after'] = IsoTime(after)
+    if before is not None:
+        query['before'] = IsoTime(before)
+    return query
+
+def SimpleAction(action):
+    # Flatten a full get_actions entry into the shape of a simple=true entry,
+    # keeping the global_sequence that simple mode leaves out.
+    return {
+        'block': action['block_num'],
+        'global_sequence': action['global_sequence'],
+        'timestamp': action['@timestamp'],
+        'trx_id': action['trx_id'],
+        'contract': action['act']['account'],
+        'action': action['act']['name'],
+        'notified': action.get('notified', []),
+        'data': action['act']['data'],
+    }
+
+def LoadCursor(filename):
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+def SaveCursor(filename, cursor):
+    # Write to a temporary file first so a crash never leaves a torn cursor behind.
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, 'w') as fh:
+        json.dump(cursor, fh)
+    os.replace(tmpFilename, filename)
+
+def HeadCursor(client, params):
+    # A cursor positioned at the newest action matching params, so following
+    # starts from now rather than from the beginning of the chain.
+    query = dict(params, sort='desc', limit=1)
+    actions = client.GetActions(query).get('actions', [])
+    if len(actions) == 0:
+        return {'block': 0, 'global_sequence': 0}
+    return {'block': actions[0]['block_num'], 'global_sequence': actions[0]['global_sequence'],
+            'timestamp': ActionTime(actions[0]['@timestamp'])}
+
+def StartCursor(client, params):
+    # A cursor just before the oldest action matching params, so following starts from the
+    # beginning of the chain and knows how far behind it is.
+    actions = client.GetActions(dict(params, sort='asc', limit=1)).get('actions', [])
+    if len(actions) == 0:
+        return {'block': 0, 'global_sequence': 0}
+    return {'block': actions[0]['block_num'], 'global_sequence': actions[0]['global_sequence'] - 1,
+            'timestamp': ActionTime(actions[0]['@timestamp']) - 0.001}
+
+def SlicePages(client, params, start, end, pageSize=PAGE_SIZE, keep=None):
+    # The pages of actions matching params from epoch seconds start up to end, in chain
+    # order.  Each page starts a millisecond before the last action of the one before and
+    # the actions already seen are dropped, so nothing is lost or repeated whether the
+    # server counts after= and before= inclusively or not; skip= steps through a
+    # millisecond holding more than a page.
+    after = start - 0.001
+    last = 0
+    skip = 0
+    while True:
+        query = dict(params, sort='asc', after=IsoTime(after), before=IsoTime(end + 0.001), limit=pageSize)
+        if skip:
+            query['skip'] = skip
+        count = 0
+        newest = after
+        page = []
+        for action in client.StreamActions(query, keep=keep):
+            count += 1
+            newest = ActionTime(action['@timestamp'])
+            if action['global_sequence'] > last and start <= newest < end:
+                page.append(action)
+                last = action['global_sequence']
+        yield page
+        if count < pageSize:
+            return
+        if newest - 0.001 > after:
+            after = newest - 0.001
+            skip = 0
+        else:
+            skip += count
+
+def SliceActions(client, params, start, end, pageSize=PAGE_SIZE, keep=None):
+    return [action for page in SlicePages(client, params, start, end, pageSize, keep) for action in page]
+
+def SlicedActions(client, params, start, end, sliceSeconds=SLICE_SECONDS, workers=SLICE_WORKERS, pageSize=PAGE_SIZE,
+                  keep=None, maxSlices=MAX_SLICES):
+    # The actions matching params from epoch seconds start up to end, in chain order, with
+    # the range cut into slices that are fetched side by side, workers of them at a time,
+    # and yielded in order.  A slice hands its pages over through a queue of SLICE_PAGES,
+    # so however long the slices are at most workers * SLICE_PAGES pages are held.
+    slices = min(max(1, math.ceil((end - start) / sliceSeconds)), maxSlices)
+    length = (end - start) / slices
+    bounds = iter([(start + i * length, end if i == slices - 1 else start + (i + 1) * length) for i in range(slices)])
+    stopping = threading.Event()
+
+    def Put(pages, item):
+        # Wait for room unless the caller has stopped taking the actions.
+        while not stopping.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Fill(pages, s, e):
+        # The end of the slice is handed over as None and a failure as the exception.
+        try:
+            for page in SlicePages(client, params, s, e, pageSize, keep):
+                if not Put(pages, page):
+                    return
+            Put(pages, None)
+        except Exception as error:
+            Put(pages, error)
+
+    def Submit(executor, s, e):
+        pages = queue.Queue(maxsize=SLICE_PAGES)
+        executor.submit(Fill, pages, s, e)
+        return pages
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            fetching = collections.deque(Submit(executor, s, e) for s, e in itertools.islice(bounds, workers))
+            while fetching:
+                pages = fetching.popleft()
+                while True:
+                    page = pages.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    yield from page
+                for s, e in itertools.islice(bounds, 1):
+                    fetching.append(Submit(executor, s, e))
+        finally:
+            stopping.set()
+
+def Advance(cursor, action):
+    cursor['block'] = action['block_num']
+    cursor['global_sequence'] = action['global_sequence']
+    cursor['timestamp'] = ActionTime(action['@timestamp'])
+
+def FollowActions(client, params, cursor, pageSize=PAGE_SIZE, simple=True, catchUp=CATCH_UP_AFTER):
+    # Page forward from the cursor with sort=asc until caught up, yielding every
+    # action exactly once in chain order.  The cursor is advanced in place as
+    # each action is yielded; the caller decides when to persist it.  With simple=False
+    # the full get_actions entries are yielded.
+    #
+    # A cursor that holds the time of its action and is more than catchUp seconds behind
+    # is first brought up to now with SlicedActions, the slices fetched in parallel.
+    #
+    # Pages start one block before the cursor block so that the boundary block is
+    # never lost whether the server treats after= as inclusive or exclusive, and
+    # actions at or below the cursor global_sequence are dropped.  When a single
+    # block holds more than a page worth of actions, skip= is used to step through it.
+    keep = jsonstream.ACTION_FIELDS if simple else None
+    if catchUp and cursor.get('timestamp') and time.time() - cursor['timestamp'] > catchUp:
+        for action in SlicedActions(client, params, cursor['timestamp'], time.time(), pageSize=pageSize, keep=keep):
+            if action['global_sequence'] <= cursor['global_sequence']:
+                continue
+            Advance(cursor, action)
+            yield SimpleAction(action) if simple else action
+    after = max(cursor['block'] - 1, 0)
+    skip = 0
+    while True:
+        query = dict(params, sort='asc', after=after, limit=pageSize)
+        if skip:
+            query['skip'] = skip
+        # The page is streamed, so only the action in hand is held however large it is.
+        count = 0
+        lastBlock = None
+        for action in client.StreamActions(query, keep=keep):
+            count += 1
+            lastBlock = action['block_num']
+            if action['global_sequence'] <= cursor['global_sequence']:
+                continue
+            Advance(cursor, action)
+            yield SimpleAction(action) if simple else action
+        if count < pageSize:
+            return
+        if lastBlock - 1 > after:
+            after = lastBlock - 1
+            skip = 0
+        else:
+            skip += count
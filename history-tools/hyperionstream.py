@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# blokcrafters Hyperion stream client
+#
+import json
+import queue
+import sys
+import threading
+import time
+
+import socketio
+
+import hyperion
+
+# Seconds to wait between attempts to (re)connect to the stream.
+RECONNECT_DELAY = 5
+
+class ActionStream:
+    # Subscribes to the Hyperion stream API (socket.io on /stream) and queues every
+    # action trace it receives as a simple action.  The stream requests are sent again
+    # on every connect with start_from taken from startFrom(request), so after a drop
+    # the stream resumes from the consumer's cursor instead of from the live head.
+    def __init__(self, streamURL, streamRequests, startFrom):
+        self.streamURL = streamURL
+        self.streamRequests = streamRequests
+        self.startFrom = startFrom
+        self.actions = queue.Queue()
+        self.downSince = time.monotonic()
+        self.sio = socketio.Client(reconnection=True, reconnection_delay=RECONNECT_DELAY)
+        self.sio.on('connect', self.OnConnect)
+        self.sio.on('disconnect', self.OnDisconnect)
+        self.sio.on('message', self.OnMessage)
+
+    def OnConnect(self):
+        for request in self.streamRequests:
+            request = dict(request, start_from=self.startFrom(request), read_until=0)
+            self.sio.emit('action_stream_request', request, callback=self.OnRequestAck)
+        self.downSince = None
+
+    def OnRequestAck(self, response):
+        if not isinstance(response, dict) or response.get('status') != 'OK':
+            print(f"stream: {self.streamURL}: request refused: {response}", file=sys.stderr, flush=True)
+
+    def OnDisconnect(self, *args):
+        if self.downSince is None:
+            self.downSince = time.monotonic()
+
+    def OnMessage(self, msg):
+        if not isinstance(msg, dict) or msg.get('type') != 'action_trace':
+            return
+        messages = msg['messages'] if 'messages' in msg else [msg.get('message')]
+        for message in messages:
+            if isinstance(message, str):
+                message = json.loads(message)
+            if message:
+                self.actions.put(hyperion.SimpleAction(message))
+
+    def DownFor(self):
+        # Seconds since the stream was last connected, 0 while it is up.
+        downSince = self.downSince
+        return 0 if downSince is None else time.monotonic() - downSince
+
+    def Get(self, timeout):
+        # Wait up to timeout for an action, then return it with everything else already queued.
+        try:
+            items = [self.actions.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                items.append(self.actions.get_nowait())
+            except queue.Empty:
+                return items
+
+    def Start(self):
+        threading.Thread(target=self.Run, daemon=True).start()
+
+    def Run(self):
+        # socketio reconnects by itself once connected; this loop covers the first connect.
+        while True:
+            try:
+                self.sio.connect(self.streamURL, transports=['websocket'], socketio_path='stream')
+                self.sio.wait()
+            except socketio.exceptions.ConnectionError as e:
+                print(f"stream: {self.streamURL}: {e}", file=sys.stderr, flush=True)
+            time.sleep(RECONNECT_DELAY)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#
+# blokcrafters streaming JSON decoding
+# the items of a large JSON array, e.g. a get_actions page, decoded one at a time as the bytes arrive
+#
+import argparse
+import codecs
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Bytes read at a time from a file or an HTTP response.
+CHUNK_SIZE = 64 * 1024
+# The full get_actions fields the tools use; with keep=ACTION_FIELDS the rest, e.g. the
+# receipts and RAM deltas, are dropped as each action is decoded.
+ACTION_FIELDS = ('@timestamp', 'block_num', 'global_sequence', 'trx_id', 'act', 'notified')
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',:]}'
+
+class ArrayStream:
+    # Iterating yields the items of the array under key in a JSON object read from chunks
+    # (an iterable of bytes or str), without ever holding more than one item and a chunk.
+    # Each item is decoded by the C scanner of the json module as soon as the text of the
+    # whole item has arrived.  The object's other members are decoded whole into fields as
+    # they are passed, so those before the array are there from the first item on.
+    def __init__(self, chunks, key='actions', keep=None):
+        self.chunks = iter(chunks)
+        self.key = key
+        self.keep = keep
+        self.fields = {}
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.at = 0
+        self.eof = False
+
+    def More(self):
+        # Append the next chunk to what is left unread; False at the end of the input.
+        if self.eof:
+            return False
+        self.text = self.text[self.at:]
+        self.at = 0
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8.decode(chunk)
+            if chunk:
+                self.text += chunk
+                return True
+        self.eof = True
+        return False
+
+    def Peek(self):
+        # The next character that is not whitespace, or '' at the end of the input.
+        while True:
+            while self.at < len(self.text) and self.text[self.at] in WHITESPACE:
+                self.at += 1
+            if self.at < len(self.text):
+                return self.text[self.at]
+            if not self.More():
+                return ''
+
+    def Expect(self, characters):
+        c = self.Peek()
+        if c == '' or c not in characters:
+            raise ValueError(f"expected one of {characters!r} but found {c or 'the end'!r}")
+        self.at += 1
+        return c
+
+    def Value(self):
+        # The next whole value.  A value reaching the end of what has arrived may be cut
+        # short (a number, or an incomplete object that the scanner reports as an error), so
+        # it is only taken once a delimiter follows it; a value is retried after the text has
+        # at least doubled, so that one larger than a chunk does not cost quadratic time.
+        self.Peek()
+        tried = 0
+        while True:
+            if len(self.text) - self.at >= 2 * tried or self.eof:
+                try:
+                    value, end = self.decoder.raw_decode(self.text, self.at)
+                    if (end < len(self.text) and self.text[end] in DELIMITERS) or self.eof:
+                        self.at = end
+                        return value
+                except json.JSONDecodeError:
+                    if self.eof:
+                        raise
+                tried = len(self.text) - self.at
+            if not self.More() and self.at >= len(self.text):
+                raise ValueError("unexpected end of the JSON input")
+
+    def __iter__(self):
+        self.Expect('{')
+        if self.Peek() == '}':
+            return
+        while True:
+            name = self.Value()
+            self.Expect(':')
+            if name == self.key and self.Peek() == '[':
+                self.at += 1
+                if self.Peek() == ']':
+                    self.at += 1
+                else:
+                    while True:
+                        item = self.Value()
+                        if self.keep is not None and isinstance(item, dict):
+                            item = {k: item[k] for k in self.keep if k in item}
+                        yield item
+                        if self.Expect(',]') == ']':
+                            break
+            else:
+                self.fields[name] = self.Value()
+            if self.Expect(',}') == '}':
+                return
+
+def FileChunks(filename, chunkSize=CHUNK_SIZE):
+    with open(filename, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunkSize)
+            if not chunk:
+                return
+            yield chunk
+
+def SyntheticPage(filename, count):
+    # A get_actions page of count full eosio.token transfers, about 1KB each as Hyperion
+    # answers them, written a piece at a time.
+    random.seed(count)
+    with open(filename, 'w') as fh:
+        fh.write('{"query_time_ms":12.3,"cached":false,"lib":250000000,"total":{"value":%d,"relation":"eq"},"actions":[' % count)
+        for n in range(count):
+            amount = random.choice([0.001, 1.0, 25.5, 1000.0, 500000.0])
+            action = {
+                '@timestamp': "2022-06-01T00:00:%02d.%03d" % (n // 1000 % 60, n % 1000), 'timestamp': "2022-06-01T00:00:00.000",
+                'block_num': 190000000 + n // 10, 'block_id': '%064x' % n, 'trx_id': '%064x' % (n * 7919),
+                'act': {'account': 'eosio.token', 'name': 'transfer',
+                        'authorization': [{'actor': f"acct{n % 997}", 'permission': 'active'}],
+                        'data': {'from': f"acct{n % 997}", 'to': f"acct{n % 991}", 'amount': amount,
+                                 'symbol': 'WAX', 'quantity': f"{amount:.8f} WAX", 'memo': 'x' * random.randint(0, 64)}},
+                'receipts': [{'receiver': r, 'global_sequence': str(5000000000 + n), 'recv_sequence': str(n),
+                              'auth_sequence': [{'account': f"acct{n % 997}", 'sequence': str(n)}]}
+                             for r in ('eosio.token', f"acct{n % 997}", f"acct{n % 991}")],
+                'cpu_usage_us': 150, 'net_usage_words': 16, 'global_sequence': 5000000000 + n, 'producer': 'blokcrafters',
+                'action_ordinal': 1, 'creator_action_ordinal': 0, 'signatures': ['SIG_K1_' + 'k' * 90],
+                'notified': ['eosio.token', f"acct{n % 997}", f"acct{n % 991}"]}
+            fh.write((',' if n else '') + json.dumps(action))
+        fh.write(']}')
+
+def Consume(how, filename):
+    # Decode a page the way the tools did (the whole response, then json.loads) or streamed,
+    # summing the amounts as a stand-in for the work done with each action.
+    started = time.perf_counter()
+    total = 0
+    count = 0
+    if how == 'whole':
+        with open(filename, 'rb') as fh:
+            content = fh.read()
+        for action in json.loads(content)['actions']:
+            total += action['act']['data']['amount']
+            count += 1
+    else:
+        for action in ArrayStream(FileChunks(filename), keep=ACTION_FIELDS):
+            total += action['act']['data']['amount']
+            count += 1
+    seconds = time.perf_counter() - started
+    return {'how': how, 'count': count, 'total': round(total, 3), 'seconds': round(seconds, 3),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def Benchmark(counts):
+    # Each approach runs in a fresh process, so that its peak RSS is its own.
+    print(f"benchmark: {'actions':>8s} {'bytes':>11s} {'how':>6s} {'seconds':>8s} {'actions/s':>10s} {'peak RSS':>10s}")
+    for count in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'page.json')
+            SyntheticPage(filename, count)
+            size = os.path.getsize(filename)
+            results = []
+            for how in ('whole', 'stream'):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--consume', how, filename],
+                                        capture_output=True, text=True, check=True).stdout
+                results.append(json.loads(output))
+            if results[0]['total'] != results[1]['total'] or results[0]['count'] != results[1]['count']:
+                raise ValueError(f"the streamed actions differ: {results}")
+            for r in results:
+                print(f"benchmark: {count:8d} {size:11d} {r['how']:>6s} {r['seconds']:8.2f} {r['count'] / r['seconds']:10.0f} {r['max_rss_kb'] / 1024:8.1f}MB")
+
+# MAIN
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream the items of a JSON array, e.g. a saved get_actions page, as JSON lines.")
+    parser.add_argument("filename", help="The JSON file", nargs='?')
+    parser.add_argument("-k", "--key", help="The member holding the array (default: %(default)s)", default='actions')
+    parser.add_argument("--benchmark", help="Compare decoding synthetic get_actions pages of these many actions whole and streamed",
+                        type=int, nargs='+')
+    parser.add_argument("--consume", help=argparse.SUPPRESS, choices=('whole', 'stream'))
+    args = parser.parse_args()
+
+    if args.benchmark:
+        Benchmark(args.benchmark)
+    elif args.consume:
+        print(json.dumps(Consume(args.consume, args.filename)))
+    elif args.filename:
+        for item in ArrayStream(FileChunks(args.filename), args.key):
+            print(json.dumps(item))
+        sys.stdout.flush()
+    else:
+        parser.error("a filename or --benchmark is required")
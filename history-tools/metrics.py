@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# blokcrafters metrics
+# counters, gauges and histograms rendered in the Prometheus text format
+#
+import bisect
+import http.server
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds, suited to HTTP calls and batch evaluation.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def LabelValue(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def LabelText(labelNames, labelValues, extra=()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{LabelValue(value)}"' for name, value in pairs) + '}'
+
+class Metric:
+    # The values are kept per tuple of label values; updating one is a dict lookup under a lock.
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def Key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelNames)
+
+    def Samples(self):
+        with self.lock:
+            return [(self.name + LabelText(self.labelNames, key), value) for key, value in sorted(self.values.items())]
+
+    def Render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, value in self.Samples():
+            lines.append(f"{name} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def Inc(self, amount=1, **labels):
+        key = self.Key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def Set(self, value, **labels):
+        key = self.Key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.Observe(time.perf_counter() - self.started, **self.labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labelNames)
+        self.buckets = tuple(buckets)
+
+    def Observe(self, value, **labels):
+        key = self.Key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def Time(self, **labels):
+        return Timer(self, labels)
+
+    def Samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in sorted(self.values.items())]
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket' + LabelText(self.labelNames, key, [('le', bound)]), cumulative))
+            samples.append((self.name + '_sum' + LabelText(self.labelNames, key), counts[-1]))
+            samples.append((self.name + '_count' + LabelText(self.labelNames, key), cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def Add(self, metric):
+        # Asking for the same metric twice, e.g. from two modules, gives back the first one.
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def Render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.Render() for metric in metrics) + "\n"
+
+REGISTRY = Registry()
+
+def NewCounter(name, help, labelNames=()):
+    return REGISTRY.Add(Counter(name, help, labelNames))
+
+def NewGauge(name, help, labelNames=()):
+    return REGISTRY.Add(Gauge(name, help, labelNames))
+
+def NewHistogram(name, help, labelNames=(), buckets=BUCKETS):
+    return REGISTRY.Add(Histogram(name, help, labelNames, buckets))
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.Render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def Serve(port, host=''):
+    # Answer Prometheus scrapes on any path from a background thread.
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def WriteTextfile(filename):
+    # For the node_exporter textfile collector; written whole so it is never read half done.
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, 'w') as fh:
+        fh.write(REGISTRY.Render())
+    os.replace(tmpFilename, filename)
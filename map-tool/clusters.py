@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+# blokcrafters map marker clustering
+# the map markers grouped per zoom level, written compact and precompressed only when they change
+#
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import os
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# The zoom levels clusters are made for; past MAX_ZOOM the map shows the markers themselves.
+MIN_ZOOM = 0
+MAX_ZOOM = 10
+# Markers closer together than this many pixels at a zoom level share a cluster.
+CLUSTER_RADIUS = 60
+# Tiles are this many pixels square, as for Google and OpenStreetMap maps.
+TILE_SIZE = 256
+# Web Mercator stops short of the poles.
+MAX_LATITUDE = 85.05112878
+# Decimal places kept for the cluster positions, about 1m.
+COORDINATE_PLACES = 5
+
+def Project(lon, lat):
+  # Web Mercator, scaled to the unit square with the origin top left.
+  lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+  x = (lon + 180) / 360
+  y = 0.5 - math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) / (2 * math.pi)
+  return x, y
+
+def Unproject(x, y):
+  lon = x * 360 - 180
+  lat = math.degrees(2 * math.atan(math.exp((0.5 - y) * 2 * math.pi)) - math.pi / 2)
+  return round(lon, COORDINATE_PLACES), round(lat, COORDINATE_PLACES)
+
+def Points(features):
+  # The markers as [x, y, count, producers, feature]; those without a usable position are left out.
+  points = []
+  for feature in features:
+    try:
+      lon, lat = (float(c) for c in feature['geometry']['coordinates'])
+    except (TypeError, ValueError):
+      continue
+    if not (math.isfinite(lon) and math.isfinite(lat)):
+      continue
+    x, y = Project(lon, lat)
+    points.append([x, y, 1, {feature['properties']['name']}, feature])
+  return points
+
+def Cluster(features, icon, minZoom=MIN_ZOOM, maxZoom=MAX_ZOOM, radius=CLUSTER_RADIUS):
+  # {zoom: [feature, ...]} from the highest zoom down: each level groups the clusters of the
+  # level above by grid cell, weighting their positions by how many markers they hold, so
+  # a marker belongs to exactly one cluster at every level and the levels nest.
+  zooms = {}
+  level = Points(features)
+  for zoom in range(maxZoom, minZoom - 1, -1):
+    cells = TILE_SIZE * 2 ** zoom / radius
+    grouped = {}
+    for point in level:
+      grouped.setdefault((int(point[0] * cells), int(point[1] * cells)), []).append(point)
+    level = []
+    for cell in sorted(grouped):
+      members = grouped[cell]
+      if len(members) == 1:
+        level.append(members[0])
+        continue
+      count = sum(m[2] for m in members)
+      level.append([sum(m[0] * m[2] for m in members) / count, sum(m[1] * m[2] for m in members) / count,
+                    count, set().union(*(m[3] for m in members)), None])
+    zooms[zoom] = [ClusterFeature(point, icon) for point in level]
+  return zooms
+
+def ClusterFeature(point, icon):
+  x, y, count, producers, feature = point
+  if feature is not None:
+    return feature
+  return {'type': 'Feature',
+          'properties': {'cluster': True, 'count': count, 'producers': len(producers), 'icon': icon},
+          'geometry': {'type': 'Point', 'coordinates': list(Unproject(x, y))}}
+
+def Compact(value):
+  return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+def WriteIfChanged(filename, text):
+  # Write text to filename, with .gz and (when brotli is installed) .br copies beside it for
+  # static hosting, unless the file already holds exactly this.  Untouched files keep their
+  # modification times, so caches and ETags stay valid.  Returns whether anything was written.
+  data = text.encode()
+  compressed = {filename + ".gz": lambda: gzip.compress(data, 9, mtime=0)}
+  if brotli is not None:
+    compressed[filename + ".br"] = lambda: brotli.compress(data, quality=11)
+  try:
+    with open(filename, 'rb') as fh:
+      unchanged = hashlib.sha256(fh.read()).digest() == hashlib.sha256(data).digest()
+  except FileNotFoundError:
+    unchanged = False
+  if unchanged and all(os.path.exists(f) for f in compressed):
+    return False
+  for f, content in [(filename, lambda: data)] + list(compressed.items()):
+    with open(f + ".tmp", 'wb') as fh:
+      fh.write(content())
+    os.replace(f + ".tmp", f)
+  return True
+
+# MAIN
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Show how the markers of a map info file written by genpmi.py cluster per zoom level.")
+  parser.add_argument("filename", help="The map info file, e.g. pmi-mainnet-full.js")
+  parser.add_argument("-r", "--radius", help="The cluster radius in pixels (default: %(default)s)", type=int, default=CLUSTER_RADIUS)
+  args = parser.parse_args()
+
+  with open(args.filename) as fh:
+    text = fh.read()
+  features = json.loads(text[text.index('{'):text.rindex('}') + 1])['features']
+  print(f"{len(features)} markers, {len(text.encode())} bytes")
+  for zoom, clustered in sorted(Cluster(features, '', radius=args.radius).items()):
+    data = Compact({'type': 'FeatureCollection', 'features': clustered}).encode()
+    sizes = f"{len(data)} bytes, {len(gzip.compress(data, 9))} gzipped"
+    if brotli is not None:
+      sizes += f", {len(brotli.compress(data, quality=11))} brotli"
+    largest = max((f['properties'].get('count', 1) for f in clustered), default=0)
+    print(f"zoom {zoom:2d}: {len(clustered):5d} features, largest cluster {largest:4d}, {sizes}")
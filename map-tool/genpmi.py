@@ -2,24 +2,73 @@
 
 import iso3166
 import argparse
+import concurrent.futures
 import sys
 import json
 import requests
-import subprocess
 import datetime
-import dateutil.parser
-import mimetypes
+import hashlib
+import signal
+import threading
 import time
+import traceback
 import os
 
-# The maximum age of the producers JSON file in seconds before we attempt to update it.
-PRODUCERS_FILE_MAXAGE = 3600
-# The maximum age of the top21 JSON file in seconds before we attempt to update it.
-TOP21_FILE_MAXAGE = 3600
-# The maximum age of the producerjson-actions JSON file in seconds before we attempt to update it.
-PRODUCERJSON_ACTIONS_FILE_MAXAGE = 3600
-# The maximum age of the urls-last-checked file in seconds before allowing to recheck the bp.json URLs
-URLSLASTCHECKED_FILE_MAXAGE = 3600
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'history-tools'))
+import actionstore
+import hyperion
+import producerjson
+import nodedb
+import nodelife
+import httpcache
+import logos as logocache
+import clusters
+import runreport
+
+# Seconds the producer registry and the top21 are used before the chain is asked again.
+PRODUCERS_TTL = 3600
+# The chains the -m and -t options stand for: their chain API and Hyperion history endpoints.
+CHAINS = [
+  {'name': 'mainnet', 'chain': ["https://wax.blokcrafters.io"], 'history': ["https://wax.blokcrafters.io"]},
+  {'name': 'testnet', 'chain': ["https://wax-test.blokcrafters.io"], 'history': ["https://wax-test.blokcrafters.io"]},
+]
+# How many producers to ask the chain API for on each get_producers page.
+PRODUCERS_PAGE_SIZE = 100
+# The producer registry fields that, when changed, mean the producer's bp.json and logo need another look.
+PRODUCER_DIFF_FIELDS = ('url', 'location', 'is_active')
+# How many producer bp.json URLs are fetched at the same time.
+BPJSON_FETCH_WORKERS = 32
+# Seconds to wait for a producer's host to connect, between bytes, and in total for its bp.json.
+BPJSON_CONNECT_TIMEOUT = 5
+BPJSON_READ_TIMEOUT = 10
+BPJSON_HOST_DEADLINE = 20
+# The largest bp.json accepted, in bytes.
+BPJSON_MAX_SIZE = 1024 * 1024
+# Seconds a producer's bp.json is used without asking its host again, then served while it
+# is revalidated in the background, and how long one that could not be fetched is left.
+BPJSON_TTL = 3600
+BPJSON_STALE = 3600
+BPJSON_NEGATIVE_TTL = 900
+# How many Hyperion health checks are made at the same time.
+HEALTH_PROBE_WORKERS = 32
+# Seconds to wait for an endpoint to connect and then to answer its health check.
+HEALTH_CONNECT_TIMEOUT = 5
+HEALTH_READ_TIMEOUT = 5
+# Seconds a health check result is reused for: answering endpoints, and ones that did not answer.
+HEALTH_CACHE_TTL = 3600
+HEALTH_NEGATIVE_TTL = 900
+# The most the fetched bp.jsons, health checks and producer registries, and the fetched
+# logos, may take on disk.  The chains share both caches.
+HTTP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+LOGO_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Seconds between refreshes of each source in daemon mode, in the order they are refreshed.
+# The bp.jsons and logos are looked at often, but each is only fetched again once its own
+# freshness in the HTTP cache has run out.
+DAEMON_SCHEDULE = {'producers': PRODUCERS_TTL, 'actions': 600, 'bpjsons': 300, 'health': 300}
+# The sources that are refreshed at once when the result of another one changes.
+DAEMON_DEPENDENTS = {'producers': ['bpjsons'], 'actions': ['bpjsons'], 'bpjsons': ['health']}
+# Seconds before a source that failed in daemon mode is tried again.
+DAEMON_RETRY = 60
 
 def dirExists(filename):
   return os.path.exists(filename) and os.path.isdir(filename)
@@ -27,301 +76,264 @@ def dirExists(filename):
 def fileExists(filename):
   return os.path.exists(filename) and os.path.isfile(filename)
 
-def fileOlderThan(filename, maxAge):
-  return (not fileExists(filename)) or (int(os.path.getmtime(filename)) < (int(datetime.datetime.utcnow().timestamp()) - maxAge))
-
-def UpdateProducers(chainURL, producersFilename, top21Filename):
-  print(f"system: fetching the producers from {chainURL} ...", file=log)
-  numToGet = 50
+def ProducersDiff(old, new):
+  # What changed in the producer registry since it was last saved.
+  diff = {'added': sorted(set(new) - set(old)), 'removed': sorted(set(old) - set(new)), 'changed': {}}
+  for p in sorted(set(old) & set(new)):
+    fields = [field for field in PRODUCER_DIFF_FIELDS if old[p].get(field) != new[p].get(field)]
+    if fields:
+      diff['changed'][p] = fields
+  return diff
+
+def FetchProducers(chain):
+  print(f"system: fetching the producers from {chain.chainClient.historyURL} ...", file=chain.log)
+  registry = {}
   start = ''
-  inactives = {}
-  producers = {}
   top21 = []
 
   while True:
-    info = subprocess.run(['cleos', '--url', chainURL, 'system', 'listproducers', '--json',
-                          '--limit', str(numToGet), '--lower', start], stdout=subprocess.PIPE)
-    someProducers = json.loads(info.stdout)
+    someProducers = chain.chainClient.GetProducers(start, PRODUCERS_PAGE_SIZE)
     for i in someProducers['rows']:
-      p = i['owner']
-      if i['is_active'] == 1:
-        producers[p] = i
-      else:
-        inactives[p] = i
-      print(f"system: producer {len(producers) + len(inactives)}: {p}", file=log)
+      registry[i['owner']] = i
     start = someProducers['more']
     if len(start) <= 0:
       break
 
-  print(f"system: ... done.", file=log)
-  print(f"system: producers: {len(producers)} active and {len(inactives)} inactive", file=log)
+  print(f"system: ... done.", file=chain.log)
 
   # Get the Top21 producers
-  info = subprocess.run(['cleos', '--url', chainURL, 'get', 'schedule', '--json'], stdout=subprocess.PIPE)
-  someJSON = json.loads(info.stdout)
+  someJSON = chain.chainClient.GetProducerSchedule()
   for p in someJSON['active']['producers']:
     top21.append(p['producer_name'])
-  print(f"system: top21 producers: {len(top21)}", file=log)
+  return {'registry': registry, 'top21': top21}
+
+def UpdateProducers(chain, registry, top21):
+  producers = {p: i for p, i in registry.items() if i['is_active'] == 1}
+  print(f"system: producers: {len(producers)} active and {len(registry) - len(producers)} inactive", file=chain.log)
+  print(f"system: top21 producers: {len(top21)}", file=chain.log)
+
+  old = {}
+  if fileExists(ProducersFilename(chain)):
+    with open(ProducersFilename(chain)) as fh:
+      old = json.load(fh)
+  diff = ProducersDiff(old, registry)
+  print(f"system: producers: {len(diff['added'])} added, {len(diff['removed'])} removed, {len(diff['changed'])} changed", file=chain.log)
+  for p in diff['added']:
+    print(f"{p}: + added to the producer registry", file=chain.log)
+  for p in diff['removed']:
+    print(f"{p}: + removed from the producer registry", file=chain.log)
+  for p, fields in diff['changed'].items():
+    print(f"{p}: + changed {fields} in the producer registry", file=chain.log)
+
+  # The whole registry is kept, inactive producers included, so that they can be
+  # diffed against next time.
+  for filename, data in ((ProducersFilename(chain), registry), (Top21Filename(chain), top21), (ProducersDiffFilename(chain), diff)):
+    with open(filename + ".tmp", 'w') as f:
+      json.dump(data, f, indent=2)
+    os.replace(filename + ".tmp", filename)
+  return producers, diff
+
+def GetProducers(chain, force=False):
+  # The active producers and the top21 from the cache while they are fresh, with no
+  # changes; otherwise from the chain with what changed since the last sync.
+  fetched, result = httpCache.Remember(f"{chain.name}:producers", PRODUCERS_TTL, lambda: FetchProducers(chain), force)
+  top21 = fetched['top21']
+  if result == 'updated':
+    producers, diff = UpdateProducers(chain, fetched['registry'], top21)
+  else:
+    producers = {p: i for p, i in fetched['registry'].items() if i['is_active'] == 1}
+    diff = {'added': [], 'removed': [], 'changed': {}}
+  return top21, producers, diff
 
-  f = open(top21Filename, 'w')
-  json.dump(top21, f, indent=2)
-  f.close()
-  return top21, producers
+def ChangedProducers(diff):
+  # The producers whose bp.json and logo need another look because of a registry change.
+  return set(diff['added']) | set(diff['changed'])
 
-def GetProducers(chainURL, producersFilename, top21Filename, force=False):
-  producers = {}
-  top21 = []
-  if force or fileOlderThan(producersFilename, PRODUCERS_FILE_MAXAGE) or fileOlderThan(top21Filename, TOP21_FILE_MAXAGE):
-    top21, producers = UpdateProducers(chainURL, producersFilename, top21Filename)
-  else:
-    with open(producersFilename) as fh:
-      producers = json.load(fh)
-    with open(top21Filename) as fh:
-      top21 = json.load(fh)
-  return top21, producers
-
-def ProducerBPJSONFilename(s, p=''):
-  name = ''
-  if s == 'url':
-    name = "{net}-jsons/{source}/{producer}-bp.json".format(net="mainnet" if args.mainnet else "testnet", source=s, producer=p)
-  elif s == 'chain':
-    name = "{net}-jsons/producerjson-actions.json".format(net="mainnet" if args.mainnet else "testnet")
-  return name
-
-def URLSLastCheckedFilename():
-  return "{net}-jsons/urls-last-checked".format(net="mainnet" if args.mainnet else "testnet")
-
-def ProducerLogoFilename(p):
-  return "{net}-logos/{producer}-logo_256".format(producer=p, net="mainnet" if args.mainnet else "testnet")
-
-def ProducerBPJSONURL(p):
+def ProducersFilename(chain):
+  return "{net}-jsons/producers.json".format(net=chain.name)
+
+def Top21Filename(chain):
+  return "{net}-jsons/top21.json".format(net=chain.name)
+
+def ActionStoreDirectory(chain):
+  return "{net}-jsons/actions".format(net=chain.name)
+
+def ProducersDiffFilename(chain):
+  return "{net}-jsons/producers-diff.json".format(net=chain.name)
+
+def BPJSONOutcomesFilename(chain):
+  return "{net}-jsons/url-fetch-outcomes.json".format(net=chain.name)
+
+def HTTPCacheDirectory():
+  return "http-cache/jsons"
+
+def LogosHTTPCacheDirectory():
+  return "http-cache/logos"
+
+def MapClustersDirectory(chain):
+  return "pmi-{net}-clusters".format(net=chain.name)
+
+def LogosDirectory(chain):
+  return "{net}-logos".format(net=chain.name)
+
+def ProducerBPJSONURL(chain, p):
   url = ''
-  producer = producers[p]
+  producer = chain.producers[p]
   if len(producer['url']):
     url = f"{producer['url']}/bp.json"
   return url
 
-def UpdateBPJSON(historyURL, source, p, force=False):
+def UpdateBPJSON(chain, source, p, outcome=None):
   failReasons = []
   zeroActions = False
   bpjson = {}
-  producer = producers[p]
   if source == 'url':
-    url = ProducerBPJSONURL(p)
-    if len(url):
-      filename = ProducerBPJSONFilename(source, p)
-      if force:
-        print(f"{p}: Force is True - removing the producer's cached url bp.json file - {filename}", file=log)
-        try:
-          os.remove(filename)
-        except FileNotFoundError:
-          pass
-      # Only check the URL for a new bp.json file when:
-      #  - we do not have a url file
-      #  - the age of the urls-last-checked file is too old
-      if fileOlderThan(URLSLastCheckedFilename(), URLSLASTCHECKED_FILE_MAXAGE):
-        print(f"{p}: updating the {source} bp.json cache file from {url} ... ", end='', file=log)
-        info = subprocess.run(['curl', '-RLSsf', '--connect-timeout', '5', '-z', filename, '-o', filename, url],
-                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        if info.returncode != 0:
-          failReasons.append(f"{p}: FAIL: {url}: curl return code {info.returncode}: {info.stdout.decode('utf-8').rstrip()}")
-          print(f"{p}: failed", file=log)
-        else:
-          print(f"{p}: success", file=log)
-      if fileExists(filename):
-        with open(filename) as fh:
-          try:
-            bpjson = json.load(fh)
-          except json.decoder.JSONDecodeError:
-            failReasons.append(f"{p}: {source} bp.json cache file could not be decoded as JSON")
-  elif source == 'chain':
-    filename = ProducerBPJSONFilename(source, p)
-    theActions = {}
-    # Force is handled before getting here for source == chain
-    if  fileOlderThan(filename, PRODUCERJSON_ACTIONS_FILE_MAXAGE):
-      print(f"{p}: updating the {source} producerjson-actions.json cache file from {historyURL} ... ", end='', file=log)
-      gaURL = historyURL + "/v2/history/get_actions?act.account=producerjson&limit=1000"
-      info = subprocess.run(['curl', '-LSsf', '--connect-timeout', '5',
-                            '-H', 'accept: application/json', '-H', 'Content-Type: application/json', gaURL], stdout=subprocess.PIPE)
-      if info.returncode != 0:
-        failReasons.append(f"FAIL: {gaURL}: curl return code {info.returncode}: {info.stdout.decode('utf-8').rstrip()}")
-        print(f"{p}: failed", file=log)
+    # The bp.json is got for every producer at once by RefreshBPJSONs; one that could not
+    # be fetched this time is still read from the body held from before.
+    content = httpCache.Content(outcome['sha256']) if outcome else None
+    if content is not None:
+      try:
+        bpjson = json.loads(content)
+      except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+        failReasons.append(f"{p}: {source} bp.json cache file could not be decoded as JSON")
       else:
-        with open(filename, 'wb') as fh:
-          fh.write(info.stdout)
-        theActions = json.loads(info.stdout)
-        print(f"{p}: success", file=log)
-    else:
-      with open(filename) as fh:
-        theActions = json.load(fh)
-
-    # Gather all the specific producer jsons from the actions into prodJSONs
-    prodJSONs = {}
-    if 'actions' in theActions:
-      for action in theActions['actions']:
-        if p != action['act']['data']['owner']:
-          continue
-        # Verify the action name
-        if not action['act']['name'] in ('set', 'del'):
-          failReasons.append(f"{p}: + unknown action name ({action['act']['name']}) is present")
-          continue
-        dt = dateutil.parser.parse(action['@timestamp'])
-        timestamp = time.mktime(dt.timetuple()) + dt.microsecond / 1000000
-        tsJSON = {}
-        tsJSON['name'] = action['act']['name']
-        tsJSONData = ''
-        if tsJSON['name'] == 'set':
-          tsJSONData = action['act']['data']['json']
-          try:
-            tsJSON['data'] = json.loads(tsJSONData)
-            prodJSONs[timestamp] = tsJSON
-          except json.decoder.JSONDecodeError:
-            failReasons.append(f"{p}: chain producerjson action data @{action['@timestamp']} could not be decoded as JSON")
-        elif tsJSON['name'] == 'del':
-          prodJSONs[timestamp] = tsJSON
-    print(f"{p}: {len(prodJSONs)} producjerjson actions on the chain", file=log)
-    if len(prodJSONs):
-      for ts, action in sorted(prodJSONs.items(), reverse=True):
-        if action['name'] == 'del':
-          # The newest action done was a delete - they are not on the chain.
+        if not isinstance(bpjson, dict):
+          failReasons.append(f"{p}: {source} bp.json cache file is not a JSON object")
           bpjson = {}
-        elif action['name'] == 'set':
-          # This is the newest set action.
-          bpjson = action['data']
-        break
+  elif source == 'chain':
+    # The producerjson index has every action decoded and grouped by owner already.
+    for problem in chain.producerJSON.Problems(p):
+      failReasons.append(f"{p}: + {problem}")
+    ownerActions = chain.producerJSON.OwnerActions(p)
+    print(f"{p}: {len(ownerActions)} producjerjson actions on the chain", file=chain.log)
+    if len(ownerActions):
+      # The newest set action's bp.json, or nothing when the newest action was a delete.
+      bpjson = chain.producerJSON.Latest(p)
     elif len(failReasons) == 0:
       zeroActions = True
 
   if len(bpjson) == 0:
     if source == 'url':
-      print(f"{p}: failed to retrieve url bp.json for the cache", file=log)
+      print(f"{p}: failed to retrieve url bp.json for the cache", file=chain.log)
     elif source == 'chain':
       if len(failReasons) > 0:
-        print(f"{p}: failed to retrieve chain bp.json data for the cache", file=log)
+        print(f"{p}: failed to retrieve chain bp.json data for the cache", file=chain.log)
         if zeroActions:
           failReasons.append(f"There are no producerjson action entries on the chain.")
     for reason in failReasons:
-      print(f"{p}: + {reason}", file=log)
+      print(f"{p}: + {reason}", file=chain.log)
   return bpjson
 
-def GetBPJSONs(historyURL, producers, force=False):
+def RefreshBPJSONs(chain, producers, force=False, revalidate=()):
+  # Get every producer's url bp.json through the HTTP cache concurrently, so the hosts
+  # are only asked once each bp.json's own freshness has run out (or at once for the
+  # producers in revalidate), and record how each went in the outcomes file.
+  print(f"system: getting {len(producers)} url bp.json files with {BPJSON_FETCH_WORKERS} workers ...", file=chain.log)
+  outcomes = {}
+  started = time.monotonic()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=BPJSON_FETCH_WORKERS) as executor:
+    futures = {}
+    for p in producers:
+      url = ProducerBPJSONURL(chain, p)
+      if not len(url):
+        outcomes[p] = {'url': url, 'result': 'no_url', 'ok': False, 'sha256': None}
+        continue
+      futures[executor.submit(httpCache.Get, url, BPJSON_TTL, BPJSON_STALE, BPJSON_NEGATIVE_TTL, force,
+                              timeout=(BPJSON_CONNECT_TIMEOUT, BPJSON_READ_TIMEOUT), maxSize=BPJSON_MAX_SIZE,
+                              deadline=BPJSON_HOST_DEADLINE, revalidate=p in revalidate)] = p
+    for future in concurrent.futures.as_completed(futures):
+      p = futures[future]
+      outcome = outcomes[p] = future.result()
+      if not outcome['ok']:
+        print(f"{p}: FAIL: {outcome['url']}: {outcome['error']} ({outcome['result']}, {outcome['seconds']}s)", file=chain.log)
+      elif outcome['result'] not in ('hit', 'stale'):
+        print(f"{p}: {outcome['result']}: {outcome['url']} ({outcome['seconds']}s)", file=chain.log)
+  counts = {}
+  for outcome in outcomes.values():
+    counts[outcome['result']] = counts.get(outcome['result'], 0) + 1
+  print(f"system: ... done in {time.monotonic() - started:.1f}s: {counts}", file=chain.log)
+  with open(BPJSONOutcomesFilename(chain) + ".tmp", 'w') as fh:
+    json.dump(outcomes, fh, indent=2, sort_keys=True)
+  os.replace(BPJSONOutcomesFilename(chain) + ".tmp", BPJSONOutcomesFilename(chain))
+  return outcomes
+
+def SyncProducerJSONActions(chain):
+  # Bring the store's producerjson feed up to date: the whole history the first time,
+  # then only the actions newer than its cursor.
+  print(f"system: syncing the producerjson actions from {chain.historyClient.historyURL} ...", file=chain.log)
+  try:
+    added = chain.store.Sync(chain.historyClient, 'producerjson', {'act.account': 'producerjson'}, start='genesis')
+  except (requests.RequestException, ValueError) as e:
+    print(f"system: FAIL: producerjson actions sync: {e} - carrying on with the actions already stored", file=chain.log)
+    return
+  print(f"system: ... {added} new producerjson actions", file=chain.log)
+
+def GetBPJSONs(chain, producers, force=False, changed=()):
+  # Returns the bp.jsons and the producers whose url bp.json was updated.  The producers
+  # changed in the registry have their bp.json revalidated whether or not it is fresh.
   bpjsons = {}
-  if force or fileOlderThan(URLSLastCheckedFilename(), URLSLASTCHECKED_FILE_MAXAGE):
-    try:
-      os.remove(URLSLastCheckedFilename())
-    except FileNotFoundError:
-      pass
+  updated = set()
   for source in ['chain', 'url']:
     bpjsons[source] = {}
+    outcomes = {}
+    if source == 'url':
+      outcomes = RefreshBPJSONs(chain, producers, force, changed)
+    updated |= set(p for p, outcome in outcomes.items() if outcome['result'] == 'updated')
     for p in producers:
       if source == 'url':
-        bpjson = UpdateBPJSON(historyURL, source, p, force)
+        bpjson = UpdateBPJSON(chain, source, p, outcomes.get(p))
       elif source == 'chain':
-        bpjson = UpdateBPJSON(historyURL, source, p, force)
-        if not dirExists('{net}-jsons/chain'.format(net="mainnet" if args.mainnet else "testnet")):
-          os.mkdir('{net}-jsons/chain'.format(net="mainnet" if args.mainnet else "testnet"))
-        f = open("{net}-jsons/chain/{producer}-bp.json".format(net="mainnet" if args.mainnet else "testnet", producer=p), 'w')
-        json.dump(bpjson, f, indent=2)
-        f.close()
+        bpjson = UpdateBPJSON(chain, source, p)
+        if not dirExists('{net}-jsons/chain'.format(net=chain.name)):
+          os.mkdir('{net}-jsons/chain'.format(net=chain.name))
+        chainFilename = "{net}-jsons/chain/{producer}-bp.json".format(net=chain.name, producer=p)
+        with open(chainFilename + ".tmp", 'w') as f:
+          json.dump(bpjson, f, indent=2)
+        os.replace(chainFilename + ".tmp", chainFilename)
       if bpjson:
         bpjsons[source][p] = bpjson
-  if source == 'url' and (not fileExists(URLSLastCheckedFilename())):
-    os.mknod(URLSLastCheckedFilename())
-  return bpjsons
+  return bpjsons, updated
 
-def UpdateLogo(source, p, force):
-  logo = {}
-  bpjson = bpjsons[source][p]
+def LogoURL(chain, p, bpjson):
+  url = ''
   if 'org' in bpjson:
     if 'branding' in bpjson['org']:
       if 'logo_256' in bpjson['org']['branding']:
         url = bpjson['org']['branding']['logo_256']
-        if len(url):
-          ext = requests.utils.urlparse(url).path.split('.')[-1]
-          filename = ProducerLogoFilename(p)
-          logoFile = f"{filename}.{ext}"
-          if force:
-            print(f"{p}: Force is True - removing the producer's cached url logo file - {logoFile}", file=log)
-            try:
-              os.remove(logoFile)
-            except FileNotFoundError:
-              pass
-            updateLogoFile = True
-          else:
-            updateLogoFile = False
-            urlTime = ''
-            try:
-              fileMTime = datetime.datetime.utcfromtimestamp(os.path.getmtime(logoFile))
-              r = requests.head(url, timeout=5, allow_redirects=True)
-              if 'Last-Modified' in r.headers:
-                urlTime = r.headers['Last-Modified']
-                urlDate = dateutil.parser.parse(urlTime, ignoretz=True)
-                if urlDate > fileMTime:
-                  updateLogoFile = True
-                  print(f"{p}: the producers logo file is newer than the cache file", file=log)
-              else:
-                print(f"{p}: could not retrieve a Last-Modified value for the producer logo file", file=log)
-                updateLogoFile = True
-            except FileNotFoundError:
-              print(f"{p}: url bp.json cache file ({logoFile}) is missing", file=log)
-              updateLogoFile = True
-            except requests.ConnectionError as e:
-              print(f"{p}: url bp.json cache file ({logoFile}): ConnectionError exception: {e}", file=log)
-              updateLogoFile = True
-            except requests.exceptions.ReadTimeout as e:
-              print(f"{p}: url bp.json cache file ({logoFile}): ReadTimeoutError exception: {e}", file=log)
-              updateLogoFile = True
-
-          if updateLogoFile:
-            print(f"{p}: updating logo cache file ({logoFile}) from {url}", file=log)
-            try:
-              r = requests.get(url, None, timeout=5)
-            except:
-              print(f"{p}: Unexpected error retrieving url={url}", file=log)
-              return logo
-            if 'Last-Modified' in r.headers:
-              urlTime = r.headers['Last-Modified']
-            else:
-              urlTime = ''
-            ct = r.headers['Content-Type']
-            ext = mimetypes.guess_extension(ct)
-            # I prefer to use jpg extension rather than jpe.  Which is what mimetimes normally returns.
-            if ext == ".jpe":
-              ext = ".jpg"
-            # ext here has a dot already in it.
-            logoFile = f"{filename}{ext}"
-            with open(logoFile, 'wb') as fh:
-              fh.write(r.content)
-            if len(urlTime) > 0:
-              modTime = dateutil.parser.parse(urlTime)
-              os.utime(logoFile, (int(time.time()), time.mktime(modTime.timetuple())))
-              # All good.
-              logo = logoFile
-        else:
-          print(f"{p}: the org.branding.logo_256 url is empty in org.branding", file=log)
+        if not len(url):
+          print(f"{p}: the org.branding.logo_256 url is empty in org.branding", file=chain.log)
       else:
-        print(f"{p}: org.branding.logo_256 is missing from the url bp.json cache", file=log)
+        print(f"{p}: org.branding.logo_256 is missing from the url bp.json cache", file=chain.log)
     else:
-      print(f"{p}: org.branding is missing from the url bp.json cache", file=log)
+      print(f"{p}: org.branding is missing from the url bp.json cache", file=chain.log)
   else:
-    print(f"{p}: org is missing from the url bp.json cache", file=log)
-
-  return logo
+    print(f"{p}: org is missing from the url bp.json cache", file=chain.log)
+  return url
 
-def GetLogos(source, producers, bpjsons, force=False):
-  logos = {}
+def GetLogos(chain, source, producers, bpjsons, force=False, revalidate=()):
+  # The producers in revalidate have their logo revalidated whether or not it is fresh.
+  urls = {}
   for p in producers:
     if p in bpjsons[source]:
-      logo = UpdateLogo(source, p, force)
-      if logo:
-        logos[p] = logo
+      url = LogoURL(chain, p, bpjsons[source][p])
+      if len(url):
+        urls[p] = url
+  print(f"system: revalidating the logos ...", file=chain.log)
+  started = time.monotonic()
+  logos, outcomes = chain.logoCache.Update(urls, force, revalidate)
+  for p, outcome in sorted(outcomes.items()):
+    if not outcome['ok']:
+      print(f"{p}: FAIL: logo {outcome['url']}: {outcome['error']}", file=chain.log)
+    elif outcome['result'] not in ('hit', 'stale'):
+      print(f"{p}: logo {outcome['result']}: {outcome['url']}", file=chain.log)
+  print(f"system: ... {len(outcomes)} logos got in {time.monotonic() - started:.1f}s, {len(set(logos.values()))} distinct images", file=chain.log)
   return logos
 
-def VerifyProducers(producers):
+def VerifyProducers(chain, producers):
   for p in producers:
     producer = producers[p]
     if len(producer['url']) == 0:
-      print(f"{p}: NOTE: the url field is empty.", file=log)
+      print(f"{p}: NOTE: the url field is empty.", file=chain.log)
 
 # Does nothing at the moment.
 def VerifyBPJSONs(bpjsons):
@@ -329,8 +341,8 @@ def VerifyBPJSONs(bpjsons):
     bpjson = bpjsons['url'][p]
 
 # CHECK
-def CheckConsistency(producers, bpjsons, logos):
-  print(f"system: + {len(producers)} producers", file=log)
+def CheckConsistency(chain, producers, bpjsons, logos):
+  print(f"system: + {len(producers)} producers", file=chain.log)
   regen = False
   for p in producers:
     producer = producers[p]
@@ -343,17 +355,17 @@ def CheckConsistency(producers, bpjsons, logos):
     else:
       if not (str(producer['location']).zfill(3) in iso3166.countries_by_numeric):
         display = True
-        print(f"system: + WARN: producer {p} has an invalid value {producer['location']} for a country code (see ISO3166)", file=log)
+        print(f"system: + WARN: producer {p} has an invalid value {producer['location']} for a country code (see ISO3166)", file=chain.log)
     if len(missing):
       display = True
-      print(f"system: + WARN: producer {p} does not have a setting for {missing}", file=log)
+      print(f"system: + WARN: producer {p} does not have a setting for {missing}", file=chain.log)
     if display:
-      print(f"system: + + producer = {producer}", file=log)
+      print(f"system: + + producer = {producer}", file=chain.log)
   if regen:
-    print(f"system: + CRIT:   You need to regenerate the producer cache with the -p option", file=log)
+    print(f"system: + CRIT:   You need to regenerate the producer cache with the -p option", file=chain.log)
 
   for source in ['url', 'chain']:
-    print(f"system: + {len(bpjsons[source])} {source} bp.json cache files", file=log)
+    print(f"system: + {len(bpjsons[source])} {source} bp.json cache files", file=chain.log)
     for b in bpjsons[source]:
       regen = False
       bpjson = bpjsons[source][b]
@@ -362,22 +374,22 @@ def CheckConsistency(producers, bpjsons, logos):
         if 'latitude' in node['location']: 
           lat = node['location']['latitude']
         else:
-          print(f"system: + WARN: producer {p} does not have a latitude for location {node['location']}", file=log)
+          print(f"system: + WARN: producer {p} does not have a latitude for location {node['location']}", file=chain.log)
           regen = True
         if 'longitude' in node['location']: 
           lon = node['location']['longitude']
         else:
-          print(f"system: + WARN: producer {p} does not have a longitude for location {node['location']}", file=log)
+          print(f"system: + WARN: producer {p} does not have a longitude for location {node['location']}", file=chain.log)
           regen = True
       if regen:
-        print(f"system: + CRIT:   You need to regenerate {source} bp.json cache files with the -b option", file=log)
+        print(f"system: + CRIT:   You need to regenerate {source} bp.json cache files with the -b option", file=chain.log)
 
-  print(f"system: + {len(bpjsons['url'])} logo cache files", file=log)
+  print(f"system: + {len(bpjsons['url'])} logo cache files", file=chain.log)
   regen = False
   for l in logos:
     logo = logos[l]
   if regen:
-    print(f"system: + CRIT:   You need to regenerate the logo cache files with the -l option", file=log)
+    print(f"system: + CRIT:   You need to regenerate the logo cache files with the -l option", file=chain.log)
 
 def GetNodeTypes(bpjson, nodeType):
   nodes = []
@@ -387,15 +399,17 @@ def GetNodeTypes(bpjson, nodeType):
     nodes.append(node)
   return nodes
 
-def NodesToFeatures(nodes, icon, producer):
+def NodesToFeatures(chain, nodes, icon, producer, extra=None):
   features = []
   for node in nodes:
     properties = {}
-    if producer in top21:
+    if producer in chain.top21:
       properties['icon'] = icon[0]
     else:
       properties['icon'] = icon[1]
     properties['name'] = producer
+    if extra:
+      properties.update(extra)
     feature = {}
     feature['type'] = 'Feature'
     feature['properties'] = properties
@@ -410,7 +424,49 @@ def NodesToFeatures(nodes, icon, producer):
     features.append(feature)
   return features
 
-def GenerateMapInfo(producers, bpjsons, logos):
+def ProbeHealth(endpoint, ttl=HEALTH_CACHE_TTL):
+  # One Hyperion health check through the HTTP cache, which reuses a result while it is
+  # fresh and remembers the endpoints that did not answer for a shorter time, so dead hosts
+  # do not cost a timeout on every run.  Any 200 answer counts: the node may not be
+  # healthy, but Hyperion is there.
+  outcome = httpCache.Get(endpoint + "/v2/health", ttl, 0, min(ttl, HEALTH_NEGATIVE_TTL),
+                          headers={'accept': 'application/json'}, timeout=(HEALTH_CONNECT_TIMEOUT, HEALTH_READ_TIMEOUT))
+  result = {'checked': outcome['fetched'], 'ok': outcome['ok'], 'latency_ms': round(outcome['seconds'] * 1000), 'cached': outcome['result'] == 'hit'}
+  if result['ok']:
+    try:
+      result['version'] = json.loads(httpCache.Content(outcome['sha256'])).get('version', '')
+    except (TypeError, ValueError, AttributeError):
+      result['version'] = ''
+  else:
+    result['error'] = outcome['error']
+  return result
+
+def ProbeHealthAll(chain, endpoints, ttl=HEALTH_CACHE_TTL):
+  # Health check every endpoint concurrently, reusing results younger than ttl seconds.
+  endpoints = sorted(set(endpoints))
+  print(f"system: health checking {len(endpoints)} endpoints ...", file=chain.log)
+  started = time.monotonic()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=HEALTH_PROBE_WORKERS) as executor:
+    health = dict(zip(endpoints, executor.map(lambda e: ProbeHealth(e, ttl), endpoints)))
+  cached = sum(1 for result in health.values() if result['cached'])
+  print(f"system: ... done in {time.monotonic() - started:.1f}s, {cached} from the cache", file=chain.log)
+  return health
+
+def HealthState(health):
+  # What the daemon compares between health checks: whether each endpoint is up and its
+  # version.  The check time and latency change on every probe and would regenerate the
+  # map info every time.
+  return {endpoint: (result['ok'], result.get('version')) for endpoint, result in health.items()}
+
+def HealthEndpoints(bpjsons):
+  # Every full node's endpoints, to be health checked all at once.
+  endpoints = []
+  for p in bpjsons['chain']:
+    for node in GetNodeTypes(bpjsons['chain'][p], 'full'):
+      endpoints.extend(e for e in (node.get('api_endpoint'), node.get('ssl_endpoint')) if e)
+  return endpoints
+
+def GenerateMapInfo(chain, producers, bpjsons, logos, health):
   # The first icon for the type is for TOP21, the second is for Standby's.
   # A Hyperion node is a special case of a Full node answering a Hyperion health check.
   iconMap = {
@@ -431,191 +487,291 @@ def GenerateMapInfo(producers, bpjsons, logos):
     for nt in nodeTypes:
       nodes = GetNodeTypes(bpjson, nt)
       if len(nodes):
-        features[nt].extend(NodesToFeatures(nodes, iconMap[nt], p))
+        features[nt].extend(NodesToFeatures(chain, nodes, iconMap[nt], p))
       # Special case for full/hyperion:
       if nt == 'full':
         # All the full nodes are now in nodes, for each of them
-        # check to see if the endpoint answers a Hyperion health check and if it does then create
+        # check to see if the endpoint answered a Hyperion health check and if it did then create
         # a feature of hyperion for it.
         for node in nodes:
           # Check the api_endpoint first then the ssl_endpoint if the api_endpoint fails
-          for endpoint in (node['api_endpoint'], node['ssl_endpoint']):
-            hcURL = endpoint + "/v2/health"
-            info = subprocess.run(['curl', '-LSsf', '--connect-timeout', '5',
-              '-H', 'accept: application/json', '-H', 'Content-Type: application/json', hcURL],
-              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            if info.returncode == 0:
-              # It answers Hyperion calls.  It's maybe not healthy, but Hyperion is there.
-              features['hyperion'].extend(NodesToFeatures([node], iconMap['hyperion'], p))
+          for endpoint in (node.get('api_endpoint'), node.get('ssl_endpoint')):
+            if endpoint and health.get(endpoint, {}).get('ok'):
+              extra = {'latency_ms': health[endpoint]['latency_ms'], 'hyperion_version': health[endpoint]['version']}
+              features['hyperion'].extend(NodesToFeatures(chain, [node], iconMap['hyperion'], p, extra))
               break
 
+  # The markers themselves, and per zoom level their clusters for the TOP21 and the
+  # Standby's apart, so the page only loads what it shows.  Only changed files are rewritten.
+  clustersDirectory = MapClustersDirectory(chain)
+  os.makedirs(clustersDirectory, exist_ok=True)
+  written = unchanged = 0
   for nt in nodeTypes:
     mapInfo = {}
     mapInfo['type'] = 'FeatureCollection'
     mapInfo['features'] = features[nt]
-    f = open("pmi-{net}-{nodeType}.js".format(net="mainnet" if args.mainnet else "testnet", nodeType=nt), 'w')
-    print(f"var {nt}Nodes =", file=f)
-    json.dump(mapInfo, f, indent=2)
-    print(";", file=f)
-    f.close()
-    print(f"system: generated {len(features[nt])} {nt} map markers", file=log)
+    filenames = {"pmi-{net}-{nodeType}.js".format(net=chain.name, nodeType=nt):
+                 f"var {nt}Nodes =\n{clusters.Compact(mapInfo)}\n;\n"}
+    for tier, icon in (('top21', iconMap[nt][0]), ('standby', iconMap[nt][1])):
+      tierFeatures = [f for f in features[nt] if (f['properties']['name'] in chain.top21) == (tier == 'top21')]
+      for zoom, clustered in clusters.Cluster(tierFeatures, icon).items():
+        filenames[os.path.join(clustersDirectory, f"{nt}-{tier}-{zoom}.json")] = clusters.Compact({'type': 'FeatureCollection', 'features': clustered})
+    for filename, text in filenames.items():
+      if clusters.WriteIfChanged(filename, text):
+        written += 1
+      else:
+        unchanged += 1
+    print(f"system: generated {len(features[nt])} {nt} map markers", file=chain.log)
+  print(f"system: {written} map files written, {unchanged} unchanged", file=chain.log)
 
   return
 
-def FilterNodeActionsByProducer(nodeActions, producer):
-  fna = {}
-  for ts in nodeActions:
-    na = nodeActions[ts]
-#    print(f'XXXXXXXXXX na={na}', file=log)
-    if 'producer_account_name' in na['data']:
-#      print(f"system: na['data'] HAS producer_account_name", file=log)
-      if na['data']['producer_account_name'] == producer:
-        fna[ts] = na
-    else:
-#      print(f"system: na['data'] is missing producer_account_name", file=log)
-      if 'json' in na['data']:
-        na_data_json = json.loads(na['data']['json'])
-        if 'producer_account_name' in na_data_json:
-#          print(f"system: na['data'] BUT HAS producer_account_name in json", file=log)
-          if na_data_json['producer_account_name'] == producer:
-            fna[ts] = na
-  return fna
-
-def GenerateNodeInfoTables():
+def GenerateNodeInfoTables(chain):
   nodeTypes = ['full', 'hyperion', 'producer', 'seed']
-  JSONActions = {}
-  nodeActions = {}
-  filename = ProducerBPJSONFilename('chain')
-  with open(filename) as fh:
-    JSONActions = json.load(fh)
-  for action in JSONActions['actions']:
-    dt = dateutil.parser.parse(action['@timestamp'])
-    timestamp = time.mktime(dt.timetuple()) + dt.microsecond / 1000000
-    tsJSON = {}
-    tsJSON['action'] = action['act']['name']
-    tsJSONData = ''
-    if tsJSON['action'] == 'set':
-      tsJSONData = action['act']['data']['json']
-      try:
-        tsJSON['data'] = json.loads(tsJSONData)
-        nodeActions[timestamp] = tsJSON
-      except json.decoder.JSONDecodeError:
-        actor = action['act']['authorization'][0]['actor']
-        print(f"system: chain producerjson action data @{action['@timestamp']} could not be decoded as JSON, actor={actor}", file=log)
-    elif tsJSON['action'] == 'del':
-      tsJSON['data'] = {'producer_account_name': action['act']['data']['owner']}
-      nodeActions[timestamp] = tsJSON
-    else:
-      print(f"system: found an unknown action on the producerjson actions: {tsJSON['name']}", file=log)
-  print(f"system: There are {len(nodeActions)} producerjson actions on the chain", file=log)
-  countries = set()
-  producerNodes = {}
-  for p in producers:
-    producerActions = {}
-    for ts, action in sorted(FilterNodeActionsByProducer(nodeActions, p).items()):
-      producerActions[ts] = action
-    if len(producerActions): print(f"{p}: {len(producerActions)} node actions", file=log)
-    producerNodes[p] = []
-    for ts in producerActions:
-      na = producerActions[ts]
-      action = na['action']
-      unknownNodes = set()
-      # Any currently existing nodes in producerNodes become tentatively deleted.
-      for pnode in producerNodes[p]:
-        pnode['deleted'] = ts
+  for owner in sorted(chain.producerJSON.problems):
+    for problem in chain.producerJSON.Problems(owner):
+      print(f"system: {owner}: {problem}", file=chain.log)
+  print(f"system: There are {chain.producerJSON.count} producerjson actions on the chain", file=chain.log)
+  # The lifecycle covers every producer that ever declared nodes, so the timeline, churn and
+  # node database keep those that have since unregistered; chain.producers only marks the active.
+  lifecycle = nodelife.NodeLifecycle()
+  for p in chain.producerJSON.Producers():
+    producerActions = chain.producerJSON.NodeActions(p)
+    if len(producerActions): print(f"{p}: {len(producerActions)} node actions", file=chain.log)
+    unknownNodes = set()
+    for na in producerActions:
+      if na['action'] == 'del':
+        lifecycle.Delete(p, na['timestamp'])
+        continue
+      data = na['data']
+      if 'nodes' not in data and 'json' in data:
+        data = json.loads(data['json'])
       nodes = []
-      if action == 'set':
-        if 'nodes' in na['data']:
-          nodes = na['data']['nodes']
-        else:
-          if 'json' in na['data']:
-            na_data_json = json.loads(na['data']['json'])
-            if 'nodes' in na_data_json:
-              nodes = na_data_json['nodes']
-        if len(nodes) == 0:
-          print(f'XXXXXX Could not find any nodes for producer {p}', file=log)
-        for node in nodes:
-          nodetype = node['node_type']
-          producerNode = {}
-          producerNode['fuzzy'] = ''
-          if isinstance(nodetype, list):
-            node_types = nodetype
-            for nodetype in node_types:
-              if not nodetype in nodeTypes:
-                if nodetype.lower() in ['api', 'query']:
-                  producerNode['fuzzy'] = nodetype
-                  nodetype = 'full'
-                  break
-                else:
-                  unknownNodes.add(nodetype)
-                  continue
-          else:
-            if not nodetype in nodeTypes:
-              if nodetype.lower() in ['api', 'query']:
-                producerNode['fuzzy'] = nodetype
-                nodetype = 'full'
-              else:
-                unknownNodes.add(nodetype)
-                continue
-          location = node['location']
-          producerNode['timestamp'] = ts
-          producerNode['deleted'] = ''
-          producerNode['producer'] = p
-          producerNode['node_type'] = nodetype
-          producerNode['location'] = location
-          countries.add(location['country'])
-          # If we already have this node in producerNodes, then just mark it not deleted.
-          found = False
-          for pnode in producerNodes[p]:
-            # TODO: We need to compare the country, lat & long of location
-            if pnode['node_type'] == nodetype and pnode['location'] == location:
-              found = True
-              pnode['deleted'] = ''
-          # If it wasn't in producerNodes - it is now.
-          if not found:
-            producerNodes[p].append(producerNode)
-      elif action == 'del':
-        for pnode in producerNodes[p]:
-          pnode['deleted'] = ts
-      if len(unknownNodes): print(f"{p}: + has unknown node types: {unknownNodes}", file=log)
-
-  print(f"system: {len(countries)} countries have nodes in them.", file=log)
-  print(f"system: + countries={sorted(countries)}", file=log)
+      for node in data.get('nodes', []):
+        nodetype, fuzzy, unknown = nodelife.NodeType(node['node_type'])
+        if nodetype is None:
+          unknownNodes.update(str(t) for t in unknown)
+          continue
+        nodes.append((nodetype, node['location'], fuzzy))
+      if len(nodes) == 0:
+        print(f'XXXXXX Could not find any nodes for producer {p}', file=chain.log)
+      lifecycle.Set(p, na['timestamp'], nodes)
+    if len(unknownNodes): print(f"{p}: + has unknown node types: {unknownNodes}", file=chain.log)
+  lifecycle.Save("node-timeline-{net}.json".format(net=chain.name))
+  churnFilename = "node-churn-{net}.txt".format(net=chain.name)
+  with open(churnFilename + ".tmp", 'w') as f:
+    nodelife.PrintChurn(lifecycle.Churn(), f)
+  os.replace(churnFilename + ".tmp", churnFilename)
+
   nodesByCountry = {}
-  for country in countries:
-    nodesByCountry[country] = []
-  for p in producers:
-    for pnode in producerNodes[p]:
-      if pnode['deleted'] == '':
-        nodesByCountry[pnode['location']['country']].append(pnode)
-        if len(pnode['fuzzy']): print(f"{p}: + has fuzzy node type: {pnode['fuzzy']}", file=log)
-  nbcFilename = "nodes-by-country-{net}.txt".format(net="mainnet" if args.mainnet else "testnet")
-  with open(nbcFilename, "w") as f:
+  for pnode in lifecycle.Active():
+    if pnode['producer'] in chain.producers:
+      nodesByCountry.setdefault(pnode['country'], []).append(pnode)
+      if len(pnode['fuzzy']): print(f"{pnode['producer']}: + has fuzzy node type: {pnode['fuzzy']}", file=chain.log)
+  countries = set(nodesByCountry)
+  print(f"system: {len(countries)} countries have nodes in them.", file=chain.log)
+  print(f"system: + countries={sorted(countries)}", file=chain.log)
+  nbcFilename = "nodes-by-country-{net}.txt".format(net=chain.name)
+  with open(nbcFilename + ".tmp", "w") as f:
     print(f"# This data was collected at: {datetime.datetime.utcnow()} UTC", file=f)
     for country in sorted(countries):
-      for pnode in sorted(nodesByCountry[country], key = lambda t: (t['timestamp'])):
-        print(f"{country} {pnode['node_type']} {pnode['timestamp']} {pnode['producer']} {pnode['location']['latitude']} {pnode['location']['longitude']}", file=f)
+      for pnode in sorted(nodesByCountry[country], key = lambda t: (t['added'])):
+        print(f"{country} {pnode['node_type']} {pnode['added']} {pnode['producer']} {pnode['latitude']} {pnode['longitude']}", file=f)
+  os.replace(nbcFilename + ".tmp", nbcFilename)
+  nodedb.Write("nodes-{net}.sqlite".format(net=chain.name), lifecycle, chain.producers)
 
   return
 
+def Fingerprint(*values):
+  return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+class ChainLog:
+  # What one chain prints, written to the shared log a whole line at a time and prefixed
+  # with the chain's name, so chains processed side by side do not garble each other.
+  def __init__(self, name, log, lock):
+    self.name = name
+    self.log = log
+    self.lock = lock
+    self.buffer = ''
+
+  def write(self, text):
+    self.buffer += text
+    if '\n' in self.buffer:
+      lines, self.buffer = self.buffer.rsplit('\n', 1)
+      with self.lock:
+        self.log.write(''.join(f"[{self.name}] {line}\n" for line in lines.split('\n')))
+
+  def flush(self):
+    with self.lock:
+      self.log.flush()
+
+class Chain:
+  # Everything genpmi keeps for one chain: its API clients, action store, logos and what
+  # was last read of its producers.  The files of a chain are named after it, e.g.
+  # mainnet-jsons/, and the chains share the HTTP caches and their connection pools.
+  def __init__(self, name, chainURLs, historyURLs, storeDirectory=None, log=sys.stdout):
+    self.name = name
+    self.log = log
+    os.makedirs("{net}-jsons".format(net=name), exist_ok=True)
+    self.chainClient = hyperion.HistoryClient(chainURLs)
+    self.historyClient = hyperion.HistoryClient(historyURLs)
+    self.store = actionstore.ActionStore(storeDirectory or ActionStoreDirectory(self))
+    self.logoCache = logocache.LogoCache(LogosDirectory(self), logoHTTPCache)
+    self.top21 = []
+    self.producers = {}
+    self.producerJSON = producerjson.ProducerJSONIndex([])
+
+def Run(chain):
+  # The whole pipeline once, for one chain.
+  with profile.Stage(f"{chain.name}: producers"):
+    chain.top21, chain.producers, producersDiff = GetProducers(chain, force=args.producers)
+  changed = ChangedProducers(producersDiff)
+  producers = chain.producers
+  print("system: {total} producers in total for {net}".format(net=chain.name, total=len(producers)), file=chain.log)
+  VerifyProducers(chain, producers)
+
+  with profile.Stage(f"{chain.name}: actions"):
+    SyncProducerJSONActions(chain)
+    chain.producerJSON = producerjson.ProducerJSONIndex(chain.store.Query(contract='producerjson'))
+  with profile.Stage(f"{chain.name}: bpjsons"):
+    bpjsons, updated = GetBPJSONs(chain, producers, force=(args.bpjsons or args.producers), changed=changed)
+  print("system: {total} url bp.json files in total for {net}".format(net=chain.name, total=len(bpjsons['url'])), file=chain.log)
+  VerifyBPJSONs(bpjsons)
+
+  with profile.Stage(f"{chain.name}: logos"):
+    logos = GetLogos(chain, 'url', producers, bpjsons, force=(args.logos or args.bpjsons or args.producers), revalidate=changed | updated)
+  print("system: {total} logo files in total for {net}".format(net=chain.name, total=len(logos)), file=chain.log)
+
+  print(f"system: Checking consistency of the producer information...", file=chain.log)
+  with profile.Stage(f"{chain.name}: consistency check"):
+    CheckConsistency(chain, producers, bpjsons, logos)
+  print(f"system: Consistency check complete", file=chain.log)
+
+  with profile.Stage(f"{chain.name}: health"):
+    health = ProbeHealthAll(chain, HealthEndpoints(bpjsons))
+  with profile.Stage(f"{chain.name}: map info"):
+    GenerateMapInfo(chain, producers, bpjsons, logos, health)
+  with profile.Stage(f"{chain.name}: node tables"):
+    GenerateNodeInfoTables(chain)
+
+def RunDaemon(chain):
+  # Refresh each source on its own schedule and regenerate only the outputs whose inputs
+  # changed, until stopping is set.  A source whose result changed makes the sources that
+  # build on it due at once; one that fails is tried again after DAEMON_RETRY seconds.
+  bpjsons = {'chain': {}, 'url': {}}
+  logos = {}
+  health = {}
+  changed = set()
+  due = dict.fromkeys(DAEMON_SCHEDULE, 0)
+  results = {}
+  inputs = {}
+  print(f"system: daemon: refreshing every {DAEMON_SCHEDULE} seconds", file=chain.log)
+  while not stopping.is_set():
+    for source in DAEMON_SCHEDULE:
+      now = time.monotonic()
+      if due[source] > now:
+        continue
+      print(f"system: daemon: refreshing the {source} at {datetime.datetime.utcnow()} UTC", file=chain.log)
+      try:
+        with profile.Stage(f"{chain.name}: {source}"):
+          if source == 'producers':
+            chain.top21, chain.producers, diff = GetProducers(chain)
+            changed |= ChangedProducers(diff)
+            result = Fingerprint(chain.top21, chain.producers)
+          elif source == 'actions':
+            SyncProducerJSONActions(chain)
+            chain.producerJSON = producerjson.ProducerJSONIndex(chain.store.Query(contract='producerjson'))
+            result = Fingerprint(chain.producerJSON.count, chain.producerJSON.latest)
+          elif source == 'bpjsons':
+            bpjsons, updated = GetBPJSONs(chain, chain.producers, changed=changed)
+            logos = GetLogos(chain, 'url', chain.producers, bpjsons, revalidate=changed | updated)
+            changed = set()
+            result = Fingerprint(bpjsons, logos)
+          elif source == 'health':
+            health = ProbeHealthAll(chain, HealthEndpoints(bpjsons), DAEMON_SCHEDULE['health'])
+            result = Fingerprint(HealthState(health))
+      except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"system: daemon: FAIL: {source}: {type(e).__name__}: {e} - trying again in {DAEMON_RETRY}s", file=chain.log)
+        due[source] = now + DAEMON_RETRY
+        continue
+      due[source] = now + DAEMON_SCHEDULE[source]
+      if results.get(source) != result:
+        results[source] = result
+        for dependent in DAEMON_DEPENDENTS.get(source, ()):
+          due[dependent] = 0
+
+    producers = chain.producers
+    retry = float('inf')
+    outputs = {
+      'consistency check': (Fingerprint(producers, bpjsons, logos), lambda: CheckConsistency(chain, producers, bpjsons, logos)),
+      'map info': (Fingerprint(chain.top21, bpjsons, logos, HealthState(health)), lambda: GenerateMapInfo(chain, producers, bpjsons, logos, health)),
+      'node tables': (Fingerprint(producers, results.get('actions')), lambda: GenerateNodeInfoTables(chain)),
+    }
+    for name, (fingerprint, generate) in outputs.items():
+      if inputs.get(name) != fingerprint:
+        print(f"system: daemon: regenerating the {name}", file=chain.log)
+        try:
+          with profile.Stage(f"{chain.name}: {name}"):
+            generate()
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+          # A bad bp.json must not stop the chain: the output is regenerated on a later pass.
+          print(f"system: daemon: FAIL: {name}: {type(e).__name__}: {e} - trying again in {DAEMON_RETRY}s", file=chain.log)
+          inputs.pop(name, None)
+          retry = time.monotonic() + DAEMON_RETRY
+          continue
+        inputs[name] = fingerprint
+    httpCache.Save()
+    logoHTTPCache.Save()
+    if args.profile is not None:
+      SaveRunReport(summary=False)
+    chain.log.flush()
+    stopping.wait(max(1, min(min(due.values()), retry) - time.monotonic()))
+
+def CloseCaches():
+  # Let the background revalidations finish so the next run starts from them.
+  for name, cache in (('http', httpCache), ('logo', logoHTTPCache)):
+    cache.Close()
+    print(f"system: {name} cache: {cache.Stats()}", file=log)
+
+def ReportsDirectory():
+  return args.profile or "reports"
+
+def SaveRunReport(summary=True):
+  with reportLock:
+    filename, report = profile.Save(ReportsDirectory(), {'http': httpCache.Stats(), 'logo': logoHTTPCache.Stats()})
+  if summary:
+    runreport.PrintSummary(report, log)
+    print(f"system: profile: run report written to {filename}", file=log)
+
+def LoadChains(filename):
+  # A chains file is a JSON list of {"name": ..., "chain": [URL, ...], "history": [URL, ...]},
+  # optionally with a "store" directory, like the CHAINS the -m and -t options stand for.
+  with open(filename) as fh:
+    chains = json.load(fh)
+  for config in chains:
+    for key in ('name', 'chain', 'history'):
+      if key not in config:
+        raise ValueError(f"chain {config} is missing '{key}'")
+  return chains
+
 # MAIN
 parser = argparse.ArgumentParser()
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument("-m", "--mainnet", help="Process Mainnet", action="store_true")
-group.add_argument("-t", "--testnet", help="Process Testnet", action="store_true")
+parser.add_argument("-m", "--mainnet", help="Process Mainnet", action="store_true")
+parser.add_argument("-t", "--testnet", help="Process Testnet", action="store_true")
+parser.add_argument("-c", "--chains", help="Process the chains listed in this JSON file; the chains are processed side by side")
 parser.add_argument("-b", "--bpjsons", help="Force an update to the cached producer bp.json files", action="store_true")
 #parser.add_argument("-c", "--check", help="Check the consistency of the producer information", action="store_true")
 parser.add_argument("-l", "--logos", help="Force an update to the cached producer logo files", action="store_true")
 parser.add_argument("-p", "--producers", help="Force an update for the cached producers json file", action="store_true")
 #parser.add_argument("-v", "--verbose", help="Be verbose while processing", action="store_true")
 parser.add_argument("-o", "--output", help="Where to write the output log (default is stdout)")
+parser.add_argument("--chain", help="A chain API endpoint to read the producer registry from; give it more than once to fail over and hedge between them", action="append")
+parser.add_argument("-u", "--history", help="A Hyperion history endpoint to use; give it more than once to fail over and hedge between them", action="append")
+parser.add_argument("-d", "--daemon", help="Keep running, refreshing each source on its own schedule and regenerating only the outputs whose inputs changed", action="store_true")
+parser.add_argument("--profile", help="Time each stage and external call, and write a run report to this directory (default: reports)", nargs='?', const='', default=None)
+parser.add_argument("-s", "--store", help="The local action store the producerjson actions are synced into and read from (default: NET-jsons/actions)")
 args = parser.parse_args()
 
-if args.output and len(args.output) > 0:
-  log = open(args.output, 'w')
-else:
-  log = sys.stdout
-
 #chainURL = "https://chain.wax.io" if args.mainnet else "https://testnet.waxsweden.org"
 #historyURL = "https://api.waxsweden.org" if args.mainnet else "https://testnet.waxsweden.org"
 #chainURL = "https://chain.wax.io" if args.mainnet else "https://testnet.blokcrafters.io"
@@ -624,32 +780,69 @@ else:
 #historyURL = "https://wax.blokcrafters.io" if args.mainnet else "https://testnet.waxsweden.org"
 #chainURL = "https://wax.blokcrafters.io" if args.mainnet else "https://testnet.wax.pink.gg"
 #historyURL = "https://wax.blokcrafters.io" if args.mainnet else "https://testnet.wax.pink.gg"
-chainURL = "https://wax.blokcrafters.io" if args.mainnet else "https://wax-test.blokcrafters.io"
-historyURL = "https://wax.blokcrafters.io" if args.mainnet else "https://wax-test.blokcrafters.io"
-producersFilename = "{net}-jsons/producers.json".format(net="mainnet" if args.mainnet else "testnet")
-top21Filename = "{net}-jsons/top21.json".format(net="mainnet" if args.mainnet else "testnet")
+configs = [config for config in CHAINS if (config['name'] == 'mainnet' and args.mainnet) or (config['name'] == 'testnet' and args.testnet)]
+if args.chains:
+  try:
+    configs.extend(LoadChains(args.chains))
+  except (OSError, ValueError) as e:
+    parser.error(f"{args.chains}: {e}")
+if not configs:
+  parser.error("one of -m/--mainnet, -t/--testnet or -c/--chains is required")
+if len(set(config['name'] for config in configs)) < len(configs):
+  parser.error("the chain names must be unique")
+if len(configs) > 1 and (args.chain or args.history or args.store):
+  parser.error("--chain, --history and --store are for a single chain; put them in the chains file")
 
-top21, producers = GetProducers(chainURL, producersFilename, top21Filename, force=args.producers)
-print("system: {total} producers in total for {net}".format(net="mainnet" if args.mainnet else "testnet", total=len(producers)), file=log)
-VerifyProducers(producers)
-
-bpjsons = GetBPJSONs(historyURL, producers, force=(args.bpjsons or args.producers))
-print("system: {total} url bp.json files in total for {net}".format(net="mainnet" if args.mainnet else "testnet", total=len(bpjsons['url'])), file=log)
-VerifyBPJSONs(bpjsons)
-
-logos = GetLogos('url', producers, bpjsons, force=(args.logos or args.bpjsons or args.producers))
-print("system: {total} logo files in total for {net}".format(net="mainnet" if args.mainnet else "testnet", total=len(logos)), file=log)
+if args.output and len(args.output) > 0:
+  log = open(args.output, 'w')
+else:
+  log = sys.stdout
 
-print(f"system: Checking consistency of the producer information...", file=log)
-CheckConsistency(producers, bpjsons, logos)
-print(f"system: Consistency check complete", file=log)
+httpCache = httpcache.HTTPCache(HTTPCacheDirectory(), HTTP_CACHE_MAX_BYTES)
+logoHTTPCache = httpcache.HTTPCache(LogosHTTPCacheDirectory(), LOGO_CACHE_MAX_BYTES)
+profile = runreport.RunReport()
+reportLock = threading.Lock()
+if args.profile is not None:
+  httpCache.observer = lambda url, seconds, size, ok: profile.Call('health' if url.endswith('/v2/health') else 'bp.json', url, seconds, size, ok)
+  logoHTTPCache.observer = profile.Observer('logo')
+stopping = threading.Event()
+
+logLock = threading.Lock()
+chains = []
+for config in configs:
+  chainLog = log if len(configs) == 1 else ChainLog(config['name'], log, logLock)
+  chains.append(Chain(config['name'], args.chain or config['chain'], args.history or config['history'],
+                      args.store or config.get('store'), chainLog))
+
+# Every chain runs on a thread of its own; they spend their time waiting on the network,
+# so the run takes about as long as the slowest chain.
+if args.daemon:
+  # SIGTERM stops the daemon as ^C does, closing the caches on the way out.
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+failed = []
+with concurrent.futures.ThreadPoolExecutor(max_workers=len(chains)) as executor:
+  futures = {executor.submit(RunDaemon if args.daemon else Run, chain): chain for chain in chains}
+  while not all(future.done() for future in futures):
+    try:
+      stopping.wait(1)
+    except KeyboardInterrupt:
+      stopping.set()
+  for future, chain in futures.items():
+    try:
+      future.result()
+    except Exception:
+      # One chain failing does not stop the others.
+      failed.append(chain.name)
+      print(f"system: FAIL: {chain.name}:\n{traceback.format_exc()}", file=chain.log)
 
-GenerateMapInfo(producers, bpjsons, logos)
-GenerateNodeInfoTables()
+with profile.Stage('closing the caches'):
+  CloseCaches()
+if args.profile is not None:
+  SaveRunReport()
 
-print(f"system: complete.", file=log)
+print(f"system: {'stopped' if args.daemon else 'complete'}.", file=log)
 
 if args.output and len(args.output) > 0:
   log.close()
 
-sys.exit(0)
+sys.exit(1 if failed else 0)
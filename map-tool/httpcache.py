@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#
+# blokcrafters HTTP cache
+# every fetch genpmi makes, kept on disk with its validators and a freshness time of its own
+#
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+
+# How many requests are made at the same time, in the foreground and in the background.
+POOL_SIZE = 32
+# Seconds to wait for a host to connect and then between bytes.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+# The most the bodies may take on disk before the least recently used are evicted.
+MAX_BYTES = 256 * 1024 * 1024
+
+class HTTPCache:
+  # Bodies are kept under bodies/ named by their sha256, so two URLs answering the same
+  # bytes share one copy.  index.json holds an entry per key (the URL, or a name given to
+  # Remember) with the body's sha256, its ETag and Last-Modified, when it was fetched, how
+  # long it stays fresh (ttl) and for how long after that it may still be served while it
+  # is revalidated in the background (stale), and when it was last used, for eviction.
+  #
+  # Get() answers from the cache while an entry is fresh, serves it and revalidates it in
+  # the background while it is stale, and otherwise makes a conditional GET.  A failed
+  # fetch keeps the body held before, and is itself remembered for negativeTTL seconds so
+  # that a dead host does not cost a timeout on every call.  Close() waits for the
+  # background revalidations and saves the index.
+  def __init__(self, directory, maxBytes=MAX_BYTES, poolSize=POOL_SIZE):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    os.makedirs(os.path.join(directory, 'bodies'), exist_ok=True)
+    self.indexFilename = os.path.join(directory, 'index.json')
+    self.entries = {}
+    if os.path.exists(self.indexFilename):
+      with open(self.indexFilename) as fh:
+        self.entries = json.load(fh)
+    self.sizes = {}
+    for entry in self.entries.values():
+      if entry.get('sha256'):
+        self.sizes[entry['sha256']] = entry['size']
+    self.bytes = sum(self.sizes.values())
+    self.lock = threading.Lock()
+    self.stats = dict.fromkeys(('hits', 'stale', 'misses', 'revalidated', 'updated', 'unchanged', 'failed', 'evicted', 'bytes_fetched'), 0)
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.background = concurrent.futures.ThreadPoolExecutor(max_workers=poolSize)
+    self.revalidating = {}
+    # Called as observer(url, seconds, bytes, ok) after every fetch, e.g. to profile them.
+    self.observer = None
+
+  def BodyFilename(self, sha):
+    return os.path.join(self.directory, 'bodies', sha)
+
+  def Content(self, sha):
+    # The bytes of a body, or None when it has gone.
+    try:
+      with open(self.BodyFilename(sha), 'rb') as fh:
+        return fh.read()
+    except (FileNotFoundError, TypeError):
+      return None
+
+  def Count(self, name, n=1):
+    with self.lock:
+      self.stats[name] += n
+
+  def Outcome(self, key, entry, result):
+    return {'url': key, 'result': result, 'ok': not entry.get('error'), 'error': entry.get('error'),
+            'sha256': entry.get('sha256'), 'status': entry.get('status'), 'fetched': entry.get('fetched'),
+            'seconds': entry.get('seconds', 0)}
+
+  def Get(self, url, ttl, stale=0, negativeTTL=None, force=False, headers=None,
+          timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), maxSize=None, deadline=None, revalidate=False):
+    # The outcome of getting url: its result ('hit', 'stale', 'not_modified', 'updated',
+    # 'unchanged' or 'failed'), whether the last fetch succeeded and the sha256 of the body
+    # held, if any.  revalidate makes a conditional GET however fresh the entry is, and
+    # force skips the cache and its validators altogether.
+    now = time.time()
+    with self.lock:
+      entry = self.entries.get(url)
+      if entry is not None:
+        entry['used'] = now
+    if entry is not None and not force and not revalidate:
+      age = now - entry['fetched']
+      if age < (entry['ttl'] if not entry.get('error') else entry.get('negative_ttl', entry['ttl'])):
+        self.Count('hits')
+        return self.Outcome(url, entry, 'hit')
+      if not entry.get('error') and entry.get('sha256') and age < entry['ttl'] + entry.get('stale', 0):
+        self.Count('stale')
+        with self.lock:
+          if url not in self.revalidating:
+            self.revalidating[url] = self.background.submit(self.Fetch, url, ttl, stale, negativeTTL, False, headers, timeout, maxSize, deadline)
+        return self.Outcome(url, entry, 'stale')
+    return self.Fetch(url, ttl, stale, negativeTTL, force, headers, timeout, maxSize, deadline)
+
+  def Fetch(self, url, ttl, stale, negativeTTL, force, headers, timeout, maxSize, deadline):
+    # One GET, conditional when there is a body to revalidate.
+    with self.lock:
+      entry = dict(self.entries.get(url, {}))
+    headers = dict(headers or {})
+    held = not force and entry.get('sha256') and os.path.exists(self.BodyFilename(entry['sha256']))
+    if held:
+      if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+      if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    else:
+      self.Count('misses')
+    entry.update(ttl=ttl, stale=stale, negative_ttl=negativeTTL if negativeTTL is not None else ttl)
+    started = time.monotonic()
+    size = 0
+    try:
+      with self.session.get(url, headers=headers, timeout=timeout, stream=True) as r:
+        entry['status'] = r.status_code
+        if r.status_code == 304 and held:
+          result = 'not_modified'
+          self.Count('revalidated')
+        elif r.status_code != 200:
+          raise requests.HTTPError(f"HTTP {r.status_code} {r.reason}")
+        else:
+          # A host may trickle its answer a byte at a time, so the whole download can have a deadline too.
+          content = b''
+          for chunk in r.iter_content(65536):
+            content += chunk
+            if maxSize is not None and len(content) > maxSize:
+              raise ValueError(f"more than {maxSize} bytes")
+            if deadline is not None and time.monotonic() - started > deadline:
+              raise ValueError(f"took more than {deadline}s")
+          size = len(content)
+          self.Count('bytes_fetched', size)
+          sha = self.Store(content)
+          result = 'unchanged' if sha == entry.get('sha256') else 'updated'
+          self.Count(result)
+          entry.update(sha256=sha, size=len(content), etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+      entry.pop('error', None)
+    except (requests.RequestException, ValueError) as e:
+      result = 'failed'
+      self.Count('failed')
+      entry['error'] = f"{type(e).__name__}: {e}"
+    entry['seconds'] = round(time.monotonic() - started, 3)
+    entry['fetched'] = entry['used'] = time.time()
+    if self.observer is not None:
+      self.observer(url, entry['seconds'], size, result != 'failed')
+    with self.lock:
+      self.entries[url] = entry
+      self.revalidating.pop(url, None)
+    self.Evict()
+    return self.Outcome(url, entry, result)
+
+  def Store(self, content):
+    sha = hashlib.sha256(content).hexdigest()
+    with self.lock:
+      known = sha in self.sizes
+    if not known or not os.path.exists(self.BodyFilename(sha)):
+      tmpFilename = self.BodyFilename(sha) + f".{threading.get_ident()}.tmp"
+      with open(tmpFilename, 'wb') as fh:
+        fh.write(content)
+      os.replace(tmpFilename, self.BodyFilename(sha))
+      with self.lock:
+        if sha not in self.sizes:
+          self.sizes[sha] = len(content)
+          self.bytes += len(content)
+    return sha
+
+  def Remember(self, key, ttl, load, force=False):
+    # For what does not come from a plain GET: the JSON value load() returns is kept under
+    # key for ttl seconds.  Returns the value and whether it was a 'hit' or 'updated'.
+    now = time.time()
+    with self.lock:
+      entry = self.entries.get(key)
+    if entry is not None and not force and now - entry['fetched'] < entry['ttl']:
+      content = self.Content(entry.get('sha256'))
+      if content is not None:
+        with self.lock:
+          entry['used'] = now
+          self.stats['hits'] += 1
+        return json.loads(content), 'hit'
+    self.Count('misses')
+    started = time.monotonic()
+    value = load()
+    content = json.dumps(value).encode()
+    sha = self.Store(content)
+    self.Count('updated')
+    with self.lock:
+      self.entries[key] = {'sha256': sha, 'size': len(content), 'ttl': ttl, 'fetched': time.time(), 'used': time.time(),
+                           'seconds': round(time.monotonic() - started, 3)}
+    self.Evict()
+    return value, 'updated'
+
+  def Evict(self):
+    # Drop the least recently used entries until the bodies fit, and with them the bodies
+    # no other entry holds.
+    with self.lock:
+      if self.bytes <= self.maxBytes:
+        return
+      holders = {}
+      for key, entry in self.entries.items():
+        if entry.get('sha256'):
+          holders.setdefault(entry['sha256'], set()).add(key)
+      for key in sorted(self.entries, key=lambda k: self.entries[k]['used']):
+        if self.bytes <= self.maxBytes:
+          break
+        sha = self.entries.pop(key).get('sha256')
+        self.stats['evicted'] += 1
+        if sha is None:
+          continue
+        holders[sha].discard(key)
+        if not holders[sha]:
+          self.bytes -= self.sizes.pop(sha)
+          try:
+            os.remove(self.BodyFilename(sha))
+          except FileNotFoundError:
+            pass
+
+  def Stats(self):
+    with self.lock:
+      return dict(self.stats, entries=len(self.entries), bytes=self.bytes)
+
+  def Save(self):
+    with self.lock:
+      with open(self.indexFilename + ".tmp", 'w') as fh:
+        json.dump(self.entries, fh, indent=1, sort_keys=True)
+      os.replace(self.indexFilename + ".tmp", self.indexFilename)
+
+  def Close(self):
+    self.background.shutdown(wait=True)
+    self.session.close()
+    self.Save()
+
+# MAIN
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="List what an HTTP cache written by genpmi.py holds.")
+  parser.add_argument("directory", help="The cache directory, e.g. http-cache/jsons or http-cache/logos")
+  args = parser.parse_args()
+
+  with open(os.path.join(args.directory, 'index.json')) as fh:
+    entries = json.load(fh)
+  now = time.time()
+  for key, entry in sorted(entries.items(), key=lambda kv: kv[1]['used'], reverse=True):
+    age = now - entry['fetched']
+    if entry.get('error'):
+      state = 'failed'
+    elif age < entry['ttl']:
+      state = 'fresh'
+    elif age < entry['ttl'] + entry.get('stale', 0):
+      state = 'stale'
+    else:
+      state = 'expired'
+    print(f"{state:7s} {age:8.0f}s {entry.get('size', 0):9d} {key}")
+  sizes = {entry['sha256']: entry['size'] for entry in entries.values() if entry.get('sha256')}
+  print(f"{len(entries)} entries, {len(sizes)} bodies, {sum(sizes.values())} bytes")
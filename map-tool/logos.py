@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# blokcrafters producer logo cache
+# the producer logos, fetched through the HTTP cache and normalized to small uniform thumbnails
+#
+import concurrent.futures
+import io
+import json
+import os
+
+import PIL.features
+import PIL.Image
+
+import httpcache
+
+# How many logos are fetched at the same time, and how many threads make thumbnails (Pillow
+# resizes and encodes without holding the GIL, so they run in parallel).
+FETCH_WORKERS = 32
+THUMBNAIL_WORKERS = os.cpu_count() or 2
+# Seconds to wait for a logo's host to connect and then between bytes.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+# The largest logo accepted, in bytes, and the most the fetched logos may take on disk.
+MAX_SIZE = 5 * 1024 * 1024
+MAX_BYTES = 256 * 1024 * 1024
+# Seconds a logo is used without asking its host again, then served while it is revalidated,
+# and how long a logo that could not be fetched is left before trying again.
+TTL = 86400
+STALE = 86400
+NEGATIVE_TTL = 3600
+# Thumbnails are this many pixels square, as WebP when Pillow can write it and PNG otherwise.
+THUMBNAIL_SIZE = 256
+THUMBNAIL_FORMAT = 'webp' if PIL.features.check('webp') else 'png'
+
+def MakeThumbnail(source, destination):
+  # Scale an image to fit a transparent square, keeping its aspect ratio.  Runs in a worker
+  # thread; returns None or what went wrong.
+  try:
+    with PIL.Image.open(source) as image:
+      image.seek(0)
+      image = image.convert('RGBA')
+      image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), PIL.Image.LANCZOS)
+      square = PIL.Image.new('RGBA', (THUMBNAIL_SIZE, THUMBNAIL_SIZE), (0, 0, 0, 0))
+      square.paste(image, ((THUMBNAIL_SIZE - image.width) // 2, (THUMBNAIL_SIZE - image.height) // 2))
+      buffer = io.BytesIO()
+      if THUMBNAIL_FORMAT == 'webp':
+        square.save(buffer, 'WEBP', quality=85, method=6)
+      else:
+        square.save(buffer, 'PNG', optimize=True)
+  except (OSError, ValueError, PIL.Image.DecompressionBombError) as e:
+    return f"{type(e).__name__}: {e}"
+  with open(destination + ".tmp", 'wb') as fh:
+    fh.write(buffer.getvalue())
+  os.replace(destination + ".tmp", destination)
+  return None
+
+class LogoCache:
+  # The images come through an HTTP cache under http/, which keeps each one once by its
+  # sha256 however many producers use it, so they share one thumbnail (<sha256>.webp or
+  # .png) too.  logos.json records each producer's logo URL and image.  Several logo caches
+  # may share one HTTP cache, e.g. one per chain; it is then closed by whoever made it.
+  def __init__(self, directory, http=None, maxBytes=MAX_BYTES):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+    self.ownsHTTP = http is None
+    self.http = http if http is not None else httpcache.HTTPCache(os.path.join(directory, 'http'), maxBytes, FETCH_WORKERS)
+    self.indexFilename = os.path.join(directory, 'logos.json')
+    self.index = {}
+    if os.path.exists(self.indexFilename):
+      with open(self.indexFilename) as fh:
+        self.index = json.load(fh)
+
+  def ThumbnailFilename(self, sha):
+    return os.path.join(self.directory, f"{sha}.{THUMBNAIL_FORMAT}")
+
+  def Update(self, urls, force=False, revalidate=()):
+    # Get the logos of the producers in urls ({producer: url}) concurrently, each fetched or
+    # revalidated only once its own freshness has run out (or at once for the producers in
+    # revalidate), then make the missing thumbnails in a thread pool.  force fetches
+    # everything whole again.  Returns the thumbnail of
+    # every producer that has one and the outcome of getting each logo.
+    outcomes = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+      futures = {}
+      for p, url in urls.items():
+        futures[executor.submit(self.http.Get, url, TTL, STALE, NEGATIVE_TTL, force,
+                                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), maxSize=MAX_SIZE, revalidate=p in revalidate)] = p
+      for future in concurrent.futures.as_completed(futures):
+        p = futures[future]
+        outcome = outcomes[p] = future.result()
+        # A logo that could not be fetched keeps the image it had.
+        if outcome['sha256']:
+          self.index[p] = {'url': outcome['url'], 'sha256': outcome['sha256']}
+    for p in list(self.index):
+      if p not in urls:
+        del self.index[p]
+
+    needed = sorted(set(entry['sha256'] for entry in self.index.values()
+                        if not os.path.exists(self.ThumbnailFilename(entry['sha256']))))
+    failed = {}
+    if needed:
+      # Threads rather than processes: genpmi runs several chains in threads, and forking a
+      # threaded process (or spawning one that re-imports genpmi) is not safe.
+      with concurrent.futures.ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as executor:
+        for sha, error in zip(needed, executor.map(MakeThumbnail, map(self.http.BodyFilename, needed), map(self.ThumbnailFilename, needed))):
+          if error:
+            failed[sha] = error
+    for p, entry in self.index.items():
+      if entry['sha256'] in failed:
+        outcomes[p] = dict(outcomes.get(p, {'url': entry['url']}), result='failed', ok=False, error=f"thumbnail: {failed[entry['sha256']]}")
+
+    with open(self.indexFilename + ".tmp", 'w') as fh:
+      json.dump(self.index, fh, indent=2, sort_keys=True)
+    os.replace(self.indexFilename + ".tmp", self.indexFilename)
+    logos = {}
+    for p, entry in self.index.items():
+      if os.path.exists(self.ThumbnailFilename(entry['sha256'])):
+        logos[p] = self.ThumbnailFilename(entry['sha256'])
+    return logos, outcomes
+
+  def Close(self):
+    if self.ownsHTTP:
+      self.http.Close()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+# blokcrafters node database
+# every producer node ever declared, in SQLite with an R-tree over their positions
+#
+import argparse
+import calendar
+import datetime
+import math
+import os
+import sqlite3
+import sys
+import time
+
+# The mean radius of the Earth, in km.
+EARTH_RADIUS = 6371.0
+# How far the nearest node search looks first, in km; it doubles until it has enough nodes.
+NEAREST_RADIUS = 100.0
+# The most it ever looks: half way round the Earth.
+MAX_RADIUS = math.pi * EARTH_RADIUS
+
+SCHEMA = '''
+CREATE TABLE nodes (
+  rowid INTEGER PRIMARY KEY,
+  id TEXT UNIQUE NOT NULL,
+  producer TEXT NOT NULL,
+  node_type TEXT NOT NULL,
+  fuzzy TEXT NOT NULL,
+  country TEXT NOT NULL,
+  latitude REAL,
+  longitude REAL,
+  added INTEGER NOT NULL,
+  removed INTEGER,
+  active INTEGER NOT NULL
+);
+CREATE TABLE intervals (
+  node INTEGER NOT NULL REFERENCES nodes(rowid),
+  added INTEGER NOT NULL,
+  removed INTEGER
+);
+CREATE VIRTUAL TABLE positions USING rtree(node, min_latitude, max_latitude, min_longitude, max_longitude);
+CREATE INDEX nodes_country ON nodes(country, node_type);
+CREATE INDEX nodes_producer ON nodes(producer);
+CREATE INDEX intervals_node ON intervals(node);
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+def Position(node):
+  # A node's (latitude, longitude), or None when it has no usable position.
+  try:
+    latitude, longitude = float(node['latitude']), float(node['longitude'])
+  except (TypeError, ValueError):
+    return None
+  if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+    return None
+  return latitude, longitude
+
+def Distance(latitude1, longitude1, latitude2, longitude2):
+  # The great circle distance in km (haversine).
+  phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+  a = (math.sin((phi2 - phi1) / 2) ** 2
+       + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+  return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+def Boxes(latitude, longitude, km):
+  # The (south, west, north, east) boxes covering every point within km of a position,
+  # split in two where they would cross the antimeridian.
+  dLatitude = math.degrees(km / EARTH_RADIUS)
+  south, north = latitude - dLatitude, latitude + dLatitude
+  if south <= -90 or north >= 90:
+    return [(max(south, -90), -180, min(north, 90), 180)]
+  dLongitude = math.degrees(math.asin(min(1, math.sin(km / EARTH_RADIUS) / math.cos(math.radians(latitude)))))
+  if dLongitude >= 180 or km >= MAX_RADIUS / 2:
+    return [(south, -180, north, 180)]
+  west, east = longitude - dLongitude, longitude + dLongitude
+  if west < -180:
+    return [(south, west + 360, north, 180), (south, -180, north, east)]
+  if east > 180:
+    return [(south, west, north, 180), (south, -180, north, east - 360)]
+  return [(south, west, north, east)]
+
+def Write(filename, lifecycle, producers, collected=None):
+  # Build the database of a node lifecycle afresh beside filename and swap it in, so readers
+  # never see it half written.  A node is active when it is declared now by a producer
+  # that is still registered.
+  tmpFilename = filename + ".tmp"
+  if os.path.exists(tmpFilename):
+    os.remove(tmpFilename)
+  db = sqlite3.connect(tmpFilename)
+  try:
+    db.executescript(SCHEMA)
+    for rowid, node in enumerate(sorted(lifecycle.nodes.values(), key=lambda n: n['id']), 1):
+      intervals = node['intervals']
+      position = Position(node) or (None, None)
+      removed = intervals[-1][1] if intervals else None
+      active = bool(intervals) and removed is None and node['producer'] in producers
+      db.execute("INSERT INTO nodes VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                 (rowid, node['id'], node['producer'], node['node_type'], node['fuzzy'] or '', node['country'],
+                  position[0], position[1], intervals[0][0] if intervals else 0, removed, active))
+      db.executemany("INSERT INTO intervals VALUES (?,?,?)", [(rowid, added, removed) for added, removed in intervals])
+      if position[0] is not None:
+        db.execute("INSERT INTO positions VALUES (?,?,?,?,?)", (rowid, position[0], position[0], position[1], position[1]))
+    db.execute("INSERT INTO info VALUES ('collected', ?)", (collected or datetime.datetime.utcnow().isoformat(timespec='seconds'),))
+    db.commit()
+  finally:
+    db.close()
+  os.replace(tmpFilename, filename)
+
+class NodeDB:
+  # Queries over a database written by Write().  Each returns the matching nodes as dicts,
+  # only the active ones unless everything is asked for; type, country and producer narrow
+  # them further.
+  def __init__(self, filename):
+    self.db = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+    self.db.row_factory = sqlite3.Row
+
+  def Where(self, everything, nodeType, country, producer):
+    clauses, parameters = [], []
+    if not everything:
+      clauses.append("n.active")
+    for column, value in (('node_type', nodeType), ('country', country and country.upper()), ('producer', producer)):
+      if value:
+        clauses.append(f"n.{column} = ?")
+        parameters.append(value)
+    return ''.join(f" AND {clause}" for clause in clauses), parameters
+
+  def Box(self, south, west, north, east, everything=False, nodeType=None, country=None, producer=None):
+    # The nodes inside a box; one whose west is east of its east crosses the antimeridian.
+    where, parameters = self.Where(everything, nodeType, country, producer)
+    boxes = [(south, west, north, east)] if west <= east else [(south, west, north, 180), (south, -180, north, east)]
+    nodes = []
+    for s, w, n, e in boxes:
+      nodes.extend(dict(row) for row in self.db.execute(
+        "SELECT n.* FROM positions p JOIN nodes n ON n.rowid = p.node"
+        " WHERE p.max_latitude >= ? AND p.min_latitude <= ? AND p.max_longitude >= ? AND p.min_longitude <= ?" + where,
+        [s, n, w, e] + parameters))
+    return nodes
+
+  def Within(self, latitude, longitude, km, everything=False, nodeType=None, country=None, producer=None):
+    # The nodes within km of a position, nearest first, each with its 'distance' in km.
+    # The R-tree narrows them to the boxes around the circle and the distance does the rest.
+    nodes = {}
+    for box in Boxes(latitude, longitude, km):
+      for node in self.Box(*box, everything=everything, nodeType=nodeType, country=country, producer=producer):
+        node['distance'] = Distance(latitude, longitude, node['latitude'], node['longitude'])
+        if node['distance'] <= km:
+          nodes[node['id']] = node
+    return sorted(nodes.values(), key=lambda n: n['distance'])
+
+  def Nearest(self, latitude, longitude, n, everything=False, nodeType=None, country=None, producer=None):
+    # The n nodes nearest a position, looking twice as far each time until there are enough.
+    km = NEAREST_RADIUS
+    while True:
+      nodes = self.Within(latitude, longitude, km, everything, nodeType, country, producer)
+      if len(nodes) >= n or km >= MAX_RADIUS:
+        return nodes[:n]
+      km = min(km * 2, MAX_RADIUS)
+
+  def Counts(self, everything=False, nodeType=None, country=None, producer=None):
+    # [(country, node_type, nodes)]
+    where, parameters = self.Where(everything, nodeType, country, producer)
+    return [tuple(row) for row in self.db.execute(
+      "SELECT n.country, n.node_type, COUNT(*) FROM nodes n WHERE 1" + where
+      + " GROUP BY n.country, n.node_type ORDER BY n.country, n.node_type", parameters)]
+
+  def At(self, when, nodeType=None, country=None, producer=None):
+    # The nodes declared at epoch seconds when, registered or not, from their intervals.
+    where, parameters = self.Where(True, nodeType, country, producer)
+    return [dict(row) for row in self.db.execute(
+      "SELECT DISTINCT n.* FROM intervals i JOIN nodes n ON n.rowid = i.node"
+      " WHERE i.added <= ? AND (i.removed IS NULL OR ? < i.removed)" + where, [when, when] + parameters)]
+
+  def Close(self):
+    self.db.close()
+
+def Coordinates(text, count):
+  try:
+    values = [float(v) for v in text.split(',')]
+  except ValueError:
+    values = []
+  if len(values) != count:
+    raise argparse.ArgumentTypeError(f"expected {count} comma separated numbers, not {text!r}")
+  return values
+
+# MAIN
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Query a node database written by genpmi.py.")
+  parser.add_argument("database", help="The node database, e.g. nodes-mainnet.sqlite")
+  group = parser.add_mutually_exclusive_group(required=True)
+  group.add_argument("--bbox", help="List the nodes inside a box, as SOUTH,WEST,NORTH,EAST in degrees", type=lambda t: Coordinates(t, 4))
+  group.add_argument("--near", help="List the nodes nearest a position, as LATITUDE,LONGITUDE in degrees", type=lambda t: Coordinates(t, 2))
+  group.add_argument("--count", help="Count the nodes by country and node type", action="store_true")
+  group.add_argument("--at", help="List the nodes declared at this UTC date and time, e.g. 2022-06-01 or 2022-06-01T12:00")
+  parser.add_argument("-k", "--km", help="With --near, list every node within this many km", type=float)
+  parser.add_argument("-n", "--nearest", help="With --near, list this many of the nearest nodes (default: %(default)s)", type=int, default=10)
+  parser.add_argument("-t", "--type", help="Only nodes of this type: full, hyperion, producer or seed")
+  parser.add_argument("-c", "--country", help="Only nodes in this country, e.g. DE")
+  parser.add_argument("-p", "--producer", help="Only nodes of this producer")
+  parser.add_argument("-a", "--all", help="Include the nodes no longer declared or whose producer is no longer registered", action="store_true")
+  args = parser.parse_args()
+
+  nodedb = NodeDB(args.database)
+  started = time.monotonic()
+  filters = {'nodeType': args.type, 'country': args.country, 'producer': args.producer}
+  if args.count:
+    results = nodedb.Counts(args.all, **filters)
+    for country, nodeType, count in results:
+      print(f"{country} {nodeType} {count}")
+  else:
+    if args.bbox:
+      results = sorted(nodedb.Box(*args.bbox, everything=args.all, **filters), key=lambda n: (n['country'], n['producer']))
+    elif args.near and args.km is not None:
+      results = nodedb.Within(*args.near, args.km, everything=args.all, **filters)
+    elif args.near:
+      results = nodedb.Nearest(*args.near, args.nearest, everything=args.all, **filters)
+    else:
+      when = datetime.datetime.fromisoformat(args.at)
+      results = sorted(nodedb.At(calendar.timegm(when.timetuple()), **filters), key=lambda n: (n['country'], n['producer']))
+    for node in results:
+      distance = f" {node['distance']:.0f}km" if 'distance' in node else ''
+      print(f"{node['country']} {node['node_type']} {node['added']} {node['producer']} {node['latitude']} {node['longitude']}{distance}")
+  print(f"{len(results)} results in {1000 * (time.monotonic() - started):.1f}ms", file=sys.stderr)
+  nodedb.Close()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# blokcrafters node lifecycle
+# the added/removed history of every producer node declared in the producerjson actions
+#
+import argparse
+import bisect
+import calendar
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+
+# The node types on the map; 'api' and 'query' are taken to mean a full node.
+NODE_TYPES = ['full', 'hyperion', 'producer', 'seed']
+FUZZY_NODE_TYPES = ['api', 'query']
+# Decimal places a node's latitude and longitude are rounded to for its identity, about 1km.
+COORDINATE_PLACES = 2
+
+def NodeType(nodetype):
+  # The map node type of a declared node_type, which may be a list, as (type, fuzzy, unknown):
+  # the first known type wins, else the first 'api' or 'query' counts as full.
+  declared = nodetype if isinstance(nodetype, list) else [nodetype]
+  for t in declared:
+    if t in NODE_TYPES:
+      return t, '', []
+  for t in declared:
+    if isinstance(t, str) and t.lower() in FUZZY_NODE_TYPES:
+      return 'full', t, []
+  return None, '', declared
+
+def Coordinate(value):
+  try:
+    return round(float(value), COORDINATE_PLACES)
+  except (TypeError, ValueError):
+    return None
+
+def NodeIdentity(producer, nodeType, location):
+  # The same node in two bp.jsons hashes the same even when the location's name or the
+  # precision of its coordinates changed.
+  country = str(location.get('country', '')).upper()
+  key = f"{producer}|{nodeType}|{country}|{Coordinate(location.get('latitude'))}|{Coordinate(location.get('longitude'))}"
+  return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def Month(timestamp):
+  return time.strftime("%Y-%m", time.gmtime(timestamp))
+
+class NodeLifecycle:
+  # Every node ever declared, keyed by its identity, with the intervals it was declared
+  # for: [added, removed] with removed None while it still is.  Each producer's currently
+  # declared nodes are a set, so a set or del action costs O(1) per node it changes.
+  def __init__(self):
+    self.nodes = {}
+    self.active = {}
+
+  def Set(self, producer, timestamp, nodes):
+    # A producer declared these nodes, given as (node_type, location, fuzzy), replacing the last lot.
+    declared = {}
+    for nodeType, location, fuzzy in nodes:
+      declared[NodeIdentity(producer, nodeType, location)] = (nodeType, location, fuzzy)
+    active = self.active.setdefault(producer, set())
+    for identity in active - set(declared):
+      self.nodes[identity]['intervals'][-1][1] = timestamp
+    for identity in set(declared) - active:
+      nodeType, location, fuzzy = declared[identity]
+      node = self.nodes.get(identity)
+      if node is None:
+        node = self.nodes[identity] = {
+          'id': identity, 'producer': producer, 'node_type': nodeType, 'fuzzy': fuzzy,
+          'country': str(location.get('country', '')).upper(),
+          'latitude': location.get('latitude'), 'longitude': location.get('longitude'), 'intervals': []}
+      node['intervals'].append([timestamp, None])
+    # The latest declaration's details win for nodes that stay.
+    for identity in set(declared) & active:
+      nodeType, location, fuzzy = declared[identity]
+      self.nodes[identity].update(fuzzy=fuzzy, latitude=location.get('latitude'), longitude=location.get('longitude'))
+    self.active[producer] = set(declared)
+
+  def Delete(self, producer, timestamp):
+    self.Set(producer, timestamp, [])
+
+  def Active(self):
+    # The nodes declared now, each with when its current interval began.
+    return [dict(self.nodes[identity], added=self.nodes[identity]['intervals'][-1][0])
+            for identities in self.active.values() for identity in identities]
+
+  def ActiveAt(self, when):
+    # The nodes declared at epoch seconds when, from their intervals alone.
+    active = []
+    for node in self.nodes.values():
+      intervals = node['intervals']
+      i = bisect.bisect_right([interval[0] for interval in intervals], when) - 1
+      if i >= 0 and (intervals[i][1] is None or when < intervals[i][1]):
+        active.append(dict(node, added=intervals[i][0]))
+    return active
+
+  def Churn(self):
+    # {country: {month: {'added': n, 'removed': n}}}
+    churn = {}
+    for node in self.nodes.values():
+      months = churn.setdefault(node['country'], {})
+      for added, removed in node['intervals']:
+        months.setdefault(Month(added), {'added': 0, 'removed': 0})['added'] += 1
+        if removed is not None:
+          months.setdefault(Month(removed), {'added': 0, 'removed': 0})['removed'] += 1
+    return churn
+
+  def Save(self, filename):
+    with open(filename + ".tmp", 'w') as fh:
+      json.dump({'nodes': list(self.nodes.values())}, fh, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+  def Load(self, filename):
+    with open(filename) as fh:
+      for node in json.load(fh)['nodes']:
+        self.nodes[node['id']] = node
+        if node['intervals'] and node['intervals'][-1][1] is None:
+          self.active.setdefault(node['producer'], set()).add(node['id'])
+
+def PrintChurn(churn, f):
+  print(f"# country month added removed", file=f)
+  for country in sorted(churn):
+    for month in sorted(churn[country]):
+      print(f"{country} {month} {churn[country][month]['added']} {churn[country][month]['removed']}", file=f)
+
+# MAIN
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Query a node timeline written by genpmi.py.")
+  parser.add_argument("timeline", help="The node timeline file, e.g. node-timeline-mainnet.json")
+  group = parser.add_mutually_exclusive_group(required=True)
+  group.add_argument("--at", help="List the nodes declared at this UTC date and time, e.g. 2022-06-01 or 2022-06-01T12:00")
+  group.add_argument("--churn", help="Print the nodes added and removed per country per month", action="store_true")
+  args = parser.parse_args()
+
+  lifecycle = NodeLifecycle()
+  lifecycle.Load(args.timeline)
+  if args.at:
+    when = datetime.datetime.fromisoformat(args.at)
+    for node in sorted(lifecycle.ActiveAt(calendar.timegm(when.timetuple())), key=lambda n: (n['country'], n['producer'])):
+      print(f"{node['country']} {node['node_type']} {node['added']} {node['producer']} {node['latitude']} {node['longitude']}")
+  else:
+    PrintChurn(lifecycle.Churn(), sys.stdout)
+  sys.stdout.flush()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# blokcrafters producerjson action index
+# decodes the producerjson contract's set/del actions once and answers the per-producer questions genpmi asks
+#
+import argparse
+import calendar
+import datetime
+import json
+import random
+import time
+
+def ActionTimestamp(action):
+  # The epoch seconds of an action's block time, which is UTC.
+  dt = datetime.datetime.fromisoformat(action['@timestamp'])
+  return calendar.timegm(dt.timetuple()) + dt.microsecond / 1000000
+
+def ProducerAccountName(data):
+  # The producer a decoded bp.json is for; some are encoded twice, with the bp.json in a 'json' field.
+  if 'producer_account_name' in data:
+    return data['producer_account_name']
+  if 'json' in data:
+    try:
+      inner = json.loads(data['json'])
+    except (TypeError, json.decoder.JSONDecodeError):
+      return None
+    if isinstance(inner, dict):
+      return inner.get('producer_account_name')
+  return None
+
+class ProducerJSONIndex:
+  # Every producerjson action decoded in one pass and grouped two ways, each group in
+  # chain order:
+  #  - by the owner of the action, for the newest bp.json a producer has set on the chain
+  #  - by the producer_account_name inside the bp.json (the owner for a del), for the node tables
+  # Each entry is a dict with the timestamp, the action name ('set' or 'del') and the decoded data.
+  def __init__(self, actions):
+    self.byOwner = {}
+    self.byProducer = {}
+    self.problems = {}
+    self.count = 0
+    for action in actions:
+      self.Add(action)
+    for entries in list(self.byOwner.values()) + list(self.byProducer.values()):
+      entries.sort(key=lambda e: (e['timestamp'], e['global_sequence']))
+    # The bp.json in effect for each owner: that of its newest set, or nothing after a del.
+    self.latest = {}
+    for owner, entries in self.byOwner.items():
+      self.latest[owner] = entries[-1]['data'] if entries[-1]['action'] == 'set' else {}
+
+  def Add(self, action):
+    owner = action['act']['data']['owner']
+    name = action['act']['name']
+    if name not in ('set', 'del'):
+      self.problems.setdefault(owner, []).append(f"unknown action name ({name}) is present")
+      return
+    entry = {'timestamp': ActionTimestamp(action), 'global_sequence': action.get('global_sequence', 0), 'action': name}
+    if name == 'set':
+      try:
+        entry['data'] = json.loads(action['act']['data']['json'])
+      except (TypeError, json.decoder.JSONDecodeError):
+        actor = action['act']['authorization'][0]['actor']
+        self.problems.setdefault(owner, []).append(
+          f"chain producerjson action data @{action['@timestamp']} could not be decoded as JSON, actor={actor}")
+        return
+      if not isinstance(entry['data'], dict):
+        self.problems.setdefault(owner, []).append(f"chain producerjson action data @{action['@timestamp']} is not a JSON object")
+        return
+      producer = ProducerAccountName(entry['data'])
+    else:
+      entry['data'] = {'producer_account_name': owner}
+      producer = owner
+    self.count += 1
+    self.byOwner.setdefault(owner, []).append(entry)
+    if producer is not None:
+      self.byProducer.setdefault(producer, []).append(entry)
+
+  def Latest(self, owner):
+    return self.latest.get(owner, {})
+
+  def OwnerActions(self, owner):
+    return self.byOwner.get(owner, [])
+
+  def Producers(self):
+    # Every producer with node actions, registered or not.
+    return sorted(self.byProducer)
+
+  def NodeActions(self, producer):
+    return self.byProducer.get(producer, [])
+
+  def Problems(self, owner):
+    return self.problems.get(owner, [])
+
+def SyntheticActions(count, producers):
+  # Random set and del actions spread over the producers, a few of them undecodable.
+  actions = []
+  started = datetime.datetime(2021, 1, 1)
+  for n in range(count):
+    p = f"producer{random.randrange(producers)}"
+    act = {'account': 'producerjson', 'authorization': [{'actor': p, 'permission': 'active'}]}
+    if random.random() < 0.05:
+      act.update(name='del', data={'owner': p})
+    else:
+      nodes = [{'node_type': random.choice(['full', 'seed', 'producer']),
+                'location': {'country': random.choice(['DE', 'US', 'SE', 'JP']), 'latitude': random.uniform(-60, 60), 'longitude': random.uniform(-180, 180)}}
+               for i in range(random.randint(1, 4))]
+      bpjson = json.dumps({'producer_account_name': p, 'org': {'candidate_name': p}, 'nodes': nodes})
+      act.update(name='set', data={'owner': p, 'json': bpjson if random.random() > 0.01 else bpjson[:-1]})
+    actions.append({'@timestamp': (started + datetime.timedelta(minutes=n)).strftime("%Y-%m-%dT%H:%M:%S.000"),
+                    'global_sequence': n + 1, 'act': act})
+  return actions
+
+def Rescan(text, producers):
+  # What genpmi did before the index, for comparison: for every producer the whole
+  # actions file was loaded again and scanned for its newest bp.json, then the node
+  # tables decoded every action once and scanned them all again for every producer.
+  for p in producers:
+    newest = None
+    for action in json.loads(text)['actions']:
+      if action['act']['data']['owner'] != p:
+        continue
+      if action['act']['name'] == 'set':
+        try:
+          newest = json.loads(action['act']['data']['json'])
+        except json.decoder.JSONDecodeError:
+          pass
+      else:
+        newest = {}
+  nodeActions = {}
+  for action in json.loads(text)['actions']:
+    if action['act']['name'] == 'set':
+      try:
+        nodeActions[ActionTimestamp(action)] = json.loads(action['act']['data']['json'])
+      except json.decoder.JSONDecodeError:
+        pass
+    else:
+      nodeActions[ActionTimestamp(action)] = {'producer_account_name': action['act']['data']['owner']}
+  for p in producers:
+    mine = sorted(ts for ts, data in nodeActions.items() if ProducerAccountName(data) == p)
+
+def Benchmark(counts, producers, rescanUpTo):
+  print(f"benchmark: {producers} producers")
+  for count in counts:
+    actions = SyntheticActions(count, producers)
+    names = [f"producer{i}" for i in range(producers)]
+    started = time.perf_counter()
+    index = ProducerJSONIndex(actions)
+    for p in names:
+      index.Latest(p)
+      index.NodeActions(p)
+    indexed = time.perf_counter() - started
+    line = f"benchmark: {count:8d} actions: index {indexed:7.3f}s ({count / indexed:8.0f} actions/s)"
+    if count <= rescanUpTo:
+      text = json.dumps({'actions': actions})
+      started = time.perf_counter()
+      Rescan(text, names)
+      rescanned = time.perf_counter() - started
+      line += f", rescanning per producer {rescanned:7.3f}s ({rescanned / indexed:.0f}x slower)"
+    print(line, flush=True)
+
+# MAIN
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Benchmark the producerjson action index against rescanning the actions per producer.")
+  parser.add_argument("-a", "--actions", help="The action counts to benchmark (default: %(default)s)", type=int, nargs='+', default=[1000, 10000, 100000])
+  parser.add_argument("-p", "--producers", help="How many producers the actions are spread over (default: %(default)s)", type=int, default=500)
+  parser.add_argument("-r", "--rescan-up-to", help="Only time the per-producer rescan up to this many actions (default: %(default)s)", type=int, default=4000)
+  args = parser.parse_args()
+  Benchmark(args.actions, args.producers, args.rescan_up_to)
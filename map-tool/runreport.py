@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# blokcrafters genpmi run report
+# where a genpmi run spent its time: per pipeline stage, per external call and per host
+#
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'history-tools'))
+import hyperion
+
+# How many of the slowest hosts the summary lists.
+SLOWEST_HOSTS = 10
+# How many of the most recent stages a report lists; the totals cover every stage.  A
+# daemon runs for weeks, so the list is bounded.
+RECENT_STAGES = 500
+
+class RunReport:
+  # The stages are timed with Stage(), the most recent kept in the order they ran and all
+  # of them summed by name; the calls made through the HTTP caches are recorded with
+  # Call().  Both are safe from the fetching threads.  The chain and history API calls are
+  # read from the hyperion client metrics at the end.
+  def __init__(self):
+    self.started = time.time()
+    self.startedMonotonic = time.monotonic()
+    self.lock = threading.Lock()
+    self.stages = collections.deque(maxlen=RECENT_STAGES)
+    self.stageTotals = {}
+    self.kinds = {}
+    self.hosts = {}
+
+  @contextlib.contextmanager
+  def Stage(self, name):
+    started = time.monotonic()
+    try:
+      yield
+    finally:
+      seconds = time.monotonic() - started
+      with self.lock:
+        self.stages.append({'name': name, 'started': round(started - self.startedMonotonic, 3), 'seconds': round(seconds, 3)})
+        self.stageTotals[name] = self.stageTotals.get(name, 0) + seconds
+
+  def Call(self, kind, url, seconds, size, ok):
+    host = urllib.parse.urlsplit(url).netloc or url
+    with self.lock:
+      for totals in (self.kinds.setdefault(kind, {}), self.hosts.setdefault(host, {})):
+        totals['calls'] = totals.get('calls', 0) + 1
+        totals['seconds'] = totals.get('seconds', 0) + seconds
+        totals['max_seconds'] = max(totals.get('max_seconds', 0), seconds)
+        totals['bytes'] = totals.get('bytes', 0) + size
+        totals['failed'] = totals.get('failed', 0) + (0 if ok else 1)
+
+  def Observer(self, kind):
+    # For HTTPCache.observer: every fetch the cache makes, recorded as a call of this kind.
+    return lambda url, seconds, size, ok: self.Call(kind, url, seconds, size, ok)
+
+  def ClientCalls(self):
+    # {endpoint path: {calls, seconds, bytes, failed}} from the hyperion client metrics.
+    calls = {}
+    with hyperion.FETCH_SECONDS.lock:
+      for (endpoint, path), counts in hyperion.FETCH_SECONDS.values.items():
+        calls[endpoint + path] = {'calls': sum(counts[:-1]), 'seconds': round(counts[-1], 3), 'bytes': 0, 'failed': 0}
+    for metric, field in ((hyperion.FETCH_BYTES, 'bytes'), (hyperion.FETCH_ERRORS, 'failed')):
+      with metric.lock:
+        for (endpoint, path), value in metric.values.items():
+          calls.setdefault(endpoint + path, {'calls': 0, 'seconds': 0, 'bytes': 0, 'failed': 0})[field] = value
+    return calls
+
+  def Slowest(self, n=SLOWEST_HOSTS):
+    # The hosts whose slowest call took longest, since with the calls made concurrently
+    # that is what holds a stage up.
+    with self.lock:
+      hosts = [dict(totals, host=host) for host, totals in self.hosts.items()]
+    hosts.sort(key=lambda h: (h['max_seconds'], h['seconds']), reverse=True)
+    return hosts[:n]
+
+  def Report(self, caches):
+    with self.lock:
+      stages = list(self.stages)
+      stageTotals = {name: round(seconds, 3) for name, seconds in self.stageTotals.items()}
+      kinds = {kind: dict(totals) for kind, totals in self.kinds.items()}
+      hostCount = len(self.hosts)
+    clientCalls = self.ClientCalls()
+    return {
+      'started': datetime.datetime.utcfromtimestamp(self.started).isoformat(timespec='seconds'),
+      'seconds': round(time.monotonic() - self.startedMonotonic, 3),
+      'stages': stages,
+      'stage_totals': stageTotals,
+      'calls': kinds,
+      'client_calls': clientCalls,
+      'bytes': sum(totals['bytes'] for totals in list(kinds.values()) + list(clientCalls.values())),
+      'hosts': hostCount,
+      'slowest_hosts': self.Slowest(),
+      'caches': caches,
+    }
+
+  def Save(self, directory, caches):
+    # One report per run, named by when it started, so runs can be compared.
+    os.makedirs(directory, exist_ok=True)
+    report = self.Report(caches)
+    filename = os.path.join(directory, "genpmi-{started}.json".format(started=report['started'].replace(':', '')))
+    with open(filename + ".tmp", 'w') as fh:
+      json.dump(report, fh, indent=2)
+    os.replace(filename + ".tmp", filename)
+    return filename, report
+
+def PrintSummary(report, f):
+  print(f"system: profile: {report['seconds']:.1f}s in total, {report['bytes']} bytes transferred", file=f)
+  for name, seconds in sorted(report['stage_totals'].items(), key=lambda kv: kv[1], reverse=True):
+    print(f"system: profile: stage {name}: {seconds:.1f}s", file=f)
+  for kind, totals in sorted(report['calls'].items()):
+    print(f"system: profile: {totals['calls']} {kind} calls, {totals['seconds']:.1f}s, {totals['bytes']} bytes, {totals['failed']} failed", file=f)
+  for name, stats in sorted(report['caches'].items()):
+    print(f"system: profile: {name} cache: {stats['hits']} hits, {stats['stale']} stale, {stats['misses']} misses, {stats['revalidated']} revalidated", file=f)
+  print(f"system: profile: the {len(report['slowest_hosts'])} slowest of {report['hosts']} hosts:", file=f)
+  for host in report['slowest_hosts']:
+    print(f"system: profile: + {host['host']}: slowest {host['max_seconds']:.2f}s, {host['calls']} calls, {host['seconds']:.2f}s, {host['failed']} failed", file=f)
+
+# MAIN
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Compare the run reports written by genpmi.py --profile.")
+  parser.add_argument("reports", help="The run reports, e.g. mainnet-reports/*.json", nargs='+')
+  args = parser.parse_args()
+
+  reports = []
+  for filename in args.reports:
+    with open(filename) as fh:
+      reports.append(json.load(fh))
+  reports.sort(key=lambda r: r['started'])
+  stages = []
+  for report in reports:
+    stages.extend(name for name in report['stage_totals'] if name not in stages)
+  print(' '.join([f"{'started':19s}", f"{'total':>8s}"] + [f"{name[:12]:>12s}" for name in stages] + [f"{'bytes':>10s}"]))
+  for report in reports:
+    print(' '.join([f"{report['started']:19s}", f"{report['seconds']:8.1f}"]
+                   + [f"{report['stage_totals'].get(name, 0):12.1f}" for name in stages] + [f"{report['bytes']:10d}"]))
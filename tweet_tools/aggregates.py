@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+#
+# blokcrafters rolling aggregates
+# sliding-window per-account sums, counts and heavy hitters over the ingested actions, for digest tweets
+#
+import argparse
+import heapq
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'history-tools'))
+import hyperion
+import outbox
+
+# How many keys each bucket tracks exactly before the smallest are pruned.
+CAPACITY = 1000
+# The number of buckets a window is split into when the aggregate does not say.
+BUCKETS = 12
+# Seconds the clock is held back when it brings digests due, so that actions still on
+# their way in are counted.
+CLOCK_GRACE = 60
+
+class Summary:
+    # The per-key sums and counts of one time bucket, bounded in size.  Keys are added in
+    # O(1) and, once there are twice `capacity` of them, the smallest half by sum is
+    # dropped.  floor is the largest sum dropped so far: a key seen again after being
+    # dropped may be under-counted by up to that much, and a key not tracked at all
+    # summed to no more than it.
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.sums = {}
+        self.counts = {}
+        self.floor = 0
+
+    def Add(self, key, amount):
+        if key in self.sums:
+            self.sums[key] += amount
+            self.counts[key] += 1
+            return
+        self.sums[key] = amount
+        self.counts[key] = 1
+        if len(self.sums) > 2 * self.capacity:
+            self.Prune()
+
+    def Prune(self):
+        keep = set(heapq.nlargest(self.capacity, self.sums, key=self.sums.get))
+        for key in list(self.sums):
+            if key not in keep:
+                self.floor = max(self.floor, self.sums.pop(key))
+                del self.counts[key]
+
+    def State(self):
+        return {'sums': self.sums, 'counts': self.counts, 'floor': self.floor}
+
+    def Load(self, state):
+        self.sums = state['sums']
+        self.counts = state['counts']
+        self.floor = state['floor']
+
+class Window:
+    # One aggregate from the rules file: the matching actions grouped by a data field,
+    # summed over a sliding window of buckets, with a digest every `every` seconds of
+    # block time listing the top keys or the keys over a threshold.
+    def __init__(self, spec, capacity=CAPACITY):
+        self.spec = spec
+        self.name = spec['name']
+        self.window = spec['window']
+        self.bucket = spec.get('bucket', max(1, self.window // BUCKETS))
+        self.every = spec.get('every', self.window)
+        self.groupBy = spec.get('group_by', 'from')
+        self.capacity = capacity
+        self.buckets = {}
+        self.nextDigest = None
+        self.lastSecond = None
+        self.lastTime = None
+
+    def ItemTime(self, item):
+        # Busy accounts have many actions a second, so only parse each second once.
+        second = item['timestamp'][:19]
+        if second != self.lastSecond:
+            self.lastSecond = second
+            self.lastTime = hyperion.ActionTime(second + ".000")
+        return self.lastTime
+
+    def Add(self, items):
+        # Count the matching actions of a batch in chain order, returning the digests
+        # that came due along the way.  This runs for every ingested action, so the
+        # spec is unpacked once per batch rather than per action.
+        spec = self.spec
+        contract = spec.get('contract')
+        action = spec.get('action')
+        prefix = spec.get('memo_prefix')
+        amountOver = spec.get('amount_over', float('-inf'))
+        groupBy = self.groupBy
+        digests = []
+        for item in items:
+            if (action is not None and item['action'] != action) or (contract is not None and item['contract'] != contract):
+                continue
+            data = item['data']
+            amount = data.get('amount')
+            key = data.get(groupBy)
+            if not isinstance(amount, (int, float)) or amount <= amountOver or not isinstance(key, str):
+                continue
+            if prefix is not None and not str(data.get('memo', '')).startswith(prefix):
+                continue
+            when = self.ItemTime(item)
+            if self.nextDigest is None or when >= self.nextDigest:
+                digests.extend(self.Due(when))
+            index = int(when // self.bucket)
+            summary = self.buckets.get(index)
+            if summary is None:
+                oldest = int((self.nextDigest - self.window) // self.bucket)
+                if index < oldest:
+                    # Too late for any window still to be digested.
+                    continue
+                summary = self.buckets[index] = Summary(self.capacity)
+                for old in [i for i in self.buckets if i < oldest]:
+                    del self.buckets[old]
+            summary.Add(key, amount)
+        return digests
+
+    def Due(self, now):
+        # The digests whose time has come, as (end, message), oldest first: one for every
+        # window that ended since the last call.  Their buckets are all still held, since
+        # only those before the window of nextDigest are dropped.  The windows that start
+        # after the newest bucket are empty, so a long gap costs no more than a short one.
+        if self.nextDigest is None:
+            self.nextDigest = (now // self.every + 1) * self.every
+            return []
+        if now < self.nextDigest:
+            return []
+        last = now // self.every * self.every
+        newest = (max(self.buckets) + 1) * self.bucket if self.buckets else None
+        digests = []
+        end = self.nextDigest
+        while end <= last and newest is not None and end - self.window < newest:
+            message = self.Digest(end)
+            if message:
+                digests.append((end, message))
+            end += self.every
+        self.nextDigest = last + self.every
+        return digests
+
+    def Totals(self, end):
+        # Key -> [sum, count, error] over the window ending at end.
+        first = int((end - self.window) // self.bucket)
+        last = int(end // self.bucket)
+        totals = {}
+        error = 0
+        for index, summary in self.buckets.items():
+            if first <= index < last:
+                error += summary.floor
+                for key, amount in summary.sums.items():
+                    total = totals.setdefault(key, [0, 0])
+                    total[0] += amount
+                    total[1] += summary.counts[key]
+        return {key: [amount, count, error] for key, (amount, count) in totals.items()}
+
+    def Digest(self, end):
+        spec = self.spec
+        rankBy = 1 if spec.get('rank_by') == 'count' else 0
+        keys = [(key, total) for key, total in self.Totals(end).items()
+                if total[0] > spec.get('sum_over', float('-inf')) and total[1] > spec.get('count_over', 0)]
+        keys.sort(key=lambda kv: kv[1][rankBy], reverse=True)
+        keys = keys[:spec.get('top', len(keys))]
+        if not keys:
+            return None
+        lines = [spec['line'].format(rank=rank, key=key, sum=total[0], count=total[1], error=total[2])
+                 for rank, (key, total) in enumerate(keys, 1)]
+        return outbox.DigestMessage({'digest_message': spec['message']}, lines)
+
+    def State(self):
+        return {'next_digest': self.nextDigest,
+                'buckets': {str(index): summary.State() for index, summary in self.buckets.items()}}
+
+    def Load(self, state):
+        self.nextDigest = state['next_digest']
+        for index, summaryState in state['buckets'].items():
+            self.buckets[int(index)] = Summary(self.capacity)
+            self.buckets[int(index)].Load(summaryState)
+
+class Aggregates:
+    # All the aggregates in a rules file, grouped by the watched account they read.
+    def __init__(self, specs, capacity=CAPACITY):
+        self.windows = []
+        self.byAccount = {}
+        for spec in specs:
+            for key in ('name', 'account', 'window', 'message', 'line'):
+                if key not in spec:
+                    raise ValueError(f"aggregate {spec} is missing '{key}'")
+            window = Window(spec, capacity)
+            if window.window % window.bucket:
+                raise ValueError(f"aggregate {spec['name']}: window must be a multiple of bucket")
+            self.windows.append(window)
+            self.byAccount.setdefault(spec['account'], []).append(window)
+
+    def Add(self, account, items):
+        # Feed one account's batch (in chain order) and return the digests due as
+        # (key, name, message).
+        digests = []
+        for window in self.byAccount.get(account, []):
+            for end, message in window.Add(items):
+                digests.append((f"{window.name}:{end:.0f}", window.name, message))
+        return digests
+
+    def Tick(self, now):
+        # The digests due by the clock, for when the watched actions have gone quiet.
+        digests = []
+        for window in self.windows:
+            for end, message in window.Due(now - CLOCK_GRACE):
+                digests.append((f"{window.name}:{end:.0f}", window.name, message))
+        return digests
+
+    def Save(self, filename):
+        hyperion.SaveCursor(filename, {window.name: window.State() for window in self.windows})
+
+    def Load(self, filename):
+        state = hyperion.LoadCursor(filename) or {}
+        for window in self.windows:
+            if window.name in state:
+                window.Load(state[window.name])
+
+def Check():
+    # Digests across a gap of several periods in block time and then by the clock: every
+    # window that ended in the gap is digested, oldest first, and the empty ones are not.
+    spec = {'name': 'check', 'account': 'eosio.token', 'window': 120, 'every': 60, 'bucket': 60,
+            'message': "{n} keys", 'line': "{key} {sum}"}
+    window = Window(spec)
+    base = 1600000020
+    def Item(offset, key, amount):
+        return {'contract': 'eosio.token', 'action': 'transfer', 'data': {'from': key, 'amount': amount},
+                'timestamp': hyperion.IsoTime(base + offset)}
+    got = []
+    for offset, key, amount in ((10, 'alice', 5), (70, 'bob', 7), (75, 'carol', 3), (370, 'dave', 1)):
+        got.extend(window.Add([Item(offset, key, amount)]))
+    got.extend(window.Due(base + 600))
+    expected = [(60, "1 keys\nalice 5"), (120, "3 keys\nbob 7\nalice 5\ncarol 3"), (180, "2 keys\nbob 7\ncarol 3"),
+                (420, "1 keys\ndave 1"), (480, "1 keys\ndave 1")]
+    got = [(end - base, message) for end, message in got]
+    for end, message in got:
+        print(f"check: digest at +{end:.0f}s: {message!r}")
+    if got != expected:
+        print(f"check: FAIL: expected {expected}")
+        sys.exit(1)
+
+# MAIN
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rolling aggregates for waxalert.py.")
+    parser.add_argument("--check", help="Check that a gap of several digest periods digests every window that ended in it", action="store_true")
+    args = parser.parse_args()
+
+    if args.check:
+        Check()
+    else:
+        parser.error("--check is required")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# blokcrafters batch filtering of action pages
+# decodes a page of actions into columns once and evaluates the alert rules over them with numpy masks
+#
+import numpy as np
+
+class Columns:
+    # One page of simple actions as arrays: epoch milliseconds, amounts (nan when
+    # there is none), interned contract and action codes, and a bit per memo prefix.
+    def __init__(self, ruleSet, items):
+        self.timestamp = np.array([item['timestamp'] for item in items], dtype='datetime64[ms]').astype(np.int64)
+        self.amount = np.fromiter((Amount(item['data']) for item in items), dtype=np.float64, count=len(items))
+        self.contract = np.fromiter((ruleSet.Code(item['contract']) for item in items), dtype=np.int32, count=len(items))
+        self.action = np.fromiter((ruleSet.Code(item['action']) for item in items), dtype=np.int32, count=len(items))
+        self.memo = np.fromiter((ruleSet.MemoBits(item['data']) for item in items), dtype=np.int64, count=len(items))
+
+def Amount(data):
+    amount = data.get('amount')
+    return amount if isinstance(amount, (int, float)) else np.nan
+
+def FirstOlder(items, cutoff):
+    # The index of the first item older than cutoff in a newest-first page.  Hyperion
+    # timestamps are fixed width, so they compare correctly as strings and the items
+    # past the cutoff are never looked at.
+    lo, hi = 0, len(items)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if items[mid]['timestamp'] < cutoff:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def TimestampString(epochMs):
+    return str(np.datetime64(int(epochMs), 'ms'))
+
+class RuleSet:
+    # The rules for one watched account, compiled for evaluation a page at a time.
+    def __init__(self, rules):
+        self.rules = rules
+        self.strings = {}
+        self.prefixes = sorted(set(rule['memo_prefix'] for rule in rules if 'memo_prefix' in rule))
+        self.maxAge = None
+        if rules and all('max_age' in rule for rule in rules):
+            self.maxAge = max(rule['max_age'] for rule in rules)
+
+    def Code(self, s):
+        return self.strings.setdefault(s, len(self.strings))
+
+    def MemoBits(self, data):
+        memo = data.get('memo')
+        bits = 0
+        if isinstance(memo, str):
+            for i, prefix in enumerate(self.prefixes):
+                if memo.startswith(prefix):
+                    bits |= 1 << i
+        return bits
+
+    def Evaluate(self, items, now=None, newestFirst=False):
+        # The (rule, item) matches in item order.  When now is given each rule's max_age
+        # (seconds) limits it to recent actions, and on a newest-first page the scan
+        # stops at the first action too old for every rule.
+        if now is not None and newestFirst and self.maxAge is not None:
+            items = items[:FirstOlder(items, TimestampString((now - self.maxAge) * 1000))]
+        if len(items) == 0:
+            return []
+        columns = Columns(self, items)
+        hits = []
+        for r, rule in enumerate(self.rules):
+            mask = np.ones(len(items), dtype=bool)
+            if 'action' in rule:
+                mask &= columns.action == self.Code(rule['action'])
+            if 'contract' in rule:
+                mask &= columns.contract == self.Code(rule['contract'])
+            if 'amount_over' in rule:
+                mask &= columns.amount > rule['amount_over']
+            if 'memo_prefix' in rule:
+                mask &= (columns.memo & (1 << self.prefixes.index(rule['memo_prefix']))) != 0
+            if now is not None and 'max_age' in rule:
+                mask &= columns.timestamp > (now - rule['max_age']) * 1000
+            for i in np.flatnonzero(mask):
+                hits.append((int(i), r))
+        hits.sort()
+        return [(self.rules[r], items[i]) for i, r in hits]
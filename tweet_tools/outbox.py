@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# blokcrafters tweet outbox
+# a durable queue of tweets between the alert evaluation and the twitter api
+#
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+
+# Seconds to back off when rate limited and twitter does not say for how long.
+RATE_LIMIT_DELAY = 900
+# Seconds before the first retry of a tweet that failed for another reason, doubled on each attempt.
+RETRY_DELAY = 30
+# How many times a tweet is tried before it is marked failed.
+MAX_ATTEMPTS = 6
+# How long sent tweets are kept so that the same action is never queued twice.
+KEEP_SENT = 7 * 86400
+# The longest tweet twitter accepts.
+TWEET_LENGTH = 280
+
+DEPTH = metrics.NewGauge('waxalert_outbox_depth', "Tweets waiting in the outbox")
+SEND_SECONDS = metrics.NewHistogram('waxalert_tweet_send_seconds', "Time taken by each call to the tweet sink", ('result',))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+  key TEXT PRIMARY KEY,
+  rule TEXT NOT NULL,
+  message TEXT NOT NULL,
+  digest_line TEXT,
+  created REAL NOT NULL,
+  state TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt REAL NOT NULL DEFAULT 0,
+  sent REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt);
+"""
+
+class RateLimited(Exception):
+    """
+    Raised by a send function when the sink is rate limiting us.
+    retryAfter is the number of seconds to wait, or None when unknown.
+    """
+    def __init__(self, retryAfter=None):
+        Exception.__init__(self, f"rate limited, retry after {retryAfter}")
+        self.retryAfter = retryAfter
+
+class Duplicate(Exception):
+    """
+    Raised by a send function when the sink already has this message,
+    e.g. after a crash between sending a tweet and recording it as sent.
+    """
+    pass
+
+def Connect(filename):
+    db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+class Outbox:
+    # The tweets waiting to be sent, keyed by rule and global_sequence so an action is queued
+    # at most once however many times it is evaluated.
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = Connect(filename)
+        self.db.executescript(SCHEMA)
+        # Anything caught mid-send by a crash is tried again; the sink's duplicate
+        # check (Duplicate) stops it from being posted twice.
+        self.db.execute("UPDATE outbox SET state = 'pending' WHERE state = 'sending'")
+        self.wakeup = threading.Event()
+
+    def Put(self, key, rule, message, digestLine=None):
+        cursor = self.db.execute("INSERT OR IGNORE INTO outbox (key, rule, message, digest_line, created) VALUES (?, ?, ?, ?, ?)",
+                                 (key, rule, message, digestLine, time.time()))
+        self.wakeup.set()
+        return cursor.rowcount == 1
+
+    def Depth(self):
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE state IN ('pending', 'sending')").fetchone()[0]
+
+def DigestMessage(rule, lines):
+    # One tweet for a burst of matches, cut short to fit when there are too many.
+    message = rule['digest_message'].format(n=len(lines))
+    for i, line in enumerate(lines):
+        more = f"\n+{len(lines) - i} more"
+        if len(message) + 1 + len(line) + (len(more) if i < len(lines) - 1 else 0) > TWEET_LENGTH:
+            return message + more
+        message += "\n" + line
+    return message
+
+class Sender(threading.Thread):
+    # Drains the outbox in the background.  Rules with a 'digest' window (seconds) have
+    # their matches held for that long and sent as a single digest tweet when more than
+    # one arrived; everything else is sent as soon as possible.
+    def __init__(self, outbox, send, rules):
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = outbox.filename
+        self.wakeup = outbox.wakeup
+        self.send = send
+        self.rules = {rule['name']: rule for rule in rules}
+        self.pausedUntil = 0
+        self.lastPrune = 0
+
+    def Ready(self, db, now, flush):
+        # The groups of rows that are due to be sent, oldest first.
+        rows = db.execute("SELECT key, rule, message, digest_line, created FROM outbox "
+                          "WHERE state = 'pending' AND next_attempt <= ? ORDER BY created", (now,)).fetchall()
+        groups = []
+        digests = {}
+        for key, ruleName, message, digestLine, created in rows:
+            rule = self.rules.get(ruleName, {})
+            window = rule.get('digest', 0)
+            if window and digestLine is not None:
+                if ruleName not in digests:
+                    if created + window > now and not flush:
+                        continue
+                    digests[ruleName] = (created, [])
+                    groups.append((rule, digests[ruleName][1]))
+                if created < digests[ruleName][0] + window:
+                    digests[ruleName][1].append((key, message, digestLine))
+            else:
+                groups.append((rule, [(key, message, digestLine)]))
+        return groups
+
+    def SendGroup(self, db, rule, rows):
+        keys = [row[0] for row in rows]
+        marks = ','.join('?' * len(keys))
+        if len(rows) > 1:
+            message = DigestMessage(rule, [row[2] for row in rows])
+        else:
+            message = rows[0][1]
+        db.execute(f"UPDATE outbox SET state = 'sending', attempts = attempts + 1 WHERE key IN ({marks})", keys)
+        started = time.perf_counter()
+        try:
+            self.send(message)
+            SEND_SECONDS.Observe(time.perf_counter() - started, result='sent')
+        except Duplicate:
+            SEND_SECONDS.Observe(time.perf_counter() - started, result='duplicate')
+        except RateLimited as e:
+            SEND_SECONDS.Observe(time.perf_counter() - started, result='rate_limited')
+            delay = e.retryAfter if e.retryAfter is not None else RATE_LIMIT_DELAY
+            self.pausedUntil = time.time() + delay
+            db.execute(f"UPDATE outbox SET state = 'pending', attempts = attempts - 1 WHERE key IN ({marks})", keys)
+            print(f"outbox: rate limited, pausing for {delay:.0f}s", file=sys.stderr, flush=True)
+            return False
+        except Exception as e:
+            SEND_SECONDS.Observe(time.perf_counter() - started, result='failed')
+            print(f"outbox: sending {keys} failed: {e}", file=sys.stderr, flush=True)
+            for key in keys:
+                attempts = db.execute("SELECT attempts FROM outbox WHERE key = ?", (key,)).fetchone()[0]
+                state = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+                db.execute("UPDATE outbox SET state = ?, next_attempt = ? WHERE key = ?",
+                           (state, time.time() + RETRY_DELAY * 2 ** (attempts - 1), key))
+            return False
+        db.execute(f"UPDATE outbox SET state = 'sent', sent = ? WHERE key IN ({marks})", [time.time()] + keys)
+        return True
+
+    def Drain(self, db, flush=False):
+        # Send everything that is due, stopping early when rate limited.
+        sent = 0
+        for rule, rows in self.Ready(db, time.time(), flush):
+            if time.time() < self.pausedUntil:
+                break
+            if self.SendGroup(db, rule, rows):
+                sent += 1
+        DEPTH.Set(db.execute("SELECT COUNT(*) FROM outbox WHERE state IN ('pending', 'sending')").fetchone()[0])
+        if time.time() - self.lastPrune > 3600:
+            db.execute("DELETE FROM outbox WHERE state = 'sent' AND sent < ?", (time.time() - KEEP_SENT,))
+            self.lastPrune = time.time()
+        return sent
+
+    def Flush(self):
+        # Send everything still pending now, digests included, e.g. at the end of a cron run.
+        db = Connect(self.filename)
+        while self.Drain(db, flush=True) and time.time() >= self.pausedUntil:
+            pass
+        db.close()
+
+    def run(self):
+        db = Connect(self.filename)
+        while True:
+            self.wakeup.clear()
+            self.Drain(db)
+            # Wake up for new tweets, otherwise check every second for digests and retries coming due.
+            self.wakeup.wait(timeout=max(1, self.pausedUntil - time.time()))
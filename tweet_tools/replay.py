@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# blokcrafters replay of archived action pages through the alert rules
+#
+import bz2
+import gzip
+import json
+import lzma
+import random
+import time
+
+import hyperion
+
+# How many actions are evaluated together, the same role as a fetched page when live.
+BATCH_SIZE = 10000
+
+def OpenArchive(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, 'rt')
+    elif filename.endswith('.xz'):
+        return lzma.open(filename, 'rt')
+    return open(filename)
+
+def Normalize(record):
+    # Archived actions may be full get_actions entries or simple=true ones.
+    if 'act' in record:
+        return hyperion.SimpleAction(record)
+    item = dict(record)
+    item.setdefault('trx_id', item.get('transaction_id'))
+    if isinstance(item.get('notified'), str):
+        item['notified'] = item['notified'].split(',')
+    return item
+
+def ReadArchive(filenames):
+    # Every action in the archives in file order.  Each line is either one action or a
+    # whole get_actions response (actions or simple_actions).
+    for filename in filenames:
+        with OpenArchive(filename) as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'actions' in record or 'simple_actions' in record:
+                    for action in record.get('actions', record.get('simple_actions')):
+                        yield Normalize(action)
+                else:
+                    yield Normalize(record)
+
+def Replay(ruleSets, route, actions, onMatch=None, batchSize=BATCH_SIZE, aggregator=None, onDigest=None):
+    # Run the actions through the same evaluation as the live engine, as fast as they
+    # can be read, and return the counts.  route(item) gives the watched accounts an
+    # action concerns and onMatch(rule, item) is called for every match.  With an
+    # aggregator the rolling aggregates are fed too, their digests falling due by
+    # block time, and onDigest(key, name, message) is called for each.
+    stats = {'actions': 0, 'evaluated': {}, 'matches': {}, 'digests': 0, 'seconds': 0, 'evaluating': 0, 'aggregating': 0}
+    for account, ruleSet in ruleSets.items():
+        stats['evaluated'][account] = 0
+        for rule in ruleSet.rules:
+            stats['matches'][rule['name']] = 0
+    started = time.perf_counter()
+    batch = []
+    for item in actions:
+        batch.append(item)
+        if len(batch) >= batchSize:
+            ReplayBatch(ruleSets, route, batch, stats, onMatch, aggregator, onDigest)
+            batch = []
+    ReplayBatch(ruleSets, route, batch, stats, onMatch, aggregator, onDigest)
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+def ReplayBatch(ruleSets, route, batch, stats, onMatch, aggregator=None, onDigest=None):
+    # Only the rule evaluation itself counts as evaluating; the aggregates are timed apart.
+    batches = {}
+    for item in batch:
+        for account in route(item):
+            batches.setdefault(account, []).append(item)
+    stats['actions'] += len(batch)
+    for account, items in batches.items():
+        stats['evaluated'][account] += len(items)
+        started = time.perf_counter()
+        matches = ruleSets[account].Evaluate(items)
+        stats['evaluating'] += time.perf_counter() - started
+        for rule, item in matches:
+            stats['matches'][rule['name']] += 1
+            if onMatch:
+                onMatch(rule, item)
+        if aggregator:
+            started = time.perf_counter()
+            digests = aggregator.Add(account, items)
+            stats['aggregating'] += time.perf_counter() - started
+            for key, name, message in digests:
+                stats['digests'] += 1
+                if onDigest:
+                    onDigest(key, name, message)
+
+def Report(ruleSets, stats):
+    rate = stats['actions'] / stats['seconds'] if stats['seconds'] else 0
+    evalRate = stats['actions'] / stats['evaluating'] if stats['evaluating'] else 0
+    print(f"replay: {stats['actions']} actions in {stats['seconds']:.2f}s = {rate:.0f} actions/s")
+    print(f"replay: evaluation alone {stats['evaluating']:.2f}s = {evalRate:.0f} actions/s")
+    if stats['aggregating']:
+        print(f"replay: aggregates {stats['aggregating']:.2f}s")
+    for account, ruleSet in ruleSets.items():
+        evaluated = stats['evaluated'][account]
+        for rule in ruleSet.rules:
+            matches = stats['matches'][rule['name']]
+            hitRate = 100 * matches / evaluated if evaluated else 0
+            print(f"replay: {rule['name']}: {matches} matches of {evaluated} {account} actions ({hitRate:.3f}%)")
+    if stats['digests']:
+        print(f"replay: {stats['digests']} aggregate digests")
+    return evalRate
+
+def SyntheticArchive(filename, count, accounts, pageSize=1000):
+    # A gzip'd archive of get_actions pages of random eosio.token transfers to and
+    # from the given accounts, with heavy-tailed amounts so that thresholds bite.
+    memos = {'eosio.ram': 'buy ram', 'eosio.names': 'bid name x'}
+    others = [f"user{i}.wam" for i in range(1000)]
+    started = 1600000000
+    with gzip.open(filename, 'wt', compresslevel=1) as fh:
+        for first in range(0, count, pageSize):
+            actions = []
+            for gs in range(first, min(first + pageSize, count)):
+                sender = random.choice(others)
+                receiver = random.choice(accounts) if random.random() < 0.05 else random.choice(others)
+                amount = round(random.paretovariate(1.1) * 100, 4)
+                actions.append({
+                    '@timestamp': time.strftime("%Y-%m-%dT%H:%M:%S.000", time.gmtime(started + gs // 10)),
+                    'block_num': gs // 10,
+                    'global_sequence': gs + 1,
+                    'trx_id': f"{gs:064x}",
+                    'notified': ['eosio.token', sender, receiver],
+                    'act': {'account': 'eosio.token', 'name': 'transfer',
+                            'data': {'from': sender, 'to': receiver, 'amount': amount, 'symbol': 'WAX',
+                                     'quantity': f"{amount:.8f} WAX", 'memo': memos.get(receiver, random.choice(['', 'deposit', 'game reward']))}},
+                })
+            fh.write(json.dumps({'actions': actions}) + "\n")
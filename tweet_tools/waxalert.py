@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+#
+# blokcrafters WAX alert engine
+# evaluates every rule in a rules file against the watched accounts with twitter notification
+#
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import queue
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'history-tools'))
+import actionstore
+import hyperion
+import jsonstream
+import metrics
+import hyperionstream
+import batchfilter
+import replay
+import outbox
+import aggregates
+
+# importing the module
+import tweepy
+
+def LoadRules(filename):
+    with open(filename) as fh:
+        config = json.load(fh)
+    for rule in config['rules']:
+        for key in ('name', 'account', 'message'):
+            if key not in rule:
+                raise ValueError(f"{filename}: rule {rule} is missing '{key}'")
+    return config
+
+def RulesByAccount(rules, aggregateSpecs=()):
+    # The watched accounts, each with the rules that apply to its actions.  Accounts
+    # read only by aggregates are watched with no rules.
+    byAccount = {}
+    for rule in rules:
+        byAccount.setdefault(rule['account'], []).append(rule)
+    for spec in aggregateSpecs:
+        byAccount.setdefault(spec['account'], [])
+    return byAccount
+
+def Pushdown(account, specs, now=None):
+    # The get_actions query for an account, narrowed on the server to what its rules (and
+    # aggregates) could match: a contract or action when they all name the same one, the
+    # smallest amount_over when they all have one and are transfers, and, for a cron run at
+    # now, the largest max_age when they all have one.  The rules still check every action.
+    if not specs or not config.get('pushdown', True):
+        return {'account': account}
+    contracts = set(spec.get('contract') for spec in specs)
+    actions = set(spec.get('action') for spec in specs)
+    action = actions.pop() if len(actions) == 1 else None
+    amountOver = None
+    if action == 'transfer' and all('amount_over' in spec for spec in specs):
+        amountOver = min(spec['amount_over'] for spec in specs)
+    after = None
+    if now is not None and all('max_age' in spec for spec in specs):
+        after = now - max(spec['max_age'] for spec in specs)
+    return hyperion.Pushdown({'account': account}, contract=contracts.pop() if len(contracts) == 1 else None,
+                             action=action, amountOver=amountOver, after=after)
+
+def Message(rule, item, count):
+    fields = dict(item['data'])
+    fields['count'] = count
+    fields['account'] = rule['account']
+    fields['memo_rest'] = str(fields.get('memo', ''))[len(rule.get('memo_prefix', '')):]
+    return rule['message'].format(**fields)
+
+EVALUATED = metrics.NewCounter('waxalert_actions_evaluated_total', "Actions evaluated against the rules", ('account',))
+MATCHED = metrics.NewCounter('waxalert_matches_total', "Actions that matched a rule", ('rule',))
+EVALUATE_SECONDS = metrics.NewHistogram('waxalert_rule_evaluation_seconds', "Time taken to evaluate the rules over one account's batch", ('account',))
+INGEST_LAG = metrics.NewGauge('waxalert_ingest_lag_seconds', "Seconds between the newest evaluated action's block time and when it was evaluated", ('account',))
+DIGESTS = metrics.NewCounter('waxalert_aggregate_digests_total', "Aggregate digests queued", ('aggregate',))
+
+def Evaluate(byAccount, batches, now=None):
+    # Check every action fetched in this batch against the rules for the account it
+    # was fetched for.  When now is given the batches are newest-first pages and each
+    # rule's max_age (seconds) restricts it to recent actions.
+    matches = []
+    for account, items in batches.items():
+        if len(items) == 0:
+            continue
+        with EVALUATE_SECONDS.Time(account=account):
+            accountMatches = ruleSets[account].Evaluate(items, now=now, newestFirst=now is not None)
+        EVALUATED.Inc(len(items), account=account)
+        newest = max(items[0]['timestamp'], items[-1]['timestamp'])
+        INGEST_LAG.Set(round(time.time() - hyperion.ActionTime(newest), 3), account=account)
+        for rule, item in accountMatches:
+            MATCHED.Inc(rule=rule['name'])
+        matches.extend(accountMatches)
+    return matches
+
+def Aggregate(batches, now=None):
+    # Feed the batches (in chain order) to the rolling aggregates and queue the digests
+    # that came due, by block time or, for quiet accounts, by the clock.
+    digests = []
+    for account, items in batches.items():
+        digests.extend(aggregator.Add(account, items))
+    if now is not None:
+        digests.extend(aggregator.Tick(now))
+    for key, name, message in digests:
+        DIGESTS.Inc(aggregate=name)
+        if tweets.Put(key, name, message):
+            print(f"{name}: digest queued", flush=True)
+
+def SaveAggregates():
+    # The windows are bounded but not tiny, so they are saved at most once a minute.
+    global lastAggregateSave
+    if aggregator.windows and time.monotonic() - lastAggregateSave >= 60:
+        aggregator.Save(args.aggregates)
+        lastAggregateSave = time.monotonic()
+
+def WriteMetrics():
+    if args.metrics_file:
+        metrics.WriteTextfile(args.metrics_file)
+
+def FetchLatest(client, account, pageSize):
+    if store:
+        store.Sync(client, account, {'account': account})
+        return [hyperion.SimpleAction(a) for a in store.Query(account=account, newestFirst=True, limit=pageSize)]
+    query = dict(Pushdown(account, byAccount[account], time.time()), sort='desc', limit=pageSize)
+    return [hyperion.SimpleAction(a) for a in client.StreamActions(query, keep=jsonstream.ACTION_FIELDS)]
+
+def SimpleCursor(item):
+    # The cursor just past a simple action; it keeps the block time so a follower that
+    # falls behind catches up in time slices.
+    return {'block': item['block'], 'global_sequence': item['global_sequence'],
+            'timestamp': hyperion.ActionTime(item['timestamp'])}
+
+def FetchNew(client, account, cursor):
+    # Yield the new actions of an account in batches of at most a page, with the cursor
+    # advanced past each batch as it is yielded, so however far behind the account is only
+    # one batch is held.
+    if store:
+        # Bring the store up to date, then read what this engine has not yet evaluated from it.
+        store.Sync(client, account, {'account': account})
+        actions = (hyperion.SimpleAction(a) for a in store.Query(account=account, afterSequence=cursor['global_sequence']))
+    else:
+        actions = hyperion.FollowActions(client, followQueries[account], cursor)
+    while True:
+        items = list(itertools.islice(actions, hyperion.PAGE_SIZE))
+        if not items:
+            return
+        if store:
+            cursor.update(SimpleCursor(items[-1]))
+        yield items
+
+def FetchAll(fetch):
+    # Fetch all the watched accounts concurrently over the shared session.
+    futures = {account: executor.submit(fetch, account) for account in byAccount}
+    batches = {}
+    for account, future in futures.items():
+        try:
+            batches[account] = future.result()
+        except (OSError, ValueError) as e:
+            print(f"{account}: {client.historyURL}: {e}", file=sys.stderr, flush=True)
+    return batches
+
+def LoadCursors():
+    cursors = hyperion.LoadCursor(args.cursors) or {}
+    for account in byAccount:
+        if account not in cursors:
+            cursors[account] = hyperion.HeadCursor(client, {'account': account})
+    hyperion.SaveCursor(args.cursors, cursors)
+    return cursors
+
+def PollAccount(account, cursor, batches):
+    # Put an account's new actions on the batches queue a batch at a time, each with the
+    # cursor past it, then (account, None, None) once it is caught up or has failed.
+    try:
+        for items in FetchNew(client, account, cursor):
+            batches.put((account, items, dict(cursor)))
+    except (OSError, ValueError) as e:
+        print(f"{account}: {client.historyURL}: {e}", file=sys.stderr, flush=True)
+    finally:
+        batches.put((account, None, None))
+
+def PollNew(cursors):
+    # The watched accounts are fetched concurrently over the shared session and their
+    # batches evaluated here as they come, each account's cursor saved after each of its
+    # batches, so only a few batches are held however far behind the accounts are.  The
+    # fetches advance copies, so a batch that fails part way is fetched again next time.
+    batches = queue.Queue(maxsize=len(byAccount))
+    for account in byAccount:
+        executor.submit(PollAccount, account, dict(cursors[account]), batches)
+    polling = len(byAccount)
+    while polling:
+        account, items, cursor = batches.get()
+        if items is None:
+            polling -= 1
+            continue
+        Tweet(Evaluate(byAccount, {account: items}))
+        Aggregate({account: items})
+        cursors[account] = cursor
+        hyperion.SaveCursor(args.cursors, cursors)
+    Aggregate({}, time.time())
+    SaveAggregates()
+    WriteMetrics()
+
+def StreamRequests(byAccount):
+    # One stream request per watched account, narrowed to the contract and action
+    # of its rules and aggregates when they all agree.
+    streamRequests = []
+    for account, rules in byAccount.items():
+        rules = rules + [window.spec for window in aggregator.byAccount.get(account, [])]
+        contracts = set(rule.get('contract', 'eosio.token') for rule in rules)
+        actions = set(rule.get('action', '*') for rule in rules)
+        streamRequests.append({
+            'contract': contracts.pop() if len(contracts) == 1 else '*',
+            'action': actions.pop() if len(actions) == 1 else '*',
+            'account': account,
+        })
+    return streamRequests
+
+def Concerns(item):
+    # The watched accounts an action was sent to or made by.
+    return [account for account in byAccount if account == item['contract'] or account in item['notified']]
+
+def RouteStreamed(items, cursors):
+    # Hand each streamed action to every watched account it concerns, dropping the
+    # ones already handled, e.g. replayed after a reconnect or seen by a fallback poll.
+    batches = {}
+    for item in sorted(items, key=lambda i: i['global_sequence']):
+        for account in Concerns(item):
+            if item['global_sequence'] <= cursors[account]['global_sequence']:
+                continue
+            batches.setdefault(account, []).append(item)
+            cursors[account] = SimpleCursor(item)
+    return batches
+
+def Tweet(matches):
+    # Queue the tweets; the sender thread does the network calls.
+    global nbr_of_tweets
+    for rule, item in matches:
+        t_msg = Message(rule, item, nbr_of_tweets)
+        digestLine = None
+        if 'digest_line' in rule:
+            digestLine = Message(dict(rule, message=rule['digest_line']), item, nbr_of_tweets)
+        if tweets.Put(f"{rule['name']}:{item['global_sequence']}", rule['name'], t_msg, digestLine):
+            nbr_of_tweets = nbr_of_tweets + 1
+
+def SendTweet(message):
+    if args.dry_run:
+        print(message, flush=True)
+        return
+    try:
+        api.update_status(status = message)
+    except tweepy.TooManyRequests as e:
+        reset = e.response.headers.get('x-rate-limit-reset')
+        raise outbox.RateLimited(float(reset) - time.time() if reset else None)
+    except tweepy.Forbidden as e:
+        # 187: Status is a duplicate.
+        if 187 in e.api_codes:
+            raise outbox.Duplicate(message)
+        raise
+
+# MAIN
+parser = argparse.ArgumentParser()
+parser.add_argument("-r", "--rules", help="The rules file to load (default: %(default)s)",
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "waxalert-rules.json"))
+parser.add_argument("-f", "--follow", help="Keep running and evaluate every new action exactly once by following a cursor per account", action="store_true")
+parser.add_argument("-s", "--stream", help="Keep running on the Hyperion stream API, resuming from the cursors and polling while the stream is down", action="store_true")
+parser.add_argument("--fallback", help="Seconds the stream may be down before polling takes over (default: %(default)s)", type=int, default=60)
+parser.add_argument("-c", "--cursors", help="The file holding the follow cursors (default: %(default)s)", default="waxalert-cursors.json")
+parser.add_argument("-i", "--interval", help="Seconds to wait between polls while following (default: %(default)s)", type=int, default=30)
+parser.add_argument("--store", help="Keep the fetched actions in this local action store and evaluate them from it")
+parser.add_argument("-o", "--outbox", help="The file holding the tweets waiting to be sent (default: %(default)s)", default="waxalert-outbox.sqlite")
+parser.add_argument("-a", "--aggregates", help="The file holding the rolling aggregate windows between runs (default: %(default)s)", default="waxalert-aggregates.json")
+parser.add_argument("--replay", help="Run archived action pages (JSONL, optionally .gz/.bz2/.xz) through the rules and report, without tweeting", nargs='+', metavar="ARCHIVE")
+parser.add_argument("--benchmark", help="Replay a synthetic archive of this many actions and report the throughput", type=int, default=0)
+parser.add_argument("--min-rate", help="With --replay/--benchmark, exit non-zero when evaluation runs slower than this many actions/s", type=float, default=0)
+parser.add_argument("--metrics-port", help="Serve Prometheus metrics on this port", type=int, default=0)
+parser.add_argument("--metrics-file", help="Write Prometheus metrics to this file (node_exporter textfile collector) after each poll and at exit")
+parser.add_argument("-n", "--dry-run", help="Print the tweets instead of sending them", action="store_true")
+args = parser.parse_args()
+
+config = LoadRules(args.rules)
+aggregator = aggregates.Aggregates(config.get('aggregates', []))
+byAccount = RulesByAccount(config['rules'], config.get('aggregates', []))
+ruleSets = {account: batchfilter.RuleSet(rules) for account, rules in byAccount.items()}
+if args.metrics_port:
+    metrics.Serve(args.metrics_port)
+store = actionstore.ActionStore(args.store) if args.store else None
+client = hyperion.HistoryClient(config.get('history', hyperion.HISTORY_URL), poolSize=max(len(byAccount), hyperion.SLICE_WORKERS))
+# Following, the aggregates see the actions too, so they narrow the queries no further than they need.
+followQueries = {account: Pushdown(account, rules + [spec for spec in config.get('aggregates', []) if spec['account'] == account])
+                 for account, rules in byAccount.items()}
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(byAccount))
+
+if args.replay or args.benchmark:
+    archives = args.replay or []
+    if args.benchmark:
+        archive = tempfile.NamedTemporaryFile(suffix='.jsonl.gz', delete=False)
+        print(f"replay: writing a synthetic archive of {args.benchmark} actions ...", flush=True)
+        replay.SyntheticArchive(archive.name, args.benchmark, list(byAccount))
+        archives.append(archive.name)
+    onMatch = None
+    onDigest = None
+    if args.dry_run:
+        onMatch = lambda rule, item: print(f"{item['timestamp']} {rule['name']}: {Message(rule, item, 0)}")
+        onDigest = lambda key, name, message: print(f"{key}: {message}")
+    stats = replay.Replay(ruleSets, Concerns, replay.ReadArchive(archives), onMatch,
+                          aggregator=aggregator, onDigest=onDigest)
+    evalRate = replay.Report(ruleSets, stats)
+    if args.benchmark:
+        os.remove(archive.name)
+    if evalRate < args.min_rate:
+        print(f"replay: evaluation rate {evalRate:.0f} actions/s is below --min-rate {args.min_rate:.0f}")
+        sys.exit(1)
+    sys.exit(0)
+
+api = None
+if not args.dry_run:
+    # tweet authentication of consumer key and secret, then of access token and secret
+    auth = tweepy.OAuthHandler(config['twitter']['consumer_key'], config['twitter']['consumer_secret'])
+    auth.set_access_token(config['twitter']['access_token'], config['twitter']['access_token_secret'])
+    api = tweepy.API(auth)
+
+tweets = outbox.Outbox(args.outbox)
+sender = outbox.Sender(tweets, SendTweet, config['rules'])
+if args.stream or args.follow:
+    sender.start()
+
+nbr_of_tweets = 0
+lastAggregateSave = time.monotonic()
+if args.stream or args.follow:
+    aggregator.Load(args.aggregates)
+if args.stream:
+    cursors = LoadCursors()
+    stream = hyperionstream.ActionStream(config.get('stream', client.historyURL), StreamRequests(byAccount),
+                                         lambda request: cursors[request['account']]['block'])
+    stream.Start()
+    lastPoll = 0
+    while True:
+        items = stream.Get(timeout=1)
+        if items:
+            batches = RouteStreamed(items, cursors)
+            Tweet(Evaluate(byAccount, batches))
+            Aggregate(batches, time.time())
+            hyperion.SaveCursor(args.cursors, cursors)
+            SaveAggregates()
+            WriteMetrics()
+        elif stream.DownFor() >= args.fallback and time.monotonic() - lastPoll >= args.interval:
+            # The stream has been down too long - poll until it comes back.
+            PollNew(cursors)
+            lastPoll = time.monotonic()
+        else:
+            Aggregate({}, time.time())
+
+if args.follow:
+    cursors = LoadCursors()
+    while True:
+        PollNew(cursors)
+        time.sleep(args.interval)
+
+pageSize = config.get('page_size', 100)
+batches = FetchAll(lambda account: FetchLatest(client, account, pageSize))
+Tweet(Evaluate(byAccount, batches, now=time.time()))
+sender.Flush()
+WriteMetrics()
+print("Total number of tweets", nbr_of_tweets)